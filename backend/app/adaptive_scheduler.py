@@ -0,0 +1,263 @@
+"""自适应调度：根据GitHub速率限制余量、README变更队列长度和观察到的变更速率，决定每次运行处理多少仓库以及下次何时运行
+
+README的全量刷新不再集中在凌晨一次完成，而是按上次检查时间从旧到新分摊到每次运行中，
+每 ADAPTIVE_FULL_REFRESH_HOURS 小时覆盖所有仓库一次。
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Deque, Dict
+
+from . import crud
+from .database import SessionLocal, StarredRepo
+from .github_service import rate_limit_tracker
+from .readme_service import readme_service
+from .shared_state import state_broker
+
+logger = logging.getLogger(__name__)
+
+# GitHub认证用户默认的每小时请求配额，无法获取速率限制时按此估算
+DEFAULT_RATE_LIMIT = 5000
+
+# 估计变更速率的时间窗口
+CHANGE_RATE_WINDOW = timedelta(hours=24)
+
+# 速率限制记录在这段时间内更新过时不再单独查询
+RATE_LIMIT_MAX_AGE = timedelta(minutes=1)
+
+# 调度决策保存在共享状态中的键前缀（readme、sync 和 history），不是领导者的进程从这里读取
+DECISION_KEY_PREFIX = "scheduler_decision:"
+
+
+class AdaptivePlanner:
+    """为README任务和同步任务做调度决策，最近的决策记录同时保存在共享状态中，供任意进程的 /scheduler/status 查看"""
+    
+    def __init__(self):
+        # 留给同步、手动处理等其他请求的配额比例
+        self.reserve_ratio = float(os.getenv("ADAPTIVE_RATE_LIMIT_RESERVE", "0.2"))
+        self.min_interval = timedelta(minutes=float(os.getenv("ADAPTIVE_MIN_INTERVAL_MINUTES", "15")))
+        self.max_interval = timedelta(minutes=float(os.getenv("ADAPTIVE_MAX_INTERVAL_MINUTES", "360")))
+        self.max_repos_per_run = int(os.getenv("ADAPTIVE_MAX_REPOS_PER_RUN", "500"))
+        # 变更队列为空时，等预计积累到这么多变更再运行
+        self.target_batch = int(os.getenv("ADAPTIVE_TARGET_BATCH", "50"))
+        # 全量刷新周期，0表示只处理变更队列
+        self.full_refresh_hours = float(os.getenv("ADAPTIVE_FULL_REFRESH_HOURS", "24"))
+        # 每个仓库平均消耗的请求数（没有README的仓库会逐个尝试文件名），按实际运行平滑更新
+        self.requests_per_repo = float(os.getenv("ADAPTIVE_REQUESTS_PER_REPO", "3"))
+        
+        self.last_readme_decision = None
+        self.last_sync_decision = None
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=20)
+    
+    async def _get_rate_limit(self) -> Dict[str, Any]:
+        """最近的速率限制记录，过期时查询 /rate_limit（不消耗配额，响应头同时更新记录）"""
+        stats = rate_limit_tracker.get_stats()
+        if stats["updated_at"] and datetime.utcnow() - stats["updated_at"] < RATE_LIMIT_MAX_AGE:
+            return stats
+        try:
+            await readme_service.github_service.check_rate_limit()
+        except Exception as e:
+            logger.warning(f"查询GitHub速率限制失败，使用最近的记录: {e}")
+        return rate_limit_tracker.get_stats()
+    
+    def _read_backlog(self, now: datetime) -> Dict[str, int]:
+        """变更队列长度（获取失败过、已到重试时间的仓库单独计数）、仓库总数和最近的变更数（在线程中执行，使用独立的数据库会话）"""
+        db = SessionLocal()
+        try:
+            pending = readme_service.get_pending_repos_query(db).order_by(None)
+            return {
+                "backlog": pending.filter(StarredRepo.readme_failures.is_(None)).count(),
+                "retry_due": pending.filter(StarredRepo.readme_failures.isnot(None)).count(),
+                "total_repos": db.query(StarredRepo).count(),
+                "recent_changes": crud.count_recent_changes(db, now - CHANGE_RATE_WINDOW)
+            }
+        finally:
+            db.close()
+    
+    async def gather_signals(self) -> Dict[str, Any]:
+        """收集调度决策需要的输入"""
+        now = datetime.utcnow()
+        rate_limit = await self._get_rate_limit()
+        counts = await asyncio.to_thread(self._read_backlog, now)
+        
+        return {
+            "limit": rate_limit["limit"],
+            "remaining": rate_limit["remaining"],
+            "reset_at": rate_limit["reset_at"],
+            "backlog": counts["backlog"],
+            "retry_due": counts["retry_due"],
+            "total_repos": counts["total_repos"],
+            "change_rate_per_hour": round(counts["recent_changes"] / (CHANGE_RATE_WINDOW.total_seconds() / 3600), 2),
+            "requests_per_repo": self.requests_per_repo
+        }
+    
+    def _budget(self, signals: Dict[str, Any], now: datetime, keep_reserve: bool = True):
+        """(可用请求数, 配额重置时间)：默认扣除保留部分，未知时按默认配额估算"""
+        limit = signals["limit"] or DEFAULT_RATE_LIMIT
+        remaining = signals["remaining"] if signals["remaining"] is not None else limit
+        reset_at = signals["reset_at"]
+        if reset_at is None or reset_at <= now:
+            reset_at = now + timedelta(hours=1)
+        reserve = int(limit * self.reserve_ratio) if keep_reserve else 0
+        return max(0, remaining - reserve), reset_at
+    
+    def plan_readmes(self, signals: Dict[str, Any], now: datetime = None) -> Dict[str, Any]:
+        """决定本次README任务处理的仓库数和下次运行时间"""
+        now = now or datetime.utcnow()
+        backlog = signals["backlog"]
+        retry_due = signals["retry_due"]
+        total_repos = signals["total_repos"]
+        change_rate = signals["change_rate_per_hour"]
+        usable, reset_at = self._budget(signals, now)
+        
+        # 运行间隔：有积压时尽快追赶；否则按变更速率等待积累到目标批量
+        # 到期重试的仓库（之前获取失败过）随下一次运行处理，不缩短间隔，一直失败的仓库不会让任务保持最短间隔
+        if backlog > 0:
+            interval, reason = self.min_interval, "backlog"
+        elif change_rate > 0:
+            interval, reason = timedelta(hours=self.target_batch / change_rate), "change_rate"
+        else:
+            interval, reason = self.max_interval, "idle"
+        
+        # 分摊全量刷新：每次运行的刷新量不超过单次上限，仓库多时缩短间隔而不是增大单次运行
+        if self.full_refresh_hours > 0 and total_repos > 0:
+            refresh_interval = timedelta(hours=self.full_refresh_hours * self.max_repos_per_run / total_repos)
+            if refresh_interval < interval:
+                interval, reason = refresh_interval, "full_refresh"
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        
+        # 配额在reset_at重置，到重置为止的可用请求按运行次数平摊，避免一次用光
+        share = min(1.0, interval / (reset_at - now))
+        budget_repos = int(usable * share / max(self.requests_per_repo, 0.1))
+        capacity = min(budget_repos, self.max_repos_per_run)
+        
+        # 变更队列中新的变更排在到期重试的仓库之前
+        max_changed = min(backlog + retry_due, capacity)
+        stale_quota = 0
+        if self.full_refresh_hours > 0:
+            stale_quota = math.ceil(total_repos * (interval / timedelta(hours=self.full_refresh_hours)))
+        max_stale = max(0, min(stale_quota, capacity - max_changed))
+        
+        next_run_at = now + interval
+        if capacity == 0 and (backlog > 0 or retry_due > 0 or stale_quota > 0):
+            # 配额不足，等重置后再运行
+            next_run_at, reason = reset_at + timedelta(minutes=1), "rate_limit"
+        elif backlog > max_changed:
+            reason = "backlog_remaining"
+        
+        return {
+            "job": "readme",
+            "decided_at": now,
+            "reason": reason,
+            "signals": signals,
+            "usable_requests": usable,
+            "rate_limit_reset_at": reset_at,
+            "interval_minutes": round(interval.total_seconds() / 60, 1),
+            "max_changed": max_changed,
+            "max_stale": max_stale,
+            "next_run_at": next_run_at,
+            "result": None
+        }
+    
+    def plan_sync(self, signals: Dict[str, Any], now: datetime = None) -> Dict[str, Any]:
+        """决定是否现在同步：每页100个仓库，可以使用保留的配额，仍不足时推迟到重置之后"""
+        now = now or datetime.utcnow()
+        usable, reset_at = self._budget(signals, now, keep_reserve=False)
+        estimated_requests = signals["total_repos"] // 100 + 2
+        run = usable >= estimated_requests
+        
+        return {
+            "job": "sync",
+            "decided_at": now,
+            "reason": "budget_ok" if run else "rate_limit",
+            "signals": signals,
+            "usable_requests": usable,
+            "estimated_requests": estimated_requests,
+            "run": run,
+            "next_run_at": now if run else reset_at + timedelta(minutes=1)
+        }
+    
+    async def _save_decision(self, decision: Dict[str, Any]):
+        """把决策和历史记录写入共享状态（在线程中执行），失败时只记录日志"""
+        states = {
+            DECISION_KEY_PREFIX + decision["job"]: decision,
+            DECISION_KEY_PREFIX + "history": {"requests_per_repo": self.requests_per_repo, "history": list(self.history)}
+        }
+        try:
+            for key, value in states.items():
+                await asyncio.to_thread(state_broker.set_state, key, json.dumps(value, default=str))
+        except Exception as e:
+            logger.warning(f"保存调度决策失败: {e}")
+    
+    async def decide_readmes(self) -> Dict[str, Any]:
+        decision = self.plan_readmes(await self.gather_signals())
+        self.last_readme_decision = decision
+        self.history.append(decision)
+        await self._save_decision(decision)
+        logger.info(
+            f"自适应调度：处理变更 {decision['max_changed']} 个、刷新 {decision['max_stale']} 个，"
+            f"下次运行 {decision['next_run_at']:%Y-%m-%d %H:%M}（{decision['reason']}）"
+        )
+        return decision
+    
+    async def decide_sync(self) -> Dict[str, Any]:
+        decision = self.plan_sync(await self.gather_signals())
+        self.last_sync_decision = decision
+        self.history.append(decision)
+        await self._save_decision(decision)
+        return decision
+    
+    async def record_run(self, decision: Dict[str, Any], processed: int, success: int, requests: int):
+        """记录一次运行的结果，并用实际消耗更新每个仓库的平均请求数"""
+        if processed > 0 and requests > 0:
+            observed = requests / processed
+            self.requests_per_repo = round(0.7 * self.requests_per_repo + 0.3 * observed, 2)
+        decision["result"] = {
+            "processed": processed,
+            "success": success,
+            "requests": requests,
+            "finished_at": datetime.utcnow()
+        }
+        await self._save_decision(decision)
+    
+    async def get_status(self, local: bool = True) -> Dict[str, Any]:
+        """调度设置和最近的决策；local为False时（本进程不是领导者）决策从共享状态读取"""
+        status = {
+            "settings": {
+                "rate_limit_reserve": self.reserve_ratio,
+                "min_interval_minutes": self.min_interval.total_seconds() / 60,
+                "max_interval_minutes": self.max_interval.total_seconds() / 60,
+                "max_repos_per_run": self.max_repos_per_run,
+                "target_batch": self.target_batch,
+                "full_refresh_hours": self.full_refresh_hours
+            },
+            "requests_per_repo": self.requests_per_repo,
+            "rate_limit": rate_limit_tracker.get_stats(),
+            "last_readme_decision": self.last_readme_decision,
+            "last_sync_decision": self.last_sync_decision,
+            "history": list(self.history)
+        }
+        if local:
+            return status
+        
+        try:
+            stored = await asyncio.to_thread(state_broker.get_states, DECISION_KEY_PREFIX)
+        except Exception as e:
+            logger.warning(f"读取调度决策失败: {e}")
+            return status
+        
+        stored = {key[len(DECISION_KEY_PREFIX):]: json.loads(value) for key, value in stored.items()}
+        status["last_readme_decision"] = stored.get("readme")
+        status["last_sync_decision"] = stored.get("sync")
+        if "history" in stored:
+            status["requests_per_repo"] = stored["history"]["requests_per_repo"]
+            status["history"] = stored["history"]["history"]
+        return status
+
+
+# 全局自适应调度实例
+adaptive_planner = AdaptivePlanner()
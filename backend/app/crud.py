@@ -1,9 +1,10 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, func
-from typing import List, Optional
+from sqlalchemy import and_, or_, func, case
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
 import json
 from . import schemas
-from .database import StarredRepo
+from .database import StarredRepo, RepoReadme, RepoNeighbor, AppSetting, SchedulerLease
 
 
 def get_repo_by_repo_id(db: Session, repo_id: int) -> Optional[StarredRepo]:
@@ -11,6 +12,20 @@ def get_repo_by_repo_id(db: Session, repo_id: int) -> Optional[StarredRepo]:
     return db.query(StarredRepo).filter(StarredRepo.repo_id == repo_id).first()
 
 
+def get_repos_by_repo_ids(db: Session, repo_ids: List[int], chunk_size: int = 500) -> List[StarredRepo]:
+    """根据一组repo_id批量获取仓库（IN查询），按输入顺序返回，不存在的ID会被跳过"""
+    repo_map = {}
+    unique_ids = list(dict.fromkeys(repo_ids))
+    
+    # 分块查询，避免超出SQLite参数数量限制
+    for i in range(0, len(unique_ids), chunk_size):
+        chunk = unique_ids[i:i + chunk_size]
+        for repo in db.query(StarredRepo).filter(StarredRepo.repo_id.in_(chunk)).all():
+            repo_map[repo.repo_id] = repo
+    
+    return [repo_map[repo_id] for repo_id in repo_ids if repo_id in repo_map]
+
+
 def create_starred_repo(db: Session, repo: schemas.StarredRepoCreate) -> StarredRepo:
     """创建新的starred仓库记录"""
     db_repo = StarredRepo(**repo.dict())
@@ -40,8 +55,7 @@ def upsert_starred_repo(db: Session, repo: schemas.StarredRepoCreate) -> Starred
         return create_starred_repo(db, repo)
 
 
-def search_repos(
-    db: Session,
+def _build_search_conditions(
     query: Optional[str] = None,
     language: Optional[str] = None,
     owner: Optional[str] = None,
@@ -50,16 +64,9 @@ def search_repos(
     starred_after: Optional[str] = None,
     starred_before: Optional[str] = None,
     has_topics: Optional[bool] = None,
-    is_fork: Optional[bool] = None,
-    sort_by: str = 'starred_at',
-    sort_order: str = 'desc',
-    page: int = 1,
-    per_page: int = 20
-) -> tuple[List[StarredRepo], int]:
-    """搜索starred仓库"""
-    db_query = db.query(StarredRepo)
-    
-    # 构建搜索条件
+    is_fork: Optional[bool] = None
+) -> list:
+    """构建搜索过滤条件"""
     conditions = []
     
     if query:
@@ -128,6 +135,52 @@ def search_repos(
     if is_fork is not None:
         conditions.append(StarredRepo.is_fork == is_fork)
     
+    return conditions
+
+
+def _relevance_order(query: str):
+    """关键词相关度排序：名称完全匹配 > 名称包含 > 全名包含 > 描述包含 > 其他（topics）"""
+    return case(
+        (func.lower(StarredRepo.name) == query.lower(), 0),
+        (StarredRepo.name.ilike(f"%{query}%"), 1),
+        (StarredRepo.full_name.ilike(f"%{query}%"), 2),
+        (StarredRepo.description.ilike(f"%{query}%"), 3),
+        else_=4
+    )
+
+
+def search_repos(
+    db: Session,
+    query: Optional[str] = None,
+    language: Optional[str] = None,
+    owner: Optional[str] = None,
+    min_stars: Optional[int] = None,
+    max_stars: Optional[int] = None,
+    starred_after: Optional[str] = None,
+    starred_before: Optional[str] = None,
+    has_topics: Optional[bool] = None,
+    is_fork: Optional[bool] = None,
+    sort_by: str = 'starred_at',
+    sort_order: str = 'desc',
+    page: int = 1,
+    per_page: int = 20
+) -> tuple[List[StarredRepo], int]:
+    """搜索starred仓库"""
+    db_query = db.query(StarredRepo)
+    
+    # 构建搜索条件
+    conditions = _build_search_conditions(
+        query=query,
+        language=language,
+        owner=owner,
+        min_stars=min_stars,
+        max_stars=max_stars,
+        starred_after=starred_after,
+        starred_before=starred_before,
+        has_topics=has_topics,
+        is_fork=is_fork
+    )
+    
     # 应用所有条件
     if conditions:
         db_query = db_query.filter(and_(*conditions))
@@ -136,16 +189,20 @@ def search_repos(
     total = db_query.count()
     
     # 构建排序
-    sort_column = getattr(StarredRepo, sort_by, StarredRepo.starred_at)
-    if sort_order.lower() == 'asc':
-        order_clause = sort_column.asc()
+    if sort_by == 'relevance' and query:
+        # 按关键词相关度排序，相关度相同时按star数排序
+        order_clauses = [_relevance_order(query).asc(), StarredRepo.stargazers_count.desc()]
     else:
-        order_clause = sort_column.desc()
+        sort_column = getattr(StarredRepo, sort_by, StarredRepo.starred_at)
+        if sort_order.lower() == 'asc':
+            order_clauses = [sort_column.asc()]
+        else:
+            order_clauses = [sort_column.desc()]
     
     # 分页和排序
     repos = (
         db_query
-        .order_by(order_clause)
+        .order_by(*order_clauses)
         .offset((page - 1) * per_page)
         .limit(per_page)
         .all()
@@ -154,6 +211,55 @@ def search_repos(
     return repos, total
 
 
+def lexical_search(db: Session, query: str, limit: int = 50, **filters) -> List[StarredRepo]:
+    """关键词搜索，按相关度排序，不统计总数（供混合搜索使用）"""
+    conditions = _build_search_conditions(query=query, **filters)
+    return (
+        db.query(StarredRepo)
+        .filter(and_(*conditions))
+        .order_by(_relevance_order(query).asc(), StarredRepo.stargazers_count.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def get_filtered_readme_repo_ids(db: Session, **filters) -> List[int]:
+    """获取满足过滤条件且已有README向量的仓库ID，作为语义搜索的候选集合"""
+    conditions = _build_search_conditions(**filters)
+    rows = (
+        db.query(StarredRepo.repo_id)
+        .join(RepoReadme, RepoReadme.repo_id == StarredRepo.repo_id)
+        .filter(and_(*conditions))
+        .all()
+    )
+    return [row[0] for row in rows]
+
+
+def iter_repos(db: Session, chunk_size: int = 500, **filters):
+    """按repo_id键集分页分块读取满足过滤条件的仓库，每次产出一个列表（不使用OFFSET，内存占用与总数无关）"""
+    conditions = _build_search_conditions(**filters)
+    last_repo_id = None
+    
+    while True:
+        db_query = db.query(StarredRepo).filter(and_(*conditions))
+        if last_repo_id is not None:
+            db_query = db_query.filter(StarredRepo.repo_id > last_repo_id)
+        
+        repos = db_query.order_by(StarredRepo.repo_id).limit(chunk_size).all()
+        if not repos:
+            break
+        
+        yield repos
+        last_repo_id = repos[-1].repo_id
+        # 已产出的对象不再需要，避免会话的identity map持续增长
+        db.expunge_all()
+
+
+def has_search_filters(**filters) -> bool:
+    """是否设置了任意结构化过滤条件"""
+    return any(value is not None and value != "" for value in filters.values())
+
+
 def get_all_languages(db: Session) -> List[str]:
     """获取所有编程语言列表"""
     languages = (
@@ -198,6 +304,15 @@ def get_repo_stats(db: Session) -> dict:
     }
 
 
+def count_recent_changes(db: Session, since: datetime) -> int:
+    """统计since之后新star或有新提交的仓库数（按上次同步得到的数据），用于估计README变更速率"""
+    return (
+        db.query(func.count(StarredRepo.id))
+        .filter(or_(StarredRepo.starred_at >= since, StarredRepo.pushed_at >= since))
+        .scalar()
+    ) or 0
+
+
 def delete_all_repos(db: Session) -> int:
     """删除所有仓库记录"""
     count = db.query(StarredRepo).count()
@@ -312,6 +427,7 @@ def bulk_upsert_starred_repos_fast(db: Session, repos: List[schemas.StarredRepoC
                     'starred_at': stmt.excluded.starred_at,
                     'created_at': stmt.excluded.created_at,
                     'updated_at': stmt.excluded.updated_at,
+                    'pushed_at': stmt.excluded.pushed_at,
                     'is_fork': stmt.excluded.is_fork,
                     'is_private': stmt.excluded.is_private,
                     'size': stmt.excluded.size,
@@ -340,4 +456,268 @@ def bulk_upsert_starred_repos_fast(db: Session, repos: List[schemas.StarredRepoC
         db.rollback()
         # 如果快速方法失败，回退到常规方法
         print(f"Fast bulk upsert failed, falling back to regular method: {e}")
-        return bulk_upsert_starred_repos(db, repos, batch_size=100) 
\ No newline at end of file
+        return bulk_upsert_starred_repos(db, repos, batch_size=100) 
+
+
+def get_readme_hashes(db: Session, repo_ids: List[int]) -> Dict[int, str]:
+    """批量获取README内容哈希，返回 {repo_id: content_hash}"""
+    if not repo_ids:
+        return {}
+    rows = (
+        db.query(RepoReadme.repo_id, RepoReadme.content_hash)
+        .filter(RepoReadme.repo_id.in_(repo_ids))
+        .all()
+    )
+    return {repo_id: content_hash for repo_id, content_hash in rows}
+
+
+def get_readme_previews(db: Session, repo_ids: List[int], length: int = 200) -> Dict[int, str]:
+    """批量获取README内容的开头部分（多取1个字符用于判断是否截断），返回 {repo_id: preview}"""
+    if not repo_ids:
+        return {}
+    rows = (
+        db.query(RepoReadme.repo_id, func.substr(RepoReadme.content, 1, length + 1))
+        .filter(RepoReadme.repo_id.in_(repo_ids))
+        .all()
+    )
+    return {repo_id: preview or "" for repo_id, preview in rows}
+
+
+def save_readme_batch(
+    db: Session,
+    readme_rows: List[dict],
+    checked_repo_ids: List[int],
+    retry_at: Optional[Dict[int, datetime]] = None
+) -> None:
+    """批量upsert README记录并更新仓库的README检查时间，整批只提交一次
+    
+    retry_at 为获取失败的仓库 {repo_id: 下次重试时间}：失败次数加1，到重试时间前不再处理
+    """
+    from sqlalchemy.dialects.sqlite import insert
+    
+    now = datetime.utcnow()
+    
+    try:
+        if readme_rows:
+            stmt = insert(RepoReadme).values([
+                {**row, "processed_at": now, "updated_at": now} for row in readme_rows
+            ])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['repo_id'],
+                set_={
+                    'content': stmt.excluded.content,
+                    'content_hash': stmt.excluded.content_hash,
+                    'embedding_id': stmt.excluded.embedding_id,
+                    'processed_at': stmt.excluded.processed_at,
+                    'updated_at': stmt.excluded.updated_at,
+                }
+            )
+            db.execute(stmt)
+        
+        if checked_repo_ids:
+            db.query(StarredRepo).filter(
+                StarredRepo.repo_id.in_(checked_repo_ids)
+            ).update({
+                StarredRepo.readme_checked_at: now,
+                StarredRepo.readme_failures: None,
+                StarredRepo.readme_retry_at: None
+            }, synchronize_session=False)
+        
+        # 按重试时间分组更新，每组一条语句
+        failed_by_time: Dict[datetime, List[int]] = {}
+        for repo_id, retry_time in (retry_at or {}).items():
+            failed_by_time.setdefault(retry_time, []).append(repo_id)
+        for retry_time, repo_ids in failed_by_time.items():
+            db.query(StarredRepo).filter(
+                StarredRepo.repo_id.in_(repo_ids)
+            ).update({
+                StarredRepo.readme_failures: func.coalesce(StarredRepo.readme_failures, 0) + 1,
+                StarredRepo.readme_retry_at: retry_time
+            }, synchronize_session=False)
+        
+        db.commit()
+    
+    except Exception as e:
+        db.rollback()
+        raise e
+
+
+def get_repo_neighbors(db: Session, repo_id: int, limit: int) -> List[Tuple[int, float]]:
+    """读取预先计算的相似仓库，返回按相似度从高到低的 [(neighbor_repo_id, similarity)]"""
+    rows = (
+        db.query(RepoNeighbor.neighbor_repo_id, RepoNeighbor.similarity)
+        .filter(RepoNeighbor.repo_id == repo_id)
+        .order_by(RepoNeighbor.rank)
+        .limit(limit)
+        .all()
+    )
+    return [(neighbor_repo_id, similarity) for neighbor_repo_id, similarity in rows]
+
+
+def get_neighbor_lists(db: Session, repo_ids: List[int], chunk_size: int = 500) -> Dict[int, List[Tuple[int, float]]]:
+    """批量读取多个仓库的相似仓库列表"""
+    result: Dict[int, List[Tuple[int, float]]] = {}
+    for i in range(0, len(repo_ids), chunk_size):
+        rows = (
+            db.query(RepoNeighbor.repo_id, RepoNeighbor.neighbor_repo_id, RepoNeighbor.similarity)
+            .filter(RepoNeighbor.repo_id.in_(repo_ids[i:i + chunk_size]))
+            .order_by(RepoNeighbor.repo_id, RepoNeighbor.rank)
+            .all()
+        )
+        for repo_id, neighbor_repo_id, similarity in rows:
+            result.setdefault(repo_id, []).append((neighbor_repo_id, similarity))
+    return result
+
+
+def get_neighbor_thresholds(db: Session) -> Dict[int, Tuple[int, float]]:
+    """每个仓库当前相似仓库列表的长度和最低相似度，返回 {repo_id: (数量, 最低相似度)}"""
+    rows = (
+        db.query(RepoNeighbor.repo_id, func.count(RepoNeighbor.rank), func.min(RepoNeighbor.similarity))
+        .group_by(RepoNeighbor.repo_id)
+        .all()
+    )
+    return {repo_id: (count, min_similarity) for repo_id, count, min_similarity in rows}
+
+
+def get_repos_with_neighbors_in(db: Session, neighbor_repo_ids: List[int], chunk_size: int = 500) -> set:
+    """相似仓库列表中包含指定仓库的仓库ID"""
+    result = set()
+    for i in range(0, len(neighbor_repo_ids), chunk_size):
+        rows = (
+            db.query(RepoNeighbor.repo_id)
+            .filter(RepoNeighbor.neighbor_repo_id.in_(neighbor_repo_ids[i:i + chunk_size]))
+            .distinct()
+            .all()
+        )
+        result.update(row[0] for row in rows)
+    return result
+
+
+def save_repo_neighbors(
+    db: Session,
+    neighbors: Dict[int, List[Tuple[int, float]]],
+    computed_at: Optional[datetime] = None,
+    chunk_size: int = 500
+) -> None:
+    """整体替换一组仓库的相似仓库列表，computed_at不为空时同时记录计算时间，一次提交"""
+    from sqlalchemy import insert
+    
+    repo_ids = list(neighbors.keys())
+    try:
+        for i in range(0, len(repo_ids), chunk_size):
+            chunk = repo_ids[i:i + chunk_size]
+            db.query(RepoNeighbor).filter(RepoNeighbor.repo_id.in_(chunk)).delete(synchronize_session=False)
+            if computed_at is not None:
+                # 显式保留updated_at，避免onupdate把它也改掉
+                db.query(RepoReadme).filter(RepoReadme.repo_id.in_(chunk)).update(
+                    {RepoReadme.neighbors_updated_at: computed_at, RepoReadme.updated_at: RepoReadme.updated_at},
+                    synchronize_session=False
+                )
+        
+        rows = [
+            {"repo_id": repo_id, "rank": rank, "neighbor_repo_id": neighbor_repo_id, "similarity": similarity}
+            for repo_id, items in neighbors.items()
+            for rank, (neighbor_repo_id, similarity) in enumerate(items, start=1)
+        ]
+        if rows:
+            db.execute(insert(RepoNeighbor), rows)
+        
+        db.commit()
+    
+    except Exception as e:
+        db.rollback()
+        raise e
+
+
+def delete_repo_neighbors(db: Session, repo_ids: List[int], chunk_size: int = 500) -> None:
+    """删除一组仓库的相似仓库列表"""
+    for i in range(0, len(repo_ids), chunk_size):
+        db.query(RepoNeighbor).filter(
+            RepoNeighbor.repo_id.in_(repo_ids[i:i + chunk_size])
+        ).delete(synchronize_session=False)
+    db.commit()
+
+
+def get_setting(db: Session, key: str, default: Optional[str] = None) -> Optional[str]:
+    """读取应用配置"""
+    setting = db.query(AppSetting).filter(AppSetting.key == key).first()
+    return setting.value if setting else default
+
+
+def set_settings(db: Session, values: Dict[str, Optional[str]]) -> None:
+    """在一个事务中写入多项应用配置"""
+    from sqlalchemy.dialects.sqlite import insert
+    
+    now = datetime.utcnow()
+    try:
+        stmt = insert(AppSetting).values([
+            {"key": key, "value": value, "updated_at": now} for key, value in values.items()
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['key'],
+            set_={'value': stmt.excluded.value, 'updated_at': stmt.excluded.updated_at}
+        )
+        db.execute(stmt)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+
+
+def acquire_lease(db: Session, name: str, holder: str, ttl_seconds: float) -> bool:
+    """获取或续期租约：租约不存在、已过期或已由holder持有时成功，使用条件UPDATE/INSERT保证只有一个实例成功"""
+    from datetime import timedelta
+    from sqlalchemy.exc import IntegrityError
+    
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl_seconds)
+    try:
+        # 续期自己的租约
+        renewed = (
+            db.query(SchedulerLease)
+            .filter(SchedulerLease.name == name, SchedulerLease.holder == holder)
+            .update({SchedulerLease.renewed_at: now, SchedulerLease.expires_at: expires_at}, synchronize_session=False)
+        )
+        if not renewed:
+            # 接管已过期的租约
+            renewed = (
+                db.query(SchedulerLease)
+                .filter(SchedulerLease.name == name, SchedulerLease.expires_at < now)
+                .update({
+                    SchedulerLease.holder: holder,
+                    SchedulerLease.acquired_at: now,
+                    SchedulerLease.renewed_at: now,
+                    SchedulerLease.expires_at: expires_at
+                }, synchronize_session=False)
+            )
+        if not renewed:
+            # 租约不存在时创建，并发创建时主键冲突的一方失败
+            if db.query(SchedulerLease.name).filter(SchedulerLease.name == name).first():
+                db.rollback()
+                return False
+            db.add(SchedulerLease(name=name, holder=holder, acquired_at=now, renewed_at=now, expires_at=expires_at))
+        db.commit()
+        return True
+    except IntegrityError:
+        db.rollback()
+        return False
+    except Exception as e:
+        db.rollback()
+        raise e
+
+
+def release_lease(db: Session, name: str, holder: str) -> None:
+    """主动释放自己持有的租约（让其他实例立即接管）"""
+    try:
+        db.query(SchedulerLease).filter(
+            SchedulerLease.name == name, SchedulerLease.holder == holder
+        ).delete(synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+
+
+def get_lease(db: Session, name: str) -> Optional[SchedulerLease]:
+    """读取租约"""
+    return db.query(SchedulerLease).filter(SchedulerLease.name == name).first()
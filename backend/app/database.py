@@ -1,15 +1,19 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, Float, ForeignKey, inspect, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 
+from .metrics import instrument_engine
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./starred_repos.db")
 
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+instrument_engine(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -36,12 +40,16 @@ class StarredRepo(Base):
     starred_at = Column(DateTime, index=True)
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
+    pushed_at = Column(DateTime, index=True)
     is_fork = Column(Boolean, default=False)
     is_private = Column(Boolean, default=False)
     size = Column(Integer)
     default_branch = Column(String)
     license_name = Column(String)
     license_key = Column(String)
+    readme_checked_at = Column(DateTime, index=True)  # 上次检查README的时间，用于增量处理
+    readme_failures = Column(Integer)  # 连续获取README失败的次数（被拒绝、限流、服务端错误），成功后清空
+    readme_retry_at = Column(DateTime, index=True)  # 获取失败后的下次重试时间，之前不再处理
     
     # 关联README内容
     readme_content = relationship("RepoReadme", back_populates="repo", uselist=False)
@@ -57,11 +65,42 @@ class RepoReadme(Base):
     embedding_id = Column(String)  # 向量数据库中的ID
     processed_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    neighbors_updated_at = Column(DateTime)  # 上次计算相似仓库的时间，早于updated_at时需要重新计算
     
     # 关联仓库
     repo = relationship("StarredRepo", back_populates="readme_content")
 
 
+class AppSetting(Base):
+    """应用级键值配置（如当前生效的向量集合），供多个进程共享"""
+    __tablename__ = "app_settings"
+    
+    key = Column(String, primary_key=True)
+    value = Column(Text)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class SchedulerLease(Base):
+    """定时任务调度器的领导者租约：只有持有未过期租约的实例触发定时任务"""
+    __tablename__ = "scheduler_leases"
+    
+    name = Column(String, primary_key=True)
+    holder = Column(String)  # 持有者实例标识
+    acquired_at = Column(DateTime)  # 本次成为领导者的时间
+    renewed_at = Column(DateTime)  # 上次心跳时间
+    expires_at = Column(DateTime, index=True)
+
+
+class RepoNeighbor(Base):
+    """预先计算的相似仓库（README向量的top-k近邻）"""
+    __tablename__ = "repo_neighbors"
+    
+    repo_id = Column(Integer, primary_key=True)
+    rank = Column(Integer, primary_key=True)  # 从1开始，按相似度从高到低
+    neighbor_repo_id = Column(Integer, index=True)
+    similarity = Column(Float)
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -71,4 +110,41 @@ def get_db():
 
 
 def create_tables():
-    Base.metadata.create_all(bind=engine) 
\ No newline at end of file
+    """创建缺少的表并补充新增的列；多个进程（例如 uvicorn --workers N）可以同时调用"""
+    attempts = len(Base.metadata.sorted_tables) + 1
+    for attempt in range(attempts):
+        try:
+            Base.metadata.create_all(bind=engine)
+            break
+        except OperationalError as e:
+            # 其他进程在检查之后先创建了表或索引，再执行时会跳过已存在的（每次失败说明其他进程有进展）
+            if "already exists" not in str(e) or attempt == attempts - 1:
+                raise
+    _add_missing_columns()
+
+
+def _add_missing_columns():
+    """为已存在的表补充新增的可空列（create_all不会修改已有表）
+    
+    每张表在一个事务中重新检查已有的列；其他进程同时补充了同一列时跳过
+    """
+    for table in Base.metadata.sorted_tables:
+        with engine.begin() as conn:
+            inspector = inspect(conn)
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                try:
+                    with conn.begin_nested():
+                        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                except OperationalError as e:
+                    if "duplicate column name" not in str(e):
+                        raise
+                if column.index:
+                    conn.execute(text(
+                        f"CREATE INDEX IF NOT EXISTS ix_{table.name}_{column.name} ON {table.name} ({column.name})"
+                    ))
@@ -0,0 +1,168 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """持久化向量缓存，以 (模型名, 内容哈希) 为键，向量以float16二进制存储"""
+    
+    def __init__(self, path: Optional[str] = None, max_entries: Optional[int] = None):
+        self.path = path or os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.db")
+        self.max_entries = max_entries or int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+        self.enabled = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+        
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._entry_count = 0
+        
+        self.hits = 0
+        self.misses = 0
+    
+    def _get_conn(self) -> sqlite3.Connection:
+        """获取（必要时创建）SQLite连接"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    model TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    dim INTEGER NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (model, content_hash)
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_embedding_cache_last_access ON embedding_cache (last_access)"
+            )
+            conn.commit()
+            self._entry_count = conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+            self._conn = conn
+        return self._conn
+    
+    @staticmethod
+    def _encode(embedding: List[float]) -> bytes:
+        """向量压缩为float16二进制"""
+        return np.asarray(embedding, dtype=np.float16).tobytes()
+    
+    @staticmethod
+    def _decode(blob: bytes) -> List[float]:
+        """float16二进制还原为向量"""
+        return np.frombuffer(blob, dtype=np.float16).astype(np.float32).tolist()
+    
+    def get_many(self, model: str, content_hashes: Iterable[str]) -> Dict[str, List[float]]:
+        """批量读取缓存，返回命中的 {内容哈希: 向量}"""
+        hashes = list(dict.fromkeys(content_hashes))
+        if not self.enabled or not hashes:
+            return {}
+        
+        found: Dict[str, List[float]] = {}
+        try:
+            with self._lock:
+                conn = self._get_conn()
+                # 分块查询，避免超出SQLite参数数量限制
+                for i in range(0, len(hashes), 500):
+                    chunk = hashes[i:i + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    rows = conn.execute(
+                        f"SELECT content_hash, vector FROM embedding_cache "
+                        f"WHERE model = ? AND content_hash IN ({placeholders})",
+                        [model, *chunk]
+                    ).fetchall()
+                    for content_hash, blob in rows:
+                        found[content_hash] = self._decode(blob)
+                
+                if found:
+                    now = time.time()
+                    conn.executemany(
+                        "UPDATE embedding_cache SET last_access = ? WHERE model = ? AND content_hash = ?",
+                        [(now, model, content_hash) for content_hash in found]
+                    )
+                    conn.commit()
+                
+                self.hits += len(found)
+                self.misses += len(hashes) - len(found)
+        except sqlite3.Error as e:
+            logger.warning(f"读取向量缓存失败: {e}")
+            return {}
+        
+        return found
+    
+    def put_many(self, model: str, embeddings: Dict[str, List[float]]):
+        """批量写入缓存"""
+        if not self.enabled or not embeddings:
+            return
+        
+        now = time.time()
+        rows = [
+            (model, content_hash, len(embedding), self._encode(embedding), now)
+            for content_hash, embedding in embeddings.items()
+        ]
+        try:
+            with self._lock:
+                conn = self._get_conn()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embedding_cache (model, content_hash, dim, vector, last_access) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+                conn.commit()
+                self._entry_count += len(rows)
+                
+                if self._entry_count > self.max_entries:
+                    self._evict(conn)
+        except sqlite3.Error as e:
+            logger.warning(f"写入向量缓存失败: {e}")
+    
+    def _evict(self, conn: sqlite3.Connection):
+        """淘汰最久未使用的条目，保留最大容量的90%"""
+        self._entry_count = conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+        overflow = self._entry_count - int(self.max_entries * 0.9)
+        if overflow <= 0:
+            return
+        
+        conn.execute(
+            "DELETE FROM embedding_cache WHERE rowid IN ("
+            "SELECT rowid FROM embedding_cache ORDER BY last_access ASC LIMIT ?)",
+            (overflow,)
+        )
+        conn.commit()
+        self._entry_count -= overflow
+        logger.info(f"向量缓存淘汰 {overflow} 条记录")
+    
+    def clear(self, model: Optional[str] = None):
+        """清空缓存（可只清空某个模型的缓存）"""
+        with self._lock:
+            conn = self._get_conn()
+            if model:
+                conn.execute("DELETE FROM embedding_cache WHERE model = ?", (model,))
+            else:
+                conn.execute("DELETE FROM embedding_cache")
+            conn.commit()
+            self._entry_count = conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+    
+    def get_stats(self) -> Dict:
+        """获取缓存统计信息"""
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": self._entry_count,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total > 0 else 0.0
+        }
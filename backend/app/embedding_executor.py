@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 子进程内持有的模型实例（每个工作进程加载一次）
+_worker_model = None
+
+
+def _init_worker(model_name: str, torch_threads: int):
+    """工作进程初始化：加载Sentence Transformer模型"""
+    global _worker_model
+    
+    try:
+        import torch
+        # 限制每个进程的线程数，避免多进程之间争抢CPU
+        torch.set_num_threads(max(1, torch_threads))
+    except ImportError:
+        pass
+    
+    from sentence_transformers import SentenceTransformer
+    _worker_model = SentenceTransformer(model_name)
+
+
+def _encode_batch(texts: List[str], batch_size: int) -> List[List[float]]:
+    """在工作进程中计算一批文本的向量"""
+    embeddings = _worker_model.encode(
+        texts,
+        batch_size=batch_size,
+        convert_to_tensor=False,
+        show_progress_bar=False
+    )
+    return embeddings.tolist()
+
+
+def _ping() -> bool:
+    """预热用的空任务，确保工作进程已完成模型加载"""
+    return _worker_model is not None
+
+
+class EmbeddingExecutor:
+    """Sentence Transformer推理执行器，在进程池中计算向量，不阻塞事件循环"""
+    
+    def __init__(self, model_name: str, max_workers: Optional[int] = None, batch_size: Optional[int] = None):
+        self.model_name = model_name
+        
+        cpu_count = os.cpu_count() or 1
+        self.max_workers = max_workers or int(os.getenv("EMBEDDING_WORKERS", str(min(2, cpu_count))))
+        self.batch_size = batch_size or int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+        # 每个工作进程分到的torch线程数
+        self.torch_threads = max(1, cpu_count // self.max_workers)
+        
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # 进程池可能同时被多个线程（asyncio.to_thread、同步调用）第一次使用，只创建一个
+        self._pool_lock = threading.Lock()
+    
+    def _get_pool(self) -> ProcessPoolExecutor:
+        """获取（必要时创建）进程池"""
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    logger.info(f"启动向量计算进程池: {self.max_workers} 个进程, 模型 {self.model_name}")
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        # 使用spawn避免fork后torch线程状态异常
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_init_worker,
+                        initargs=(self.model_name, self.torch_threads)
+                    )
+        return self._pool
+    
+    def _reset_pool(self, pool: ProcessPoolExecutor):
+        """进程池损坏（工作进程崩溃）后重建；其他线程已经重建过时不再关闭新的进程池"""
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+    
+    def _split(self, texts: List[str]) -> List[List[str]]:
+        """把文本切分成若干批次，分发到不同的工作进程"""
+        return [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+    
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        """异步计算一组文本的向量"""
+        if not texts:
+            return []
+        
+        loop = asyncio.get_running_loop()
+        batches = self._split(texts)
+        pool = self._get_pool()
+        
+        try:
+            results = await asyncio.gather(*[
+                loop.run_in_executor(pool, _encode_batch, batch, self.batch_size)
+                for batch in batches
+            ])
+        except BrokenProcessPool:
+            logger.error("向量计算进程池已损坏，正在重建")
+            self._reset_pool(pool)
+            raise
+        
+        return [embedding for batch_result in results for embedding in batch_result]
+    
+    def embed_sync(self, texts: List[str]) -> List[List[float]]:
+        """同步计算向量（供非异步上下文使用）"""
+        if not texts:
+            return []
+        
+        pool = self._get_pool()
+        try:
+            futures = [pool.submit(_encode_batch, batch, self.batch_size) for batch in self._split(texts)]
+            return [embedding for future in futures for embedding in future.result()]
+        except BrokenProcessPool:
+            logger.error("向量计算进程池已损坏，正在重建")
+            self._reset_pool(pool)
+            raise
+    
+    def warmup(self):
+        """预热：启动所有工作进程并加载模型"""
+        pool = self._get_pool()
+        futures = [pool.submit(_ping) for _ in range(self.max_workers)]
+        for future in futures:
+            future.result()
+    
+    def shutdown(self):
+        """关闭进程池"""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
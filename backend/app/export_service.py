@@ -0,0 +1,48 @@
+import csv
+import io
+import json
+from typing import Iterator
+from sqlalchemy.orm import Session
+
+from . import crud, schemas
+from .database import SessionLocal
+
+# 支持的导出格式
+EXPORT_FORMATS = ("ndjson", "csv")
+
+# 各导出格式的响应类型
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+
+# 导出的字段（与仓库详情接口一致）
+EXPORT_FIELDS = list(schemas.StarredRepo.model_fields.keys())
+
+
+def iter_export_chunks(db: Session, fmt: str = "ndjson", chunk_size: int = 500, **filters) -> Iterator[str]:
+    """按键集分页逐块导出满足过滤条件的仓库，每块产出一段文本（CSV第一块前先产出表头）"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {fmt}")
+    
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(EXPORT_FIELDS)
+        yield buffer.getvalue()
+    
+    for repos in crud.iter_repos(db, chunk_size=chunk_size, **filters):
+        rows = [schemas.StarredRepo.model_validate(repo).model_dump(mode="json") for repo in repos]
+        
+        if fmt == "ndjson":
+            yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+        else:
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+            writer.writerows(rows)
+            yield buffer.getvalue()
+
+
+def stream_export(fmt: str = "ndjson", chunk_size: int = 500, **filters) -> Iterator[str]:
+    """使用独立的数据库会话逐块导出，供流式响应在线程池中迭代（请求结束或客户端断开时关闭会话）"""
+    db = SessionLocal()
+    try:
+        yield from iter_export_chunks(db, fmt, chunk_size, **filters)
+    finally:
+        db.close()
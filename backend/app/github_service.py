@@ -2,14 +2,61 @@ import httpx
 import json
 import os
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
 
+from .metrics import record_github_response
+
 load_dotenv()
 
 
-class GitHubService:
+class RateLimitTracker:
+    """记录GitHub响应头中最近一次的速率限制，并统计本进程发出的API请求数（供调度器估算请求预算）"""
+    
     def __init__(self):
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset_at: Optional[datetime] = None
+        self.updated_at: Optional[datetime] = None
+        self.requests = 0
+    
+    def record(self, response: httpx.Response, counted: bool = True):
+        """从响应头更新速率限制（/rate_limit 本身不消耗配额，counted=False）"""
+        if counted:
+            self.requests += 1
+        record_github_response(response)
+        headers = response.headers
+        if "X-RateLimit-Remaining" not in headers:
+            return
+        try:
+            self.limit = int(headers.get("X-RateLimit-Limit", self.limit or 0))
+            self.remaining = int(headers["X-RateLimit-Remaining"])
+            if headers.get("X-RateLimit-Reset"):
+                self.reset_at = datetime.utcfromtimestamp(int(headers["X-RateLimit-Reset"]))
+            self.updated_at = datetime.utcnow()
+        except ValueError:
+            pass
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "remaining": self.remaining,
+            "reset_at": self.reset_at,
+            "updated_at": self.updated_at,
+            "requests": self.requests
+        }
+
+
+# 全局速率限制记录（同一进程内所有GitHub客户端共用）
+rate_limit_tracker = RateLimitTracker()
+
+
+# GitHub API地址，可指向本地的模拟服务（benchmarks/mock_github.py）或GitHub Enterprise
+DEFAULT_GITHUB_API_URL = "https://api.github.com"
+
+
+class GitHubService:
+    def __init__(self, base_url: Optional[str] = None):
         self.token = os.getenv("GITHUB_TOKEN")
         if not self.token:
             raise ValueError("GITHUB_TOKEN environment variable is required")
@@ -19,7 +66,7 @@ class GitHubService:
             "Accept": "application/vnd.github.v3.star+json",
             "User-Agent": "star-repo-search"
         }
-        self.base_url = "https://api.github.com"
+        self.base_url = (base_url or os.getenv("GITHUB_API_URL") or DEFAULT_GITHUB_API_URL).rstrip("/")
 
     async def get_user_info(self) -> Dict[str, Any]:
         """获取当前用户信息"""
@@ -28,6 +75,7 @@ class GitHubService:
                 f"{self.base_url}/user",
                 headers=self.headers
             )
+            rate_limit_tracker.record(response)
             response.raise_for_status()
             return response.json()
 
@@ -48,6 +96,7 @@ class GitHubService:
                     headers=self.headers,
                     params={"page": page, "per_page": per_page}
                 )
+                rate_limit_tracker.record(response)
                 response.raise_for_status()
                 
                 repos = response.json()
@@ -61,9 +110,11 @@ class GitHubService:
                 
                 page += 1
                 
-                # 检查是否还有更多页面
+                # 检查是否还有更多页面（有Link头时以其中的next为准，省去最后一次空页请求）
                 if len(repos) < per_page:
                     break
+                if "link" in response.headers and "next" not in response.links:
+                    break
 
         return all_repos
 
@@ -94,6 +145,7 @@ class GitHubService:
             "starred_at": datetime.fromisoformat(starred_at.replace("Z", "+00:00")),
             "created_at": datetime.fromisoformat(repo["created_at"].replace("Z", "+00:00")),
             "updated_at": datetime.fromisoformat(repo["updated_at"].replace("Z", "+00:00")),
+            "pushed_at": datetime.fromisoformat(repo["pushed_at"].replace("Z", "+00:00")) if repo.get("pushed_at") else None,
             "is_fork": repo["fork"],
             "is_private": repo["private"],
             "size": repo["size"],
@@ -109,6 +161,7 @@ class GitHubService:
                 f"{self.base_url}/rate_limit",
                 headers=self.headers
             )
+            rate_limit_tracker.record(response, counted=False)
             response.raise_for_status()
             return response.json()
 
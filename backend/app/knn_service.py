@@ -0,0 +1,309 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import or_
+
+from . import crud
+from .database import SessionLocal, RepoReadme, RepoNeighbor
+from .vector_service import vector_service
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+def _merge_topk(best_scores, best_indices, scores, indices, k):
+    """合并当前top-k和新块的得分，用argpartition保留每行最大的k个"""
+    all_scores = np.concatenate([best_scores, scores], axis=1)
+    all_indices = np.concatenate([best_indices, indices], axis=1)
+    if all_scores.shape[1] <= k:
+        return all_scores, all_indices
+    top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(all_scores, top, axis=1), np.take_along_axis(all_indices, top, axis=1)
+
+
+class KnnService:
+    """相似仓库服务：预先计算每个仓库README向量的top-k近邻，查询时一次索引读取
+    
+    近邻表由离线任务分块矩阵乘法计算；增量刷新时只重新计算README有变化的仓库、近邻中包含变化仓库的仓库，
+    并把变化仓库插入到相似度超过对方当前第k名的其他仓库的列表中。
+    """
+    
+    def __init__(self):
+        self.k = int(os.getenv("KNN_NEIGHBORS", "20"))
+        self.block_rows = int(os.getenv("KNN_BLOCK_ROWS", "1024"))
+        # 需要重新计算的仓库超过该比例时直接全量重建
+        self.full_rebuild_ratio = float(os.getenv("KNN_FULL_REBUILD_RATIO", "0.2"))
+        
+        self.status = {
+            "is_running": False,
+            "last_run": None,
+            "last_result": None
+        }
+        self._lock = threading.Lock()
+    
+    # ---- 查询 ----
+    
+    def _read_neighbors(self, repo_id: int, limit: int) -> Optional[List[Tuple[int, float]]]:
+        """读取近邻表；近邻表过期（README在计算后有更新）或limit超出预先计算的数量时返回None"""
+        if limit > self.k:
+            return None
+        
+        db = SessionLocal()
+        try:
+            readme = (
+                db.query(RepoReadme.updated_at, RepoReadme.neighbors_updated_at)
+                .filter(RepoReadme.repo_id == repo_id)
+                .first()
+            )
+            if not readme or readme.neighbors_updated_at is None:
+                return None
+            if readme.updated_at and readme.neighbors_updated_at < readme.updated_at:
+                return None
+            return crud.get_repo_neighbors(db, repo_id, limit)
+        finally:
+            db.close()
+    
+    def _search_by_stored_vector(self, repo_id: int, limit: int) -> Optional[List[Tuple[int, float]]]:
+        """用仓库已存储的向量实时检索（不重新计算向量），仓库没有向量时返回None"""
+        embeddings = vector_service.store.get_embeddings([repo_id])
+        if repo_id not in embeddings:
+            return None
+        results = vector_service.search_by_embedding(embeddings[repo_id], limit + 1)
+        return [
+            (result["repo_id"], result["similarity_score"])
+            for result in results
+            if result["repo_id"] != repo_id
+        ][:limit]
+    
+    def _hydrate(self, repo_ids: List[int]):
+        db = SessionLocal()
+        try:
+            return crud.get_repos_by_repo_ids(db, repo_ids)
+        finally:
+            db.close()
+    
+    async def get_similar(self, repo_id: int, limit: int = 10) -> Optional[Dict]:
+        """获取相似仓库：优先读取近邻表，否则用已存储的向量实时检索；仓库没有README向量时返回None"""
+        start_time = time.time()
+        
+        source = "knn"
+        neighbors = await asyncio.to_thread(self._read_neighbors, repo_id, limit)
+        if neighbors is None:
+            source = "vector"
+            neighbors = await asyncio.to_thread(self._search_by_stored_vector, repo_id, limit)
+            if neighbors is None:
+                return None
+        
+        scores = dict(neighbors)
+        repos = await asyncio.to_thread(self._hydrate, list(scores.keys()))
+        results = [{"repo": repo, "similarity_score": scores[repo.repo_id]} for repo in repos]
+        
+        return {
+            "repo_id": repo_id,
+            "results": results,
+            "total": len(results),
+            "source": source,
+            "processing_time": round(time.time() - start_time, 3)
+        }
+    
+    # ---- 近邻表计算 ----
+    
+    def _load_vectors(self, db) -> Tuple[np.ndarray, np.ndarray]:
+        """读取所有README向量，归一化后以float16保存在内存中（分块计算时再转换为float32）"""
+        repo_ids = [row[0] for row in db.query(RepoReadme.repo_id).order_by(RepoReadme.repo_id).all()]
+        
+        ids = []
+        blocks = []
+        for i in range(0, len(repo_ids), 1000):
+            chunk = repo_ids[i:i + 1000]
+            embeddings = vector_service.store.get_embeddings(chunk)
+            chunk_ids = [repo_id for repo_id in chunk if repo_id in embeddings]
+            if not chunk_ids:
+                continue
+            matrix = np.asarray([embeddings[repo_id] for repo_id in chunk_ids], dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            ids.extend(chunk_ids)
+            blocks.append((matrix / norms).astype(np.float16))
+        
+        if not ids:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=np.float16)
+        return np.asarray(ids, dtype=np.int64), np.vstack(blocks)
+    
+    def _compute(
+        self,
+        db,
+        ids: np.ndarray,
+        matrix: np.ndarray,
+        query_rows: np.ndarray,
+        computed_at: datetime,
+        insert_from: Optional[np.ndarray] = None,
+        thresholds: Optional[np.ndarray] = None
+    ) -> Dict[int, List[Tuple[int, float]]]:
+        """分块计算query_rows的top-k近邻并写入近邻表
+        
+        insert_from 为变化仓库的行掩码：这些行与其他仓库的相似度超过对方的阈值（当前第k名）时，
+        记录为对方列表的插入候选并返回 {行号: [(变化仓库行号, 相似度)]}
+        """
+        k = min(self.k, len(ids) - 1)
+        column_rows = self.block_rows * 4
+        insertions: Dict[int, List[Tuple[int, float]]] = {}
+        
+        for q_start in range(0, len(query_rows), self.block_rows):
+            q_rows = query_rows[q_start:q_start + self.block_rows]
+            queries = matrix[q_rows].astype(np.float32)
+            best_scores = np.full((len(q_rows), 0), -np.inf, dtype=np.float32)
+            best_rows = np.zeros((len(q_rows), 0), dtype=np.int64)
+            collect = insert_from[q_rows] if insert_from is not None else None
+            
+            for c_start in range(0, len(ids), column_rows):
+                c_rows = np.arange(c_start, min(c_start + column_rows, len(ids)), dtype=np.int64)
+                scores = queries @ matrix[c_start:c_start + len(c_rows)].astype(np.float32).T
+                # 排除自身
+                scores[q_rows[:, None] == c_rows[None, :]] = -np.inf
+                
+                best_scores, best_rows = _merge_topk(
+                    best_scores, best_rows, scores, np.broadcast_to(c_rows, scores.shape), k
+                )
+                
+                if collect is not None and collect.any():
+                    hit_q, hit_c = np.nonzero(collect[:, None] & (scores > thresholds[c_rows][None, :]))
+                    for qi, ci in zip(hit_q.tolist(), hit_c.tolist()):
+                        insertions.setdefault(int(c_rows[ci]), []).append((int(q_rows[qi]), float(scores[qi, ci])))
+            
+            order = np.argsort(-best_scores, axis=1)
+            neighbors = {}
+            for i, row in enumerate(q_rows.tolist()):
+                neighbors[int(ids[row])] = [
+                    (int(ids[best_rows[i, j]]), float(best_scores[i, j]))
+                    for j in order[i]
+                    if np.isfinite(best_scores[i, j])
+                ]
+            crud.save_repo_neighbors(db, neighbors, computed_at)
+        
+        return insertions
+    
+    def refresh(self, full: bool = False) -> Dict:
+        """刷新近邻表（在线程或worker进程中执行，使用独立的数据库会话）"""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("相似仓库计算任务已在运行中")
+        
+        db = SessionLocal()
+        start_time = time.time()
+        # README在本次计算开始后更新的仓库，下次刷新时仍视为有变化
+        computed_at = datetime.utcnow()
+        try:
+            self.status["is_running"] = True
+            ids, matrix = self._load_vectors(db)
+            row_of = {repo_id: row for row, repo_id in enumerate(ids.tolist())}
+            
+            if len(ids) < 2:
+                db.query(RepoNeighbor).delete(synchronize_session=False)
+                db.commit()
+                result = {"mode": "full", "total": len(ids), "recomputed": 0, "inserted": 0}
+                return self._finish(result, start_time)
+            
+            # 已不存在向量的仓库：删除它们自己的列表，包含它们的列表需要重新计算
+            existing_sources = {row[0] for row in db.query(RepoNeighbor.repo_id).distinct().all()}
+            removed = [repo_id for repo_id in existing_sources if repo_id not in row_of]
+            if removed:
+                crud.delete_repo_neighbors(db, removed)
+            
+            if not full:
+                dirty_ids = [
+                    row[0] for row in db.query(RepoReadme.repo_id).filter(or_(
+                        RepoReadme.neighbors_updated_at.is_(None),
+                        RepoReadme.neighbors_updated_at < RepoReadme.updated_at
+                    )).all()
+                    if row[0] in row_of
+                ]
+                # 近邻中包含变化或已删除仓库的列表，旧的相似度已失效，需要整体重新计算
+                affected = crud.get_repos_with_neighbors_in(db, dirty_ids + removed)
+                recompute_ids = set(dirty_ids) | {repo_id for repo_id in affected if repo_id in row_of}
+                if len(recompute_ids) > self.full_rebuild_ratio * len(ids):
+                    full = True
+            
+            if full:
+                db.query(RepoNeighbor).delete(synchronize_session=False)
+                db.commit()
+                self._compute(db, ids, matrix, np.arange(len(ids), dtype=np.int64), computed_at)
+                result = {"mode": "full", "total": len(ids), "recomputed": len(ids), "inserted": 0}
+                return self._finish(result, start_time)
+            
+            if not recompute_ids:
+                result = {"mode": "incremental", "total": len(ids), "recomputed": 0, "inserted": 0}
+                return self._finish(result, start_time)
+            
+            query_rows = np.asarray(sorted(row_of[repo_id] for repo_id in recompute_ids), dtype=np.int64)
+            insert_from = np.zeros(len(ids), dtype=bool)
+            insert_from[[row_of[repo_id] for repo_id in dirty_ids]] = True
+            
+            # 其他仓库的插入阈值：列表已满时为当前第k名的相似度，否则任何相似度都可以插入；
+            # 本次整体重新计算的仓库不接受插入
+            k = min(self.k, len(ids) - 1)
+            thresholds = np.full(len(ids), -np.inf, dtype=np.float32)
+            for repo_id, (count, min_similarity) in crud.get_neighbor_thresholds(db).items():
+                if repo_id in row_of and count >= k:
+                    thresholds[row_of[repo_id]] = min_similarity
+            thresholds[query_rows] = np.inf
+            
+            insertions = self._compute(db, ids, matrix, query_rows, computed_at, insert_from, thresholds)
+            
+            # 把变化仓库合并到其他仓库的列表中
+            target_rows = list(insertions.keys())
+            for i in range(0, len(target_rows), 500):
+                chunk = target_rows[i:i + 500]
+                current = crud.get_neighbor_lists(db, [int(ids[row]) for row in chunk])
+                updated = {}
+                for row in chunk:
+                    repo_id = int(ids[row])
+                    candidates = current.get(repo_id, []) + [
+                        (int(ids[source_row]), similarity) for source_row, similarity in insertions[row]
+                    ]
+                    updated[repo_id] = sorted(candidates, key=lambda item: item[1], reverse=True)[:k]
+                crud.save_repo_neighbors(db, updated)
+            
+            result = {
+                "mode": "incremental",
+                "total": len(ids),
+                "recomputed": len(query_rows),
+                "inserted": len(target_rows)
+            }
+            return self._finish(result, start_time)
+        
+        finally:
+            self.status["is_running"] = False
+            db.close()
+            self._lock.release()
+    
+    def _finish(self, result: Dict, start_time: float) -> Dict:
+        result["seconds"] = round(time.time() - start_time, 3)
+        self.status["last_run"] = datetime.utcnow()
+        self.status["last_result"] = result
+        logger.info(f"相似仓库近邻表刷新完成：{result}")
+        return result
+    
+    async def arefresh(self, full: bool = False) -> Dict:
+        """异步刷新近邻表，计算在线程中进行"""
+        return await asyncio.to_thread(self.refresh, full)
+    
+    def get_stats(self) -> Dict:
+        """近邻表统计信息"""
+        db = SessionLocal()
+        try:
+            repos = db.query(RepoNeighbor.repo_id).distinct().count()
+        finally:
+            db.close()
+        return {"k": self.k, "repos_with_neighbors": repos, **self.status}
+
+
+# 全局相似仓库服务实例
+knn_service = KnnService()
@@ -1,21 +1,32 @@
+import time
+
+# 启动耗时从导入应用模块开始计算
+_import_started = time.perf_counter()
+
 from fastapi import FastAPI, Depends, HTTPException, BackgroundTasks, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
 import asyncio
 import os
 import json
-import time
 from datetime import datetime
 from dotenv import load_dotenv
 
-from . import crud, schemas
+from . import crud, metrics, schemas
 from .database import get_db, create_tables
-from .github_service import GitHubService
+from .github_service import GitHubService, rate_limit_tracker
 from .websocket_manager import websocket_manager
 from .vector_service import vector_service
 from .readme_service import readme_service
+from .search_service import search_service
 from .scheduler import task_scheduler
+from .sync_service import sync_service
+from .knn_service import knn_service
+from .reindex_service import reindex_service
+from .process_stats import get_process_stats
+from .export_service import EXPORT_FORMATS, EXPORT_MEDIA_TYPES, stream_export
 
 load_dotenv()
 
@@ -35,15 +46,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 按路由记录请求耗时（GET /metrics 导出）
+app.add_middleware(metrics.MetricsMiddleware)
+
 # 创建数据库表
 create_tables()
 
-# 全局变量用于跟踪同步状态
-sync_status = {
-    "is_syncing": False,
-    "last_sync": None,
-    "total_repos": 0,
-    "message": "Ready to sync"
+# 同步状态（与同步服务共享同一个字典）
+sync_status = sync_service.status
+
+# 是否在API进程内运行定时任务（使用独立的worker进程时设为false）
+RUN_SCHEDULER_IN_API = os.getenv("RUN_SCHEDULER_IN_API", "true").lower() == "true"
+
+# 批量语义搜索每个请求的最大查询数
+BATCH_SEARCH_MAX_QUERIES = int(os.getenv("BATCH_SEARCH_MAX_QUERIES", "100"))
+
+# 启动与预热耗时
+startup_stats = {
+    "startup_seconds": None,
+    "warmup_seconds": None
 }
 
 
@@ -56,21 +77,44 @@ async def root():
 @app.get("/health")
 async def health_check():
     """健康检查"""
-    return {"status": "healthy", "timestamp": datetime.utcnow()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.utcnow(),
+        "startup": startup_stats,
+        "process": get_process_stats(),
+        "websocket": websocket_manager.get_stats()
+    }
+
+
+@app.post("/warmup")
+async def warmup():
+    """预热：加载向量存储和向量模型（或创建API客户端），避免第一次语义搜索时才加载"""
+    try:
+        await run_warmup()
+        return {"message": "Warmup completed", "startup": startup_stats, "process": get_process_stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def run_warmup():
+    """在线程中执行预热并记录耗时"""
+    start = time.perf_counter()
+    await asyncio.to_thread(vector_service.warmup)
+    startup_stats["warmup_seconds"] = round(time.perf_counter() - start, 3)
 
 
 @app.websocket("/ws/sync")
 async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket端点，用于实时同步状态推送"""
+    """WebSocket端点，用于实时同步状态推送（所有消息经该连接的发送队列写出）"""
     await websocket_manager.connect(websocket)
     try:
         # 发送当前同步状态
         initial_message = {
             "type": "sync_status",
-            "data": sync_status,
+            "data": await sync_service.get_status(),
             "timestamp": datetime.utcnow().isoformat()
         }
-        await websocket.send_text(json.dumps(initial_message, default=str))
+        await websocket_manager.send_personal_message(json.dumps(initial_message, default=str), websocket)
         
         # 保持连接活跃
         while True:
@@ -79,15 +123,18 @@ async def websocket_endpoint(websocket: WebSocket):
                 data = await asyncio.wait_for(websocket.receive_text(), timeout=30.0)
                 # 可以处理客户端发送的消息，比如心跳包
                 if data == "ping":
-                    await websocket.send_text("pong")
+                    await websocket_manager.send_personal_message("pong", websocket)
             except asyncio.TimeoutError:
                 # 发送心跳包
                 heartbeat = {
                     "type": "heartbeat",
                     "timestamp": datetime.utcnow().isoformat()
                 }
-                await websocket.send_text(json.dumps(heartbeat))
-    except WebSocketDisconnect:
+                await websocket_manager.send_personal_message(json.dumps(heartbeat), websocket)
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: 连接已被服务端关闭（例如过慢被断开）
+        pass
+    finally:
         websocket_manager.disconnect(websocket)
 
 
@@ -97,71 +144,28 @@ async def sync_starred_repos(
     username: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
-    """同步GitHub starred仓库"""
-    if sync_status["is_syncing"]:
+    """同步GitHub starred仓库（所有进程共享同一个同步锁）"""
+    if not await sync_service.try_start():
         raise HTTPException(status_code=409, detail="Sync is already in progress")
     
     background_tasks.add_task(sync_repos_background, username, db)
     
-    sync_status["is_syncing"] = True
-    sync_status["message"] = "Sync started"
-    
     return schemas.SyncStatus(**sync_status)
 
 
+@app.get("/sync/status", response_model=schemas.SyncStatus)
+async def get_sync_status():
+    """获取同步状态（可能来自其他进程）"""
+    return schemas.SyncStatus(**await sync_service.get_status())
+
+
 async def sync_repos_background(username: Optional[str], db: Session):
     """后台同步任务"""
     try:
-        sync_status["is_syncing"] = True
-        sync_status["message"] = "Fetching repositories from GitHub..."
-        
-        # 广播同步开始状态
-        await websocket_manager.broadcast_sync_status(sync_status)
-        
-        github_service = GitHubService()
-        repos_data = await github_service.get_starred_repos(username)
-        
-        sync_status["message"] = f"Saving {len(repos_data)} repositories to database..."
-        await websocket_manager.broadcast_sync_status(sync_status)
-        
-        # 转换为StarredRepoCreate对象列表
-        repo_creates = [schemas.StarredRepoCreate(**repo_data) for repo_data in repos_data]
-        
-        # 使用高性能批量插入/更新，每批500条记录
-        total_repos = len(repo_creates)
-        batch_size = 500
-        
-        for i in range(0, total_repos, batch_size):
-            batch = repo_creates[i:i + batch_size]
-            current_batch = i // batch_size + 1
-            total_batches = (total_repos + batch_size - 1) // batch_size
-            
-            # 广播进度
-            await websocket_manager.broadcast_sync_progress(
-                current=i + len(batch),
-                total=total_repos,
-                message=f"Processing batch {current_batch}/{total_batches} ({len(batch)} repositories)"
-            )
-            
-            # 处理当前批次
-            crud.bulk_upsert_starred_repos_fast(db, batch, batch_size=len(batch))
-        
-        # 获取最终结果
-        result = {"total_processed": total_repos, "created": 0, "updated": total_repos}
-        
-        sync_status["last_sync"] = datetime.utcnow()
-        sync_status["total_repos"] = result["total_processed"]
-        sync_status["message"] = f"Successfully synced {result['total_processed']} repositories"
-        
-        # 广播完成状态
-        await websocket_manager.broadcast_sync_status(sync_status)
-        
-    except Exception as e:
-        sync_status["message"] = f"Sync failed: {str(e)}"
-        await websocket_manager.broadcast_sync_status(sync_status)
-    finally:
-        sync_status["is_syncing"] = False
-        await websocket_manager.broadcast_sync_status(sync_status)
+        await sync_service.sync(username, db)
+    except Exception:
+        # 失败信息已经记录在同步状态中并广播
+        pass
 
 
 @app.get("/repos/search", response_model=schemas.SearchResponse)
@@ -213,15 +217,70 @@ async def search_repos(
     )
 
 
+@app.get("/repos/export")
+async def export_repos(
+    format: str = "ndjson",
+    query: Optional[str] = None,
+    language: Optional[str] = None,
+    owner: Optional[str] = None,
+    min_stars: Optional[int] = None,
+    max_stars: Optional[int] = None,
+    starred_after: Optional[str] = None,
+    starred_before: Optional[str] = None,
+    has_topics: Optional[bool] = None,
+    is_fork: Optional[bool] = None,
+    chunk_size: int = 500
+):
+    """流式导出满足过滤条件的全部仓库（NDJSON或CSV，按repo_id排序）
+    
+    按键集分页逐块读取并写出，内存占用与导出行数无关
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    
+    chunks = stream_export(
+        format,
+        min(max(chunk_size, 1), 5000),
+        query=query,
+        language=language,
+        owner=owner,
+        min_stars=min_stars,
+        max_stars=max_stars,
+        starred_after=starred_after,
+        starred_before=starred_before,
+        has_topics=has_topics,
+        is_fork=is_fork
+    )
+    return StreamingResponse(
+        chunks,
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="starred_repos.{format}"'}
+    )
+
+
 @app.get("/repos/{repo_id}", response_model=schemas.StarredRepo)
 async def get_repo(repo_id: int, db: Session = Depends(get_db)):
     """根据ID获取仓库详情"""
-    repo = crud.get_repo_by_repo_id(db, repo_id)
+    repo = await asyncio.to_thread(crud.get_repo_by_repo_id, db, repo_id)
     if not repo:
         raise HTTPException(status_code=404, detail="Repository not found")
     return repo
 
 
+@app.get("/repos/{repo_id}/similar", response_model=schemas.SimilarReposResponse)
+async def get_similar_repos(repo_id: int, limit: int = 10):
+    """获取相似仓库：读取预先计算的近邻表，近邻表不可用时用仓库已存储的README向量检索"""
+    limit = max(1, min(limit, 100))
+    try:
+        result = await knn_service.get_similar(repo_id, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    if result is None:
+        raise HTTPException(status_code=404, detail="README vector not found for repository")
+    return schemas.SimilarReposResponse(**result)
+
+
 @app.get("/languages", response_model=List[str])
 async def get_languages(db: Session = Depends(get_db)):
     """获取所有编程语言列表"""
@@ -301,71 +360,137 @@ async def get_readme_stats(db: Session = Depends(get_db)):
         
         return {
             **stats,
-            "vector_stats": vector_stats
+            "vector_stats": vector_stats,
+            "knn_stats": knn_service.get_stats()
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/vectors/reindex")
+async def reindex_vectors(background_tasks: BackgroundTasks, chunk_size: Optional[int] = None):
+    """在后台构建新版本的向量集合，完成后原子切换，重建期间搜索不受影响"""
+    if not await reindex_service.lock.acquire():
+        raise HTTPException(status_code=409, detail="Reindex already in progress")
+    
+    background_tasks.add_task(reindex_vectors_background, chunk_size)
+    return {"message": "Reindex started", "active_collection": vector_service.active_collection}
+
+
+async def reindex_vectors_background(chunk_size: Optional[int]):
+    """后台向量重建任务"""
+    try:
+        await reindex_service.run(chunk_size)
+    except Exception as e:
+        print(f"向量重建失败: {e}")
+
+
+@app.get("/vectors/reindex/status")
+async def get_reindex_status():
+    """获取向量重建进度"""
+    return {
+        **await reindex_service.get_status(),
+        "active_collection": vector_service.active_collection
+    }
+
+
 @app.post("/repos/semantic-search", response_model=schemas.SemanticSearchResponse)
-async def semantic_search_repos(
-    request: schemas.SemanticSearchRequest,
-    db: Session = Depends(get_db)
-):
+async def semantic_search_repos(request: schemas.SemanticSearchRequest):
     """语义搜索仓库"""
     try:
-        start_time = time.time()
-        
-        # 执行向量搜索
-        vector_results = vector_service.semantic_search(
-            query=request.query,
-            limit=request.limit
-        )
-        
-        # 过滤相似度分数
-        filtered_results = [
-            result for result in vector_results 
-            if result["similarity_score"] >= request.min_similarity
-        ]
-        
-        # 获取仓库详细信息
-        search_results = []
-        for result in filtered_results:
-            repo = crud.get_repo_by_repo_id(db, result["repo_id"])
-            if repo:
-                # 截取内容预览
-                content_preview = result["content"][:200] + "..." if len(result["content"]) > 200 else result["content"]
-                
-                search_result = schemas.SemanticSearchResult(
-                    repo_id=repo.repo_id,
-                    repo_name=repo.name,
-                    full_name=repo.full_name,
-                    description=repo.description,
-                    language=repo.language,
-                    stars=repo.stargazers_count,
-                    similarity_score=result["similarity_score"],
-                    content_preview=content_preview
-                )
-                search_results.append(search_result)
-        
-        processing_time = time.time() - start_time
-        
-        return schemas.SemanticSearchResponse(
-            results=search_results,
-            total=len(search_results),
-            query=request.query,
-            processing_time=round(processing_time, 3)
-        )
+        # 并发的相同搜索请求共享同一次计算
+        result = await search_service.semantic_search(request)
+        return schemas.SemanticSearchResponse(**result)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/repos/semantic-search/batch", response_model=schemas.BatchSemanticSearchResponse)
+async def batch_semantic_search_repos(request: schemas.BatchSemanticSearchRequest):
+    """批量语义搜索：一次请求执行多个查询，按请求顺序返回每个查询的结果"""
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="queries must not be empty")
+    if len(request.queries) > BATCH_SEARCH_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_SEARCH_MAX_QUERIES} queries per request")
+    
+    try:
+        result = await search_service.batch_semantic_search(request)
+        return schemas.BatchSemanticSearchResponse(**result)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/repos/hybrid-search", response_model=schemas.HybridSearchResponse)
+async def hybrid_search_repos(request: schemas.HybridSearchRequest):
+    """混合搜索：关键词检索与语义检索并发执行并融合排序"""
+    try:
+        result = await search_service.hybrid_search(request)
+        return schemas.HybridSearchResponse(**result)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """获取查询向量缓存、持久化向量缓存和请求合并的统计信息"""
+    return {
+        "query_embedding_cache": vector_service.query_cache.get_stats(),
+        "query_embedding_coalescing": vector_service.query_flight.get_stats(),
+        "semantic_search_coalescing": search_service.search_flight.get_stats(),
+        "embedding_cache": vector_service.embedding_cache.get_stats()
+    }
+
+
+def collect_runtime_metrics():
+    """抓取时把缓存、请求合并、WebSocket和GitHub配额的统计写入指标"""
+    caches = {
+        "query_embedding": vector_service.query_cache.get_stats(),
+        "embedding": vector_service.embedding_cache.get_stats()
+    }
+    for name, stats in caches.items():
+        metrics.cache_hits.set_total(stats["hits"], cache=name)
+        metrics.cache_misses.set_total(stats["misses"], cache=name)
+        metrics.cache_hit_ratio.set(stats["hit_ratio"], cache=name)
+        metrics.cache_entries.set(stats.get("size", stats.get("entries", 0)), cache=name)
+    
+    flights = {"query_embedding": vector_service.query_flight, "semantic_search": search_service.search_flight}
+    for name, flight in flights.items():
+        metrics.coalesced_calls.set_total(flight.coalesced, flight=name)
+    
+    # 只读本进程的统计，不查询共享状态中其他进程的连接数
+    clients = list(websocket_manager.clients.values())
+    metrics.websocket_connections.set(len(clients))
+    metrics.websocket_queued_messages.set(sum(client.queue.qsize() for client in clients))
+    metrics.websocket_max_queue_depth.set(max((client.queue.qsize() for client in clients), default=0))
+    metrics.websocket_dropped_messages.set_total(websocket_manager.dropped_messages)
+    metrics.websocket_evicted_clients.set_total(websocket_manager.evicted_clients)
+    metrics.websocket_published_events.set_total(websocket_manager.published_events)
+    metrics.websocket_coalesced_events.set_total(websocket_manager.coalesced_events)
+    
+    if rate_limit_tracker.remaining is not None:
+        metrics.github_rate_limit_remaining.set(rate_limit_tracker.remaining)
+        metrics.github_rate_limit_limit.set(rate_limit_tracker.limit)
+    if rate_limit_tracker.reset_at is not None:
+        metrics.github_rate_limit_reset.set((rate_limit_tracker.reset_at - datetime(1970, 1, 1)).total_seconds())
+
+
+metrics.registry.add_collector(collect_runtime_metrics)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus 文本格式的指标（本进程）"""
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/scheduler/status", response_model=schemas.SchedulerStatus)
 async def get_scheduler_status():
     """获取调度器状态"""
     try:
-        status = task_scheduler.get_status()
+        status = await task_scheduler.get_status()
         return schemas.SchedulerStatus(**status)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -395,11 +520,29 @@ async def stop_scheduler():
 @app.on_event("startup")
 async def startup_event():
     """应用启动时的初始化"""
-    try:
-        await task_scheduler.start()
-        print("定时任务调度器已启动")
-    except Exception as e:
-        print(f"启动调度器失败: {e}")
+    if RUN_SCHEDULER_IN_API:
+        try:
+            await task_scheduler.start()
+            print("定时任务调度器已启动")
+        except Exception as e:
+            print(f"启动调度器失败: {e}")
+    else:
+        print("定时任务由独立的worker进程运行（python -m app.worker run）")
+    
+    # 转发其他进程（其他uvicorn worker、独立的worker）发布的WebSocket事件
+    await websocket_manager.start_relay()
+    
+    startup_stats["startup_seconds"] = round(time.perf_counter() - _import_started, 3)
+    process = get_process_stats()
+    print(f"应用启动耗时 {startup_stats['startup_seconds']}s, RSS {process['rss_mb']}MB")
+    
+    # 需要时在启动阶段预热重型依赖（默认在第一次使用时加载）
+    if os.getenv("WARMUP_ON_STARTUP", "false").lower() == "true":
+        try:
+            await run_warmup()
+            print(f"预热完成，耗时 {startup_stats['warmup_seconds']}s, RSS {get_process_stats()['rss_mb']}MB")
+        except Exception as e:
+            print(f"预热失败: {e}")
 
 
 @app.on_event("shutdown")
@@ -410,6 +553,13 @@ async def shutdown_event():
         print("定时任务调度器已停止")
     except Exception as e:
         print(f"停止调度器失败: {e}")
+    
+    await websocket_manager.close_all()
+    
+    try:
+        vector_service.shutdown()
+    except Exception as e:
+        print(f"关闭向量计算进程池失败: {e}")
 
 
 if __name__ == "__main__":
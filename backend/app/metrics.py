@@ -0,0 +1,354 @@
+"""进程内指标：计数器、仪表和直方图，以 Prometheus 文本格式从 GET /metrics 导出
+
+不依赖 prometheus_client。热点路径（HTTP路由、SQL语句、GitHub请求、向量计算和向量检索）在发生时记录，
+缓存命中率、WebSocket连接和队列、GitHub配额等已有统计在抓取时由收集函数读取。
+
+指标按进程统计：多个uvicorn worker时每次抓取只反映处理该请求的worker，独立的worker进程不导出指标。
+METRICS_ENABLED=false 时不记录也不导出。
+"""
+import os
+import math
+import time
+import bisect
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 延迟直方图的默认分桶（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 批量大小直方图的分桶
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    """指标基类：按标签值分组保存样本"""
+    
+    type = "untyped"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+    
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        """(样本名, 标签, 值)"""
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, _format_labels(self.labelnames, key), value
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """只增不减的计数"""
+    
+    type = "counter"
+    
+    def inc(self, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def set_total(self, value: float, **labels):
+        """用已有的累计统计（如缓存命中次数）同步计数值，供收集函数使用"""
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(Metric):
+    """可增可减的当前值"""
+    
+    type = "gauge"
+    
+    def set(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+    
+    def inc(self, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """按分桶统计观测值的分布，同时记录总和与次数"""
+    
+    type = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各分桶计数（最后一个为+Inf）, 总和, 次数]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+    
+    def time(self, **labels) -> "_Timer":
+        """计时上下文管理器，退出时记录耗时（秒）"""
+        return _Timer(self, labels)
+    
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        names = self.labelnames + ("le",)
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", _format_labels(names, key + (_format_value(float(bound)),)), cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, object]):
+        self.histogram = histogram
+        self.labels = labels
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    """指标注册表：导出时先运行收集函数（把已有的统计写入仪表），再按注册顺序输出所有指标"""
+    
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+    
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标 {metric.name} 已注册")
+            self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+    
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def add_collector(self, collector: Callable[[], None]):
+        """注册抓取时运行的收集函数"""
+        self._collectors.append(collector)
+    
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning(f"指标收集失败 {getattr(collector, '__name__', collector)}: {e}")
+        
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# 全局指标注册表
+registry = Registry()
+
+# HTTP
+http_requests_in_progress = registry.gauge("http_requests_in_progress", "Requests currently being handled", ["method"])
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template, including streamed bodies", ["method", "route", "status"]
+)
+
+# SQL
+db_query_duration = registry.histogram("db_query_duration_seconds", "SQL statement execution time", ["operation"])
+db_query_errors = registry.counter("db_query_errors_total", "SQL statements that raised an error", ["operation"])
+
+# GitHub
+github_requests = registry.counter("github_requests_total", "GitHub API responses by endpoint and status code", ["endpoint", "status"])
+github_request_duration = registry.histogram("github_request_duration_seconds", "GitHub API response time", ["endpoint"])
+github_rate_limit_remaining = registry.gauge("github_rate_limit_remaining", "Remaining GitHub API quota from the latest response")
+github_rate_limit_limit = registry.gauge("github_rate_limit_limit", "GitHub API quota per window from the latest response")
+github_rate_limit_reset = registry.gauge("github_rate_limit_reset_timestamp_seconds", "When the GitHub API quota resets (unix time)")
+
+# 向量计算与检索
+embedding_batch_size = registry.histogram("embedding_batch_size", "Texts per embedding computation (after cache lookup)", ["method"], BATCH_SIZE_BUCKETS)
+embedding_duration = registry.histogram("embedding_duration_seconds", "Embedding computation time per batch", ["method"])
+embedding_texts = registry.counter("embedding_texts_total", "Texts embedded by the model or API", ["method"])
+vector_query_duration = registry.histogram("vector_query_duration_seconds", "Vector store query time", ["backend", "filtered"])
+vector_query_batch_size = registry.histogram("vector_query_batch_size", "Query vectors per vector store query", ["backend"], BATCH_SIZE_BUCKETS)
+
+# 缓存
+cache_hits = registry.counter("cache_hits_total", "Cache hits since process start", ["cache"])
+cache_misses = registry.counter("cache_misses_total", "Cache misses since process start", ["cache"])
+cache_hit_ratio = registry.gauge("cache_hit_ratio", "Cache hits / lookups since process start", ["cache"])
+cache_entries = registry.gauge("cache_entries", "Entries currently cached", ["cache"])
+coalesced_calls = registry.counter("coalesced_calls_total", "Calls that joined an in-flight computation since process start", ["flight"])
+
+# WebSocket
+websocket_connections = registry.gauge("websocket_connections", "WebSocket clients connected to this process")
+websocket_queued_messages = registry.gauge("websocket_queued_messages", "Messages waiting in client send queues")
+websocket_max_queue_depth = registry.gauge("websocket_max_queue_depth", "Deepest client send queue")
+websocket_dropped_messages = registry.counter("websocket_dropped_messages_total", "Messages dropped for slow clients since process start")
+websocket_evicted_clients = registry.counter("websocket_evicted_clients_total", "Slow clients disconnected since process start")
+websocket_published_events = registry.counter("websocket_published_events_total", "Events published since process start")
+websocket_coalesced_events = registry.counter("websocket_coalesced_events_total", "Events merged into a pending update since process start")
+
+
+def github_endpoint(path: str) -> str:
+    """GitHub API路径归类为低基数的端点名"""
+    parts = path.strip("/").split("/")
+    if parts[0] == "repos" and len(parts) >= 4:
+        return parts[3]
+    if parts[0] == "users" and len(parts) >= 3:
+        return parts[2]
+    return parts[0] or "root"
+
+
+def record_github_response(response, endpoint: Optional[str] = None):
+    """记录一次GitHub API响应的状态码和耗时"""
+    if not METRICS_ENABLED:
+        return
+    endpoint = endpoint or github_endpoint(response.request.url.path)
+    github_requests.inc(endpoint=endpoint, status=response.status_code)
+    try:
+        github_request_duration.observe(response.elapsed.total_seconds(), endpoint=endpoint)
+    except RuntimeError:
+        # 流式响应未读取完时没有 elapsed
+        pass
+
+
+def sql_operation(statement: str) -> str:
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return keyword if keyword in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "PRAGMA") else "OTHER"
+
+
+def instrument_engine(engine):
+    """通过SQLAlchemy引擎事件记录每条SQL语句的执行时间"""
+    if not METRICS_ENABLED:
+        return
+    from sqlalchemy import event
+    
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+    
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("metrics_query_start")
+        if starts:
+            db_query_duration.observe(time.perf_counter() - starts.pop(), operation=sql_operation(statement))
+    
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        starts = exception_context.connection.info.get("metrics_query_start") if exception_context.connection else None
+        if starts:
+            starts.pop()
+        db_query_errors.inc(operation=sql_operation(exception_context.statement or ""))
+
+
+class MetricsMiddleware:
+    """ASGI中间件：按路由模板记录HTTP请求耗时（到响应体发送完为止）和进行中的请求数"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        
+        method = scope["method"]
+        status = {"code": 500}
+        
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+        
+        start = time.perf_counter()
+        http_requests_in_progress.inc(method=method)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_progress.dec(method=method)
+            # 路由匹配后 scope 中有 route，用模板（如 /repos/{repo_id}）而不是实际路径，避免标签基数过高
+            route = scope.get("route")
+            http_request_duration.observe(
+                time.perf_counter() - start,
+                method=method,
+                route=getattr(route, "path", "unmatched"),
+                status=status["code"]
+            )
@@ -0,0 +1,44 @@
+import os
+import sys
+from typing import Dict, List
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 按需加载的重型依赖，用于确认API进程没有提前加载它们
+HEAVY_MODULES = ("chromadb", "openai", "sentence_transformers", "torch")
+
+
+def get_rss_bytes() -> int:
+    """当前进程的常驻内存（RSS）字节数"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return get_peak_rss_bytes()
+
+
+def get_peak_rss_bytes() -> int:
+    """进程启动以来的RSS峰值字节数"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux上单位为KB，macOS上为字节
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_loaded_heavy_modules() -> List[str]:
+    """已经被导入的重型依赖"""
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+
+def get_process_stats() -> Dict:
+    """进程资源统计信息"""
+    return {
+        "pid": os.getpid(),
+        "rss_mb": round(get_rss_bytes() / 1024 / 1024, 1),
+        "peak_rss_mb": round(get_peak_rss_bytes() / 1024 / 1024, 1),
+        "loaded_heavy_modules": get_loaded_heavy_modules()
+    }
@@ -0,0 +1,95 @@
+import os
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(text: str) -> str:
+    """规范化查询文本作为缓存键：去掉首尾空白、合并连续空白（保留大小写，区分大小写的模型对不同大小写给出不同向量）"""
+    return " ".join(text.split())
+
+
+class QueryEmbeddingCache:
+    """查询向量的内存LRU缓存，以 (模型名, 规范化查询文本) 为键"""
+    
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size or int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+        self._cache: "OrderedDict[Hashable, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: Hashable) -> Optional[List[float]]:
+        """读取缓存，命中时移到最近使用的位置"""
+        with self._lock:
+            embedding = self._cache.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return embedding
+    
+    def put(self, key: Hashable, embedding: List[float]):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        with self._lock:
+            self._cache[key] = embedding
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+    
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._cache.clear()
+    
+    def get_stats(self) -> Dict:
+        """获取缓存统计信息"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total > 0 else 0.0
+        }
+
+
+class SingleFlight:
+    """请求合并：相同键的并发调用共享同一个进行中的计算"""
+    
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+    
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """执行（或加入进行中的）计算并返回结果"""
+        self.calls += 1
+        task = self._inflight.get(key)
+        
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        
+        # shield: 某个调用方被取消时不影响共享计算和其他调用方
+        return await asyncio.shield(task)
+    
+    def get_stats(self) -> Dict:
+        """获取请求合并统计信息"""
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._inflight)
+        }
@@ -1,26 +1,79 @@
 import asyncio
 import logging
+import os
 import re
-from typing import Optional, Dict, List
-from sqlalchemy.orm import Session
+from typing import Optional, Dict, List, Tuple
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy.orm import Session, Query
 import httpx
-from datetime import datetime
+from datetime import datetime, timedelta
 
+from . import crud
 from .database import get_db, RepoReadme, StarredRepo
 from .vector_service import vector_service, get_content_hash
-from .github_service import GitHubService
+from .github_service import GitHubService, rate_limit_tracker
 
 logger = logging.getLogger(__name__)
 
+# 处理README需要的仓库字段，批量处理时只读取这些列
+README_SOURCE_COLUMNS = (
+    StarredRepo.repo_id,
+    StarredRepo.name,
+    StarredRepo.full_name,
+    StarredRepo.owner_login,
+    StarredRepo.language,
+    StarredRepo.stargazers_count,
+    StarredRepo.description,
+    StarredRepo.readme_failures,
+)
+
+# 排序键中代替空时间的值，空时间排在所有时间之前（与SQLite中NULL的排序位置相同）
+MIN_DATETIME = datetime(1970, 1, 1)
+
+
+def keyset_after(sort_keys: List[Tuple], values) -> object:
+    """键集分页条件：按 sort_keys（[(表达式, 是否降序)]）排在 values 之后的行"""
+    conditions = []
+    for i, (expr, descending) in enumerate(sort_keys):
+        equal = [key == value for (key, _), value in zip(sort_keys[:i], values)]
+        conditions.append(and_(*equal, expr < values[i] if descending else expr > values[i]))
+    return or_(*conditions)
+
 
 class ReadmeService:
     """README处理服务"""
     
     def __init__(self):
-        self.github_service = GitHubService()
+        self._github_service: Optional[GitHubService] = None
+        # 每组并发请求之间、每块之间的延迟秒数，避免触发GitHub的限流（对本地模拟服务压测时可设为0）
+        self.request_delay = float(os.getenv("README_FETCH_DELAY_SECONDS", "1"))
+        # 获取失败（被拒绝、限流、服务端错误）的仓库按指数退避重试：第n次失败后等待 基础间隔×2^(n-1)，不超过上限
+        self.retry_base = timedelta(minutes=float(os.getenv("README_RETRY_BASE_MINUTES", "60")))
+        self.retry_max = timedelta(hours=float(os.getenv("README_RETRY_MAX_HOURS", "168")))
+    
+    @property
+    def github_service(self) -> GitHubService:
+        """GitHub客户端，第一次使用时创建（未配置GITHUB_TOKEN时才会报错）"""
+        if self._github_service is None:
+            self._github_service = GitHubService()
+        return self._github_service
     
     async def get_readme_content(self, owner: str, repo: str, branch: str = "main") -> Optional[str]:
         """从GitHub获取README内容"""
+        content, _ = await self._fetch_readme(owner, repo)
+        return content
+    
+    async def _fetch_readme(
+        self, owner: str, repo: str, client: Optional[httpx.AsyncClient] = None
+    ) -> Tuple[Optional[str], bool]:
+        """从GitHub获取README内容，同时返回结果是否确定（被拒绝或请求失败时不确定，需要下次重试）
+        
+        批量处理时传入共享的client，复用连接，也避免每次创建client时重复加载证书
+        """
+        if client is None:
+            async with httpx.AsyncClient() as client:
+                return await self._fetch_readme(owner, repo, client)
+        
         try:
             # 尝试常见的README文件名
             readme_files = [
@@ -29,47 +82,52 @@ class ReadmeService:
                 "README.txt", "readme.txt", "Readme.txt",
                 "README", "readme", "Readme"
             ]
+            conclusive = True
             
             for readme_file in readme_files:
                 try:
-                    url = f"https://api.github.com/repos/{owner}/{repo}/contents/{readme_file}"
+                    url = f"{self.github_service.base_url}/repos/{owner}/{repo}/contents/{readme_file}"
                     headers = self.github_service._get_headers()
                     
-                    async with httpx.AsyncClient() as client:
-                        response = await client.get(url, headers=headers)
-                        
-                        logger.debug(f"请求 {url} 返回状态码: {response.status_code}")
-                        
-                        if response.status_code == 200:
-                            data = response.json()
-                            if data.get("type") == "file" and data.get("content"):
-                                # 解码base64内容
-                                import base64
-                                content = base64.b64decode(data["content"]).decode('utf-8', errors='ignore')
-                                logger.info(f"成功获取 {owner}/{repo} 的 {readme_file}")
-                                return self._clean_readme_content(content)
-                        elif response.status_code == 404:
-                            logger.debug(f"{owner}/{repo} 中不存在 {readme_file}")
-                        elif response.status_code == 403:
-                            logger.warning(f"访问 {owner}/{repo} 的 {readme_file} 被拒绝 (403)")
-                            # 如果是403错误，可能是私有仓库或API限制
-                            break
-                        elif response.status_code == 401:
-                            logger.error(f"GitHub API认证失败 (401)")
-                            break
-                        else:
-                            logger.warning(f"获取 {readme_file} 失败，状态码: {response.status_code}")
-                                
+                    response = await client.get(url, headers=headers)
+                    rate_limit_tracker.record(response)
+                    
+                    logger.debug(f"请求 {url} 返回状态码: {response.status_code}")
+                    
+                    if response.status_code == 200:
+                        data = response.json()
+                        if data.get("type") == "file" and data.get("content"):
+                            # 解码base64内容
+                            import base64
+                            content = base64.b64decode(data["content"]).decode('utf-8', errors='ignore')
+                            logger.info(f"成功获取 {owner}/{repo} 的 {readme_file}")
+                            return self._clean_readme_content(content), True
+                    elif response.status_code == 404:
+                        logger.debug(f"{owner}/{repo} 中不存在 {readme_file}")
+                    elif response.status_code == 403:
+                        logger.warning(f"访问 {owner}/{repo} 的 {readme_file} 被拒绝 (403)")
+                        # 如果是403错误，可能是私有仓库或API限制
+                        conclusive = False
+                        break
+                    elif response.status_code == 401:
+                        logger.error(f"GitHub API认证失败 (401)")
+                        conclusive = False
+                        break
+                    else:
+                        logger.warning(f"获取 {readme_file} 失败，状态码: {response.status_code}")
+                        conclusive = False
+                
                 except Exception as e:
                     logger.debug(f"尝试获取 {readme_file} 失败: {e}")
+                    conclusive = False
                     continue
             
             logger.warning(f"未找到 {owner}/{repo} 的README文件")
-            return None
+            return None, conclusive
             
         except Exception as e:
             logger.error(f"获取README内容失败 {owner}/{repo}: {e}")
-            return None
+            return None, False
     
     def _clean_readme_content(self, content: str) -> str:
         """清理README内容"""
@@ -91,131 +149,259 @@ class ReadmeService:
     
     async def process_repo_readme(self, db: Session, repo: StarredRepo) -> bool:
         """处理单个仓库的README"""
-        try:
-            # 获取README内容
-            readme_content = await self.get_readme_content(
-                repo.owner_login, 
-                repo.name, 
-                repo.default_branch or "main"
-            )
-            
-            if not readme_content:
-                logger.info(f"仓库 {repo.full_name} 没有README文件")
-                return False
-            
-            # 计算内容哈希
-            content_hash = get_content_hash(readme_content)
-            
-            # 检查是否已存在
-            existing_readme = db.query(RepoReadme).filter(
-                RepoReadme.repo_id == repo.repo_id
-            ).first()
-            
-            if existing_readme:
-                # 检查内容是否有变化
-                if existing_readme.content_hash == content_hash:
-                    logger.info(f"仓库 {repo.full_name} 的README内容未变化，跳过处理")
-                    return True
-                
-                # 更新现有记录
-                logger.info(f"更新仓库 {repo.full_name} 的README内容")
-                
-                # 更新向量数据库
-                embedding_id = vector_service.update_readme(
-                    repo.repo_id, 
-                    readme_content,
-                    metadata={
-                        "repo_name": repo.name,
-                        "full_name": repo.full_name,
-                        "language": repo.language,
-                        "stars": repo.stargazers_count,
-                        "description": repo.description or ""
-                    }
+        results = await self._process_repo_chunk(db, [repo], concurrency=1)
+        return results.get(repo.repo_id) is True
+    
+    @staticmethod
+    def _checked_at():
+        # 兼容旧数据：没有检查时间时使用README记录的处理时间
+        return func.coalesce(StarredRepo.readme_checked_at, RepoReadme.processed_at)
+    
+    @staticmethod
+    def _retry_due(now: datetime):
+        """没有获取失败过，或已到重试时间的仓库"""
+        return or_(StarredRepo.readme_retry_at.is_(None), StarredRepo.readme_retry_at <= now)
+    
+    def next_retry_at(self, failures: int, now: Optional[datetime] = None) -> datetime:
+        """第failures次连续获取失败后的下次重试时间"""
+        delay = min(self.retry_base * 2 ** min(failures - 1, 20), self.retry_max)
+        return (now or datetime.utcnow()) + delay
+    
+    def get_pending_sort_keys(self) -> List[Tuple]:
+        """变更队列的排序键：新star的、从未处理过的仓库优先（获取失败过、等待重试的仓库除外），
+        其次是最近有提交的仓库，最后按repo_id区分
+        """
+        changed_at = func.coalesce(StarredRepo.pushed_at, StarredRepo.updated_at, MIN_DATETIME)
+        new_repo = and_(self._checked_at().is_(None), StarredRepo.readme_failures.is_(None))
+        return [
+            (case((new_repo, 0), else_=1), False),
+            (func.coalesce(StarredRepo.starred_at, MIN_DATETIME), True),
+            (changed_at, True),
+            (StarredRepo.repo_id, False),
+        ]
+    
+    def get_stale_sort_keys(self) -> List[Tuple]:
+        """全量刷新的排序键：上次检查时间从旧到新（从未检查过的最先），最后按repo_id区分"""
+        return [
+            (func.coalesce(self._checked_at(), MIN_DATETIME), False),
+            (StarredRepo.repo_id, False),
+        ]
+    
+    def get_pending_repos_query(self, db: Session, *columns) -> Query:
+        """README变更队列：从未处理过的仓库，以及上次检查后有新提交的仓库，按优先级排序（获取失败的仓库到重试时间后才回到队列）"""
+        checked_at = self._checked_at()
+        changed_at = func.coalesce(StarredRepo.pushed_at, StarredRepo.updated_at)
+        
+        return (
+            db.query(*(columns or (StarredRepo,)))
+            .outerjoin(RepoReadme, RepoReadme.repo_id == StarredRepo.repo_id)
+            .filter(or_(checked_at.is_(None), changed_at > checked_at), self._retry_due(datetime.utcnow()))
+            .order_by(*(expr.desc() if descending else expr for expr, descending in self.get_pending_sort_keys()))
+        )
+    
+    def get_stale_repos_query(self, db: Session, *columns) -> Query:
+        """按上次检查时间从旧到新排列的所有仓库（从未检查过的最先，未到重试时间的除外），用于把全量刷新分摊到多次运行"""
+        return (
+            db.query(*(columns or (StarredRepo,)))
+            .outerjoin(RepoReadme, RepoReadme.repo_id == StarredRepo.repo_id)
+            .filter(self._retry_due(datetime.utcnow()))
+            .order_by(*(expr.desc() if descending else expr for expr, descending in self.get_stale_sort_keys()))
+        )
+    
+    def _iter_repo_chunks(
+        self,
+        db: Session,
+        chunk_size: int,
+        max_repos: Optional[int],
+        only_changed: bool,
+        stale_first: bool = False
+    ):
+        """分块读取需要处理的仓库（只读取处理README需要的列），按各自的排序键做键集分页，不使用OFFSET
+        
+        处理失败的仓库留在原位置，成功的仓库离开变更队列（或因检查时间更新排到最后），
+        都不会影响键集的位置，不需要记录本轮已处理的仓库
+        """
+        remaining = max_repos
+        started_at = datetime.utcnow()
+        if only_changed:
+            sort_keys = self.get_pending_sort_keys()
+            base_query = self.get_pending_repos_query(db, *README_SOURCE_COLUMNS)
+        elif stale_first:
+            sort_keys = self.get_stale_sort_keys()
+            # 本轮已经检查过的仓库排到最后，不再重复读到
+            base_query = self.get_stale_repos_query(db, *README_SOURCE_COLUMNS).filter(sort_keys[0][0] < started_at)
+        else:
+            sort_keys = [(StarredRepo.repo_id, False)]
+            base_query = db.query(*README_SOURCE_COLUMNS).order_by(StarredRepo.repo_id)
+        # 同时读取排序键的值，作为下一块的起点
+        base_query = base_query.add_columns(*(expr.label(f"sort_key_{i}") for i, (expr, _) in enumerate(sort_keys)))
+        last_values = None
+        
+        while remaining is None or remaining > 0:
+            limit = chunk_size if remaining is None else min(chunk_size, remaining)
+            
+            query = base_query
+            if last_values is not None:
+                query = query.filter(keyset_after(sort_keys, last_values))
+            
+            rows = query.limit(limit).all()
+            if not rows:
+                break
+            
+            yield rows
+            
+            last_values = [getattr(rows[-1], f"sort_key_{i}") for i in range(len(sort_keys))]
+            if remaining is not None:
+                remaining -= len(rows)
+    
+    @staticmethod
+    def vector_item(repo, content: str, embedding: List[float]) -> Dict:
+        """构造写入向量数据库的条目"""
+        return {
+            "repo_id": repo.repo_id,
+            "content": content,
+            "embedding": embedding,
+            "metadata": {
+                "repo_name": repo.name,
+                "full_name": repo.full_name,
+                "language": repo.language,
+                "stars": repo.stargazers_count,
+                "description": repo.description or ""
+            }
+        }
+    
+    async def _process_repo_chunk(self, db: Session, repos: List, concurrency: int) -> Dict[int, Optional[bool]]:
+        """处理一块仓库的README：并发获取内容，批量计算向量，一次事务写入数据库
+        
+        返回 {repo_id: 结果}，True 表示有README，False 表示确认没有README，None 表示需要重试
+        """
+        results: Dict[int, Optional[bool]] = {}
+        fetched: Dict[int, str] = {}
+        checked_repo_ids = []
+        # 获取失败的仓库记录失败次数和下次重试时间，避免每次运行都排在队首反复请求
+        retry_at: Dict[int, datetime] = {}
+        
+        # 分组并发获取README内容（整块共享一个client），组间延迟避免API限制
+        async with httpx.AsyncClient() as client:
+            for i in range(0, len(repos), concurrency):
+                group = repos[i:i + concurrency]
+                responses = await asyncio.gather(
+                    *[self._fetch_readme(repo.owner_login, repo.name, client) for repo in group],
+                    return_exceptions=True
                 )
+                for repo, response in zip(group, responses):
+                    if isinstance(response, Exception):
+                        logger.error(f"处理仓库 {repo.full_name} 的README失败: {response}")
+                        results[repo.repo_id] = None
+                        retry_at[repo.repo_id] = self.next_retry_at((repo.readme_failures or 0) + 1)
+                        continue
+                    
+                    content, conclusive = response
+                    if content:
+                        fetched[repo.repo_id] = content
+                    elif conclusive:
+                        # 确认没有README，记录检查时间，仓库有新提交前不再重复检查
+                        logger.info(f"仓库 {repo.full_name} 没有README文件")
+                        results[repo.repo_id] = False
+                        checked_repo_ids.append(repo.repo_id)
+                    else:
+                        results[repo.repo_id] = None
+                        retry_at[repo.repo_id] = self.next_retry_at((repo.readme_failures or 0) + 1)
                 
-                # 更新数据库记录
-                existing_readme.content = readme_content
-                existing_readme.content_hash = content_hash
-                existing_readme.embedding_id = embedding_id
-                existing_readme.updated_at = datetime.utcnow()
+                if i + concurrency < len(repos):
+                    await asyncio.sleep(self.request_delay)
+        
+        try:
+            # 一次查询取出已有README的哈希，找出内容有变化的仓库
+            content_hashes = {repo_id: get_content_hash(content) for repo_id, content in fetched.items()}
+            existing_hashes = crud.get_readme_hashes(db, list(fetched.keys()))
+            
+            changed = [
+                repo for repo in repos
+                if repo.repo_id in fetched and existing_hashes.get(repo.repo_id) != content_hashes[repo.repo_id]
+            ]
+            
+            readme_rows = []
+            if changed:
+                logger.info(f"更新 {len(changed)} 个仓库的README内容")
                 
-            else:
-                # 创建新记录
-                logger.info(f"处理仓库 {repo.full_name} 的README内容")
+                # 一次批量计算所有变化内容的向量（已缓存的内容不重复推理）
+                embeddings = await vector_service.aget_embeddings([fetched[repo.repo_id] for repo in changed])
                 
-                # 添加到向量数据库
-                embedding_id = vector_service.add_readme(
-                    repo.repo_id, 
-                    readme_content,
-                    metadata={
-                        "repo_name": repo.name,
-                        "full_name": repo.full_name,
-                        "language": repo.language,
-                        "stars": repo.stargazers_count,
-                        "description": repo.description or ""
-                    }
-                )
+                # 一次写入向量数据库
+                embedding_ids = await asyncio.to_thread(vector_service.upsert_readmes, [
+                    self.vector_item(repo, fetched[repo.repo_id], embedding)
+                    for repo, embedding in zip(changed, embeddings)
+                ])
                 
-                # 创建数据库记录
-                readme_record = RepoReadme(
-                    repo_id=repo.repo_id,
-                    content=readme_content,
-                    content_hash=content_hash,
-                    embedding_id=embedding_id
-                )
-                db.add(readme_record)
+                readme_rows = [
+                    {
+                        "repo_id": repo.repo_id,
+                        "content": fetched[repo.repo_id],
+                        "content_hash": content_hashes[repo.repo_id],
+                        "embedding_id": embedding_id
+                    }
+                    for repo, embedding_id in zip(changed, embedding_ids)
+                ]
             
-            db.commit()
-            return True
+            # README行批量upsert，并记录检查时间，整块只提交一次
+            checked_repo_ids.extend(fetched.keys())
+            crud.save_readme_batch(db, readme_rows, checked_repo_ids, retry_at)
             
+            for repo_id in fetched:
+                results[repo_id] = True
+                
         except Exception as e:
-            logger.error(f"处理仓库 {repo.full_name} 的README失败: {e}")
+            logger.error(f"写入README批次失败: {e}")
             db.rollback()
-            return False
+            for repo_id in fetched:
+                results[repo_id] = None
+        
+        return results
     
-    async def batch_process_readmes(self, db: Session, batch_size: int = 10, max_repos: Optional[int] = None):
-        """批量处理README"""
+    async def batch_process_readmes(
+        self,
+        db: Session,
+        batch_size: int = 10,
+        max_repos: Optional[int] = None,
+        only_changed: bool = False,
+        chunk_size: int = 100,
+        stale_first: bool = False
+    ):
+        """批量处理README（only_changed=True时只处理变更队列中的仓库，stale_first=True时从最久未检查的仓库开始）
+        
+        按chunk_size分块从数据库流式读取仓库，每块内以batch_size并发请求GitHub，
+        每块一次批量计算向量、一次提交，内存占用与仓库总数无关
+        """
         try:
-            # 获取需要处理的仓库
-            query = db.query(StarredRepo)
+            # 统计需要处理的仓库数
+            if only_changed:
+                total_repos = self.get_pending_repos_query(db).order_by(None).count()
+            else:
+                total_repos = db.query(StarredRepo).count()
             if max_repos:
-                query = query.limit(max_repos)
-            
-            repos = query.all()
-            total_repos = len(repos)
+                total_repos = min(total_repos, max_repos)
             
             logger.info(f"开始批量处理 {total_repos} 个仓库的README")
             
             processed = 0
             success_count = 0
-            
-            # 分批处理
-            for i in range(0, total_repos, batch_size):
-                batch = repos[i:i + batch_size]
-                
-                # 并发处理当前批次
-                tasks = []
-                for repo in batch:
-                    task = self.process_repo_readme(db, repo)
-                    tasks.append(task)
-                
-                # 等待当前批次完成
-                results = await asyncio.gather(*tasks, return_exceptions=True)
+            for chunk in self._iter_repo_chunks(db, chunk_size, max_repos, only_changed, stale_first):
+                results = await self._process_repo_chunk(db, chunk, concurrency=batch_size)
                 
                 # 统计结果
-                for result in results:
+                for repo_id, result in results.items():
                     processed += 1
-                    if isinstance(result, bool) and result:
+                    if result:
                         success_count += 1
                 
                 logger.info(f"已处理 {processed}/{total_repos} 个仓库，成功 {success_count} 个")
                 
                 # 避免API限制，添加延迟
-                if i + batch_size < total_repos:
-                    await asyncio.sleep(1)
+                await asyncio.sleep(self.request_delay)
             
-            logger.info(f"批量处理完成：总计 {total_repos} 个，成功 {success_count} 个")
-            return {"total": total_repos, "success": success_count, "failed": total_repos - success_count}
+            logger.info(f"批量处理完成：总计 {processed} 个，成功 {success_count} 个")
+            return {"total": processed, "success": success_count, "failed": processed - success_count}
             
         except Exception as e:
             logger.error(f"批量处理README失败: {e}")
@@ -226,11 +412,15 @@ class ReadmeService:
         try:
             total_repos = db.query(StarredRepo).count()
             processed_repos = db.query(RepoReadme).count()
+            pending_repos = self.get_pending_repos_query(db).order_by(None).count()
+            retrying_repos = db.query(StarredRepo).filter(StarredRepo.readme_retry_at > datetime.utcnow()).count()
             vector_stats = vector_service.get_collection_stats()
             
             return {
                 "total_repos": total_repos,
                 "processed_repos": processed_repos,
+                "pending_repos": pending_repos,
+                "retrying_repos": retrying_repos,
                 "vector_documents": vector_stats["total_documents"],
                 "processing_rate": f"{processed_repos}/{total_repos}" if total_repos > 0 else "0/0"
             }
@@ -239,6 +429,8 @@ class ReadmeService:
             return {
                 "total_repos": 0,
                 "processed_repos": 0,
+                "pending_repos": 0,
+                "retrying_repos": 0,
                 "vector_documents": 0,
                 "processing_rate": "0/0"
             }
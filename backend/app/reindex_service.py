@@ -0,0 +1,199 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from . import crud
+from .database import SessionLocal, RepoReadme, StarredRepo
+from .readme_service import README_SOURCE_COLUMNS, ReadmeService
+from .vector_service import vector_service, COLLECTION_BASE_NAME, ACTIVE_COLLECTION_KEY
+from .vector_store import VectorStore, create_vector_store
+from .websocket_manager import websocket_manager
+from .shared_state import SharedLock, state_broker
+
+logger = logging.getLogger(__name__)
+
+# 应用配置中保存上一个集合名的键（保留一个旧版本，便于回退）
+PREVIOUS_COLLECTION_KEY = "previous_vector_collection"
+
+
+class ReindexService:
+    """蓝绿重建向量集合：用数据库中已保存的README内容批量构建新版本集合，完成后原子地切换读取方
+    
+    构建期间旧集合继续提供搜索；新写入同时写入两个集合，构建结束后再补上构建期间数据库中更新的README。
+    """
+    
+    def __init__(self, chunk_size: int = 200):
+        self.chunk_size = chunk_size
+        self.status = {
+            "is_running": False,
+            "phase": "idle",
+            "processed": 0,
+            "total": 0,
+            "collection": None,
+            "previous_collection": None,
+            "started_at": None,
+            "finished_at": None,
+            "message": "Ready to reindex"
+        }
+        # 跨进程互斥：任意进程同一时间只运行一个重建
+        self.lock = SharedLock(state_broker, "vector_reindex")
+    
+    async def _update_status(self, **changes):
+        """更新状态并通过WebSocket广播"""
+        self.status.update(changes)
+        await websocket_manager.broadcast_reindex_status(self.status)
+    
+    def _read_chunk(self, last_repo_id: Optional[int], updated_since: Optional[datetime]) -> List:
+        """按repo_id键集分页读取一块README内容（在线程中执行，使用独立的数据库会话）"""
+        db = SessionLocal()
+        try:
+            query = (
+                db.query(*README_SOURCE_COLUMNS, RepoReadme.content)
+                .join(RepoReadme, RepoReadme.repo_id == StarredRepo.repo_id)
+                .filter(RepoReadme.content.isnot(None), RepoReadme.content != "")
+                .order_by(StarredRepo.repo_id)
+            )
+            if updated_since is not None:
+                query = query.filter(RepoReadme.updated_at >= updated_since)
+            if last_repo_id is not None:
+                query = query.filter(StarredRepo.repo_id > last_repo_id)
+            return query.limit(self.chunk_size).all()
+        finally:
+            db.close()
+    
+    async def get_status(self) -> Dict:
+        """重建状态：本进程正在重建时返回本地状态，否则返回任意进程最近发布的状态"""
+        if self.lock.held:
+            return self.status
+        return await websocket_manager.get_state("reindex_status") or self.status
+    
+    def _count(self) -> int:
+        db = SessionLocal()
+        try:
+            return db.query(RepoReadme).filter(RepoReadme.content.isnot(None), RepoReadme.content != "").count()
+        finally:
+            db.close()
+    
+    async def _copy(self, store: VectorStore, updated_since: Optional[datetime] = None) -> int:
+        """把README内容分块批量计算向量并写入目标集合，返回写入数量"""
+        copied = 0
+        last_repo_id = None
+        
+        while True:
+            rows = await asyncio.to_thread(self._read_chunk, last_repo_id, updated_since)
+            if not rows:
+                break
+            
+            # 每块一次批量计算（已缓存的内容不重复推理）、一次写入
+            embeddings = await vector_service.aget_embeddings([row.content for row in rows])
+            await asyncio.to_thread(vector_service.upsert_readmes, [
+                ReadmeService.vector_item(row, row.content, embedding)
+                for row, embedding in zip(rows, embeddings)
+            ], store)
+            
+            copied += len(rows)
+            last_repo_id = rows[-1].repo_id
+            if updated_since is None:
+                await self._update_status(
+                    processed=copied,
+                    message=f"Embedded {copied}/{self.status['total']} READMEs"
+                )
+        
+        return copied
+    
+    def _switch(self, store: VectorStore, old_name: str) -> Optional[str]:
+        """在一个事务中更新集合指针，返回需要删除的更早版本集合名"""
+        db = SessionLocal()
+        try:
+            stale_name = crud.get_setting(db, PREVIOUS_COLLECTION_KEY)
+            crud.set_settings(db, {ACTIVE_COLLECTION_KEY: store.name, PREVIOUS_COLLECTION_KEY: old_name})
+        finally:
+            db.close()
+        
+        vector_service.switch_collection(store)
+        return stale_name if stale_name not in (None, old_name, store.name) else None
+    
+    async def run(self, chunk_size: Optional[int] = None) -> Dict:
+        """执行一次蓝绿重建（未事先获取重建锁时在这里获取）"""
+        if not self.lock.held and not await self.lock.acquire():
+            raise RuntimeError("向量重建任务已在运行中")
+        if chunk_size:
+            self.chunk_size = chunk_size
+        
+        started_at = datetime.utcnow()
+        old_name = await asyncio.to_thread(lambda: vector_service.store.name)
+        new_name = f"{COLLECTION_BASE_NAME}_v{started_at:%Y%m%d%H%M%S}"
+        
+        self.status.update({
+            "is_running": True,
+            "processed": 0,
+            "total": 0,
+            "collection": new_name,
+            "previous_collection": old_name,
+            "started_at": started_at,
+            "finished_at": None
+        })
+        
+        new_store = None
+        try:
+            await self._update_status(phase="building", message=f"Building collection {new_name}")
+            new_store = await asyncio.to_thread(create_vector_store, new_name)
+            await asyncio.to_thread(new_store.clear)
+            self.status["total"] = await asyncio.to_thread(self._count)
+            
+            # 构建期间本进程的新写入同时写入新集合
+            vector_service.begin_shadow(new_store)
+            copied = await self._copy(new_store)
+            
+            # 补上构建期间数据库中更新的README（包括其他进程写入的）
+            await self._update_status(phase="catching_up", message="Applying READMEs updated during the rebuild")
+            caught_up = await self._copy(new_store, updated_since=started_at)
+            
+            await self._update_status(phase="switching", message=f"Switching readers to {new_name}")
+            stale_name = await asyncio.to_thread(self._switch, new_store, old_name)
+            vector_service.end_shadow()
+            
+            # 保留上一个版本便于回退，删除更早的版本
+            if stale_name:
+                try:
+                    await asyncio.to_thread(create_vector_store(stale_name).drop)
+                except Exception as e:
+                    logger.warning(f"删除旧向量集合 {stale_name} 失败: {e}")
+            
+            result = {"collection": new_name, "previous_collection": old_name, "total": copied, "caught_up": caught_up}
+            await self._update_status(
+                phase="done",
+                finished_at=datetime.utcnow(),
+                message=f"Reindexed {copied} READMEs into {new_name}"
+            )
+            logger.info(f"向量重建完成：{result}")
+        
+        except Exception as e:
+            vector_service.end_shadow()
+            logger.error(f"向量重建失败: {e}")
+            if new_store is not None and vector_service.store.name != new_store.name:
+                try:
+                    await asyncio.to_thread(new_store.drop)
+                except Exception:
+                    pass
+            await self._update_status(phase="failed", finished_at=datetime.utcnow(), message=f"Reindex failed: {e}")
+            raise
+        
+        finally:
+            self.status["is_running"] = False
+            await websocket_manager.broadcast_reindex_status(self.status)
+            await self.lock.release()
+        
+        # 新集合中的向量可能来自不同的模型，近邻表全量重建
+        try:
+            from .knn_service import knn_service
+            await knn_service.arefresh(full=True)
+        except Exception as e:
+            logger.error(f"重建相似仓库近邻表失败: {e}")
+        
+        return result
+
+
+# 全局向量重建服务实例
+reindex_service = ReindexService()
@@ -1,17 +1,32 @@
 import asyncio
 import logging
+import os
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
-from datetime import datetime
+from apscheduler.triggers.date import DateTrigger
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.orm import Session
 
+from . import crud
 from .database import SessionLocal
 from .readme_service import readme_service
+from .sync_service import sync_service
+from .knn_service import knn_service
+from .github_service import rate_limit_tracker
+from .adaptive_scheduler import adaptive_planner
 from .websocket_manager import websocket_manager
+from .shared_state import SharedLock, state_broker, get_worker_id
 
 logger = logging.getLogger(__name__)
 
+# 调度器领导者租约名
+LEADER_LEASE_NAME = "task_scheduler"
+
+# 调度模式：adaptive 按配额、积压和变更速率自行安排README任务；fixed 为每天凌晨全量+每6小时增量
+SCHEDULER_MODES = ("adaptive", "fixed")
+ADAPTIVE_JOB_ID = "adaptive_readme"
+
 
 class TaskScheduler:
     """定时任务调度器"""
@@ -19,6 +34,14 @@ class TaskScheduler:
     def __init__(self):
         self.scheduler = AsyncIOScheduler()
         self.is_running = False
+        # 每次增量任务最多处理的仓库数
+        self.incremental_limit = int(os.getenv("INCREMENTAL_README_LIMIT", "200"))
+        # GitHub同步任务的间隔小时数，0表示不定时同步
+        self.sync_interval_hours = int(os.getenv("SYNC_INTERVAL_HOURS", "0"))
+        self.mode = os.getenv("SCHEDULER_MODE", "adaptive")
+        if self.mode not in SCHEDULER_MODES:
+            raise ValueError(f"不支持的 SCHEDULER_MODE: {self.mode}")
+        self.planner = adaptive_planner
         self.readme_processing_status = {
             "is_processing": False,
             "last_run": None,
@@ -26,46 +49,129 @@ class TaskScheduler:
             "total_processed": 0,
             "message": "Ready to process"
         }
+        # 跨进程互斥：README处理任务在所有进程中同一时间只运行一个
+        self.readme_lock = SharedLock(state_broker, "readme_processing")
+        
+        # 领导者选举：多个进程/副本都启动调度器时，只有持有数据库租约的实例触发定时任务
+        self.leader_election = os.getenv("SCHEDULER_LEADER_ELECTION", "true").lower() == "true"
+        self.lease_seconds = float(os.getenv("SCHEDULER_LEASE_SECONDS", "30"))
+        self.heartbeat_seconds = float(os.getenv("SCHEDULER_HEARTBEAT_SECONDS", "10"))
+        self.instance_id = get_worker_id()
+        self.is_leader = False
+        self._election_task = None
+        self._lease_info = {"leader": None, "lease_expires_at": None}
     
     async def start(self):
         """启动调度器"""
         if not self.is_running:
-            # 添加README处理任务 - 每天凌晨2点执行
-            self.scheduler.add_job(
-                self.process_readmes_job,
-                CronTrigger(hour=2, minute=0),
-                id="readme_processing",
-                name="Process README files",
-                replace_existing=True
-            )
-            
-            # 添加增量README处理任务 - 每6小时执行一次
-            self.scheduler.add_job(
-                self.incremental_readme_job,
-                IntervalTrigger(hours=6),
-                id="incremental_readme",
-                name="Incremental README processing",
-                replace_existing=True
-            )
-            
-            self.scheduler.start()
+            if self.mode == "adaptive":
+                # 自适应README任务 - 启动后不久首次运行，之后每次运行结束时自行安排下一次
+                self._schedule_adaptive(datetime.utcnow())
+            else:
+                # 添加README处理任务 - 每天凌晨2点执行
+                self.scheduler.add_job(
+                    self.process_readmes_job,
+                    CronTrigger(hour=2, minute=0),
+                    id="readme_processing",
+                    name="Process README files",
+                    replace_existing=True
+                )
+                
+                # 添加增量README处理任务 - 每6小时执行一次
+                self.scheduler.add_job(
+                    self.incremental_readme_job,
+                    IntervalTrigger(hours=6),
+                    id="incremental_readme",
+                    name="Incremental README processing",
+                    replace_existing=True
+                )
+            
+            # 添加GitHub同步任务（可选）
+            if self.sync_interval_hours > 0:
+                self.scheduler.add_job(
+                    self.sync_job,
+                    IntervalTrigger(hours=self.sync_interval_hours),
+                    id="github_sync",
+                    name="Sync starred repositories",
+                    replace_existing=True
+                )
+            
+            # 启用领导者选举时先暂停，成为领导者后才触发任务
+            self.scheduler.start(paused=self.leader_election)
             self.is_running = True
             logger.info("定时任务调度器已启动")
             
+            if self.leader_election:
+                self._election_task = asyncio.create_task(self._election_loop())
+            else:
+                self.is_leader = True
+            
             # 更新下次运行时间
             self._update_next_run_time()
     
     async def stop(self):
-        """停止调度器"""
+        """停止调度器（领导者释放租约，其他实例立即接管）"""
         if self.is_running:
+            if self._election_task is not None:
+                self._election_task.cancel()
+                self._election_task = None
+            if self.leader_election and self.is_leader:
+                try:
+                    await asyncio.to_thread(self._release_lease)
+                except Exception as e:
+                    logger.error(f"释放调度器租约失败: {e}")
+            self.is_leader = False
+            
             self.scheduler.shutdown()
             self.is_running = False
             logger.info("定时任务调度器已停止")
     
+    def _acquire_lease(self) -> bool:
+        """获取或续期领导者租约（在线程中执行，使用独立的数据库会话）"""
+        db = SessionLocal()
+        try:
+            acquired = crud.acquire_lease(db, LEADER_LEASE_NAME, self.instance_id, self.lease_seconds)
+            lease = crud.get_lease(db, LEADER_LEASE_NAME)
+            self._lease_info = {
+                "leader": lease.holder if lease else None,
+                "lease_expires_at": lease.expires_at if lease else None
+            }
+            return acquired
+        finally:
+            db.close()
+    
+    def _release_lease(self):
+        db = SessionLocal()
+        try:
+            crud.release_lease(db, LEADER_LEASE_NAME, self.instance_id)
+        finally:
+            db.close()
+    
+    async def _election_loop(self):
+        """定期获取或续期租约：获得租约时恢复任务，失去租约（或无法续期）时暂停任务"""
+        while True:
+            try:
+                acquired = await asyncio.to_thread(self._acquire_lease)
+            except Exception as e:
+                logger.error(f"续期调度器租约失败: {e}")
+                acquired = False
+            
+            if acquired and not self.is_leader:
+                self.is_leader = True
+                self.scheduler.resume()
+                self._update_next_run_time()
+                logger.info(f"成为调度器领导者: {self.instance_id}")
+            elif not acquired and self.is_leader:
+                self.is_leader = False
+                self.scheduler.pause()
+                logger.warning(f"失去调度器领导者租约，暂停定时任务: {self.instance_id}")
+            
+            await asyncio.sleep(self.heartbeat_seconds)
+    
     def _update_next_run_time(self):
         """更新下次运行时间"""
         try:
-            job = self.scheduler.get_job("readme_processing")
+            job = self.scheduler.get_job(ADAPTIVE_JOB_ID if self.mode == "adaptive" else "readme_processing")
             if job and job.next_run_time:
                 self.readme_processing_status["next_run"] = job.next_run_time
         except Exception as e:
@@ -73,7 +179,7 @@ class TaskScheduler:
     
     async def process_readmes_job(self):
         """README处理定时任务"""
-        if self.readme_processing_status["is_processing"]:
+        if not await self.readme_lock.acquire():
             logger.warning("README处理任务已在运行中，跳过本次执行")
             return
         
@@ -105,6 +211,8 @@ class TaskScheduler:
             finally:
                 db.close()
             
+            await self._refresh_neighbors()
+        
         except Exception as e:
             logger.error(f"README处理任务失败: {e}")
             self.readme_processing_status["message"] = f"处理失败: {str(e)}"
@@ -115,10 +223,38 @@ class TaskScheduler:
             
             # 广播最终状态
             await websocket_manager.broadcast_readme_status(self.readme_processing_status)
+            await self.readme_lock.release()
+    
+    async def sync_job(self):
+        """GitHub同步定时任务（自适应模式下配额不足时推迟到配额重置之后）"""
+        if await sync_service.is_syncing():
+            logger.warning("同步任务已在运行中，跳过本次执行")
+            return
+        
+        try:
+            if self.mode == "adaptive":
+                decision = await self.planner.decide_sync()
+                if not decision["run"]:
+                    logger.warning(f"GitHub配额不足，同步推迟到 {decision['next_run_at']:%Y-%m-%d %H:%M}")
+                    self.scheduler.add_job(
+                        self.sync_job,
+                        DateTrigger(run_date=decision["next_run_at"].replace(tzinfo=timezone.utc)),
+                        id="github_sync_deferred",
+                        name="Deferred sync of starred repositories",
+                        replace_existing=True,
+                        misfire_grace_time=None
+                    )
+                    return
+            
+            logger.info("开始执行GitHub同步任务")
+            result = await sync_service.sync()
+            logger.info(f"GitHub同步任务完成：{result}")
+        except Exception as e:
+            logger.error(f"GitHub同步任务失败: {e}")
     
     async def incremental_readme_job(self):
-        """增量README处理任务（处理最近更新的仓库）"""
-        if self.readme_processing_status["is_processing"]:
+        """增量README处理任务（处理变更队列中的仓库）"""
+        if not await self.readme_lock.acquire():
             logger.warning("README处理任务已在运行中，跳过增量处理")
             return
         
@@ -128,11 +264,12 @@ class TaskScheduler:
             # 创建数据库会话
             db = SessionLocal()
             try:
-                # 只处理最近50个仓库
+                # 只处理变更队列：新star的仓库、从未处理的仓库和有新提交的仓库
                 result = await readme_service.batch_process_readmes(
                     db=db,
                     batch_size=5,
-                    max_repos=50
+                    max_repos=self.incremental_limit,
+                    only_changed=True
                 )
                 
                 logger.info(f"增量README处理完成：{result}")
@@ -140,12 +277,98 @@ class TaskScheduler:
             finally:
                 db.close()
             
+            await self._refresh_neighbors()
+        
         except Exception as e:
             logger.error(f"增量README处理失败: {e}")
+        
+        finally:
+            await self.readme_lock.release()
+    
+    def _schedule_adaptive(self, run_at: datetime):
+        """安排下一次自适应README任务（run_at为UTC时间，至少在一分钟之后）"""
+        run_at = max(run_at, datetime.utcnow() + timedelta(minutes=1))
+        # 错过的运行（例如调度器暂停期间、领导者切换）在恢复后补上
+        self.scheduler.add_job(
+            self.adaptive_readme_job,
+            DateTrigger(run_date=run_at.replace(tzinfo=timezone.utc)),
+            id=ADAPTIVE_JOB_ID,
+            name="Adaptive README processing",
+            replace_existing=True,
+            misfire_grace_time=None
+        )
+        if self.scheduler.running:
+            self._update_next_run_time()
+    
+    async def adaptive_readme_job(self):
+        """自适应README任务：按规划处理变更队列和最久未检查的仓库，结束时安排下一次运行"""
+        next_run = datetime.utcnow() + self.planner.min_interval
+        if not await self.readme_lock.acquire():
+            logger.warning("README处理任务已在运行中，推迟自适应任务")
+            self._schedule_adaptive(next_run)
+            return
+        
+        try:
+            decision = await self.planner.decide_readmes()
+            next_run = decision["next_run_at"]
+            
+            if decision["max_changed"] or decision["max_stale"]:
+                self.readme_processing_status["is_processing"] = True
+                self.readme_processing_status["message"] = (
+                    f"处理变更 {decision['max_changed']} 个、刷新 {decision['max_stale']} 个仓库的README..."
+                )
+                self.readme_processing_status["last_run"] = datetime.utcnow()
+                await websocket_manager.broadcast_readme_status(self.readme_processing_status)
+                
+                requests_before = rate_limit_tracker.requests
+                results = []
+                db = SessionLocal()
+                try:
+                    # 先处理变更队列，再用剩余的额度刷新最久未检查的仓库
+                    if decision["max_changed"]:
+                        results.append(await readme_service.batch_process_readmes(
+                            db=db, batch_size=5, max_repos=decision["max_changed"], only_changed=True
+                        ))
+                    if decision["max_stale"]:
+                        results.append(await readme_service.batch_process_readmes(
+                            db=db, batch_size=5, max_repos=decision["max_stale"], stale_first=True
+                        ))
+                finally:
+                    db.close()
+                
+                processed = sum(result["total"] for result in results)
+                success = sum(result["success"] for result in results)
+                await self.planner.record_run(decision, processed, success, rate_limit_tracker.requests - requests_before)
+                
+                self.readme_processing_status["total_processed"] = success
+                self.readme_processing_status["message"] = f"处理完成：成功 {success} 个，失败 {processed - success} 个"
+                logger.info(f"自适应README任务完成：{decision['result']}")
+                
+                await self._refresh_neighbors()
+            else:
+                self.readme_processing_status["message"] = f"本次无需处理（{decision['reason']}）"
+        
+        except Exception as e:
+            logger.error(f"自适应README任务失败: {e}")
+            self.readme_processing_status["message"] = f"处理失败: {str(e)}"
+        
+        finally:
+            self.readme_processing_status["is_processing"] = False
+            await self.readme_lock.release()
+            if self.is_running:
+                self._schedule_adaptive(next_run)
+            await websocket_manager.broadcast_readme_status(self.readme_processing_status)
+    
+    async def _refresh_neighbors(self):
+        """README处理后增量刷新相似仓库近邻表（只重新计算有变化的部分）"""
+        try:
+            await knn_service.arefresh()
+        except Exception as e:
+            logger.error(f"刷新相似仓库近邻表失败: {e}")
     
     async def manual_process_readmes(self, max_repos: int = None):
         """手动触发README处理"""
-        if self.readme_processing_status["is_processing"]:
+        if not await self.readme_lock.acquire():
             raise Exception("README处理任务已在运行中")
         
         try:
@@ -168,20 +391,36 @@ class TaskScheduler:
                 self.readme_processing_status["total_processed"] = result["success"]
                 self.readme_processing_status["message"] = f"手动处理完成：成功 {result['success']} 个，失败 {result['failed']} 个"
                 
-                return result
-                
             finally:
                 db.close()
+            
+            await self._refresh_neighbors()
+            return result
         
         finally:
             self.readme_processing_status["is_processing"] = False
             await websocket_manager.broadcast_readme_status(self.readme_processing_status)
+            await self.readme_lock.release()
+    
+    async def get_readme_status(self):
+        """README处理状态：本进程正在处理时返回本地状态，否则返回任意进程（例如独立的worker）最近发布的状态"""
+        if self.readme_lock.held:
+            return self.readme_processing_status
+        return await websocket_manager.get_state("readme_status") or self.readme_processing_status
     
-    def get_status(self):
+    async def get_status(self):
         """获取调度器状态"""
         return {
             "is_running": self.is_running,
-            "readme_processing": self.readme_processing_status,
+            "leader_election": {
+                "enabled": self.leader_election,
+                "instance_id": self.instance_id,
+                "is_leader": self.is_leader,
+                **self._lease_info
+            },
+            "readme_processing": await self.get_readme_status(),
+            "mode": self.mode,
+            "adaptive": await self.planner.get_status(local=self.is_leader) if self.mode == "adaptive" else None,
             "jobs": [
                 {
                     "id": job.id,
@@ -21,6 +21,7 @@ class StarredRepoBase(BaseModel):
     starred_at: datetime
     created_at: datetime
     updated_at: datetime
+    pushed_at: Optional[datetime] = None
     is_fork: bool = False
     is_private: bool = False
     size: int
@@ -108,6 +109,15 @@ class SemanticSearchRequest(BaseModel):
     query: str
     limit: int = 10
     min_similarity: float = 0.5
+    # 结构化过滤条件，在向量检索时下推，保证返回limit个满足条件的结果
+    language: Optional[str] = None
+    owner: Optional[str] = None
+    min_stars: Optional[int] = None
+    max_stars: Optional[int] = None
+    starred_after: Optional[str] = None
+    starred_before: Optional[str] = None
+    has_topics: Optional[bool] = None
+    is_fork: Optional[bool] = None
 
 
 class SemanticSearchResult(BaseModel):
@@ -128,6 +138,83 @@ class SemanticSearchResponse(BaseModel):
     processing_time: float
 
 
+class BatchSemanticSearchRequest(BaseModel):
+    queries: List[str]
+    limit: int = 10
+    min_similarity: float = 0.5
+    # 结构化过滤条件，对所有查询生效
+    language: Optional[str] = None
+    owner: Optional[str] = None
+    min_stars: Optional[int] = None
+    max_stars: Optional[int] = None
+    starred_after: Optional[str] = None
+    starred_before: Optional[str] = None
+    has_topics: Optional[bool] = None
+    is_fork: Optional[bool] = None
+
+
+class BatchSemanticSearchItem(BaseModel):
+    query: str
+    results: List[SemanticSearchResult]
+    total: int
+
+
+class BatchSemanticSearchResponse(BaseModel):
+    results: List[BatchSemanticSearchItem]  # 与请求中的queries一一对应
+    total_queries: int
+    processing_time: float
+
+
+class HybridSearchRequest(BaseModel):
+    query: str
+    limit: int = 20
+    # 结构化过滤条件，同时作用于关键词检索和向量检索
+    language: Optional[str] = None
+    owner: Optional[str] = None
+    min_stars: Optional[int] = None
+    max_stars: Optional[int] = None
+    starred_after: Optional[str] = None
+    starred_before: Optional[str] = None
+    has_topics: Optional[bool] = None
+    is_fork: Optional[bool] = None
+    # 融合参数：加权倒数排名融合 (RRF)
+    lexical_weight: float = 1.0
+    semantic_weight: float = 1.0
+    rrf_k: int = 60
+    min_similarity: float = 0.0
+    # 延迟预算（毫秒），超时的一路检索结果会被放弃
+    timeout_ms: Optional[int] = None
+
+
+class HybridSearchResult(BaseModel):
+    repo: StarredRepo
+    score: float
+    lexical_rank: Optional[int] = None
+    semantic_rank: Optional[int] = None
+    similarity_score: Optional[float] = None
+
+
+class HybridSearchResponse(BaseModel):
+    results: List[HybridSearchResult]
+    total: int
+    query: str
+    processing_time: float
+    sources: dict  # 每一路检索的状态: "ok" | "timeout" | "error"
+
+
+class SimilarRepoResult(BaseModel):
+    repo: StarredRepo
+    similarity_score: float
+
+
+class SimilarReposResponse(BaseModel):
+    repo_id: int
+    results: List[SimilarRepoResult]
+    total: int
+    source: str  # "knn": 预先计算的近邻表 | "vector": 用已存储的向量实时检索
+    processing_time: float
+
+
 class ReadmeProcessingStatus(BaseModel):
     is_processing: bool
     last_run: Optional[datetime] = None
@@ -136,7 +223,27 @@ class ReadmeProcessingStatus(BaseModel):
     message: str
 
 
+class LeaderElectionStatus(BaseModel):
+    enabled: bool
+    instance_id: str
+    is_leader: bool
+    leader: Optional[str] = None  # 当前持有租约的实例
+    lease_expires_at: Optional[datetime] = None
+
+
+class AdaptiveSchedulingStatus(BaseModel):
+    settings: dict
+    requests_per_repo: float
+    rate_limit: dict
+    last_readme_decision: Optional[dict] = None
+    last_sync_decision: Optional[dict] = None
+    history: List[dict] = []
+
+
 class SchedulerStatus(BaseModel):
     is_running: bool
     readme_processing: ReadmeProcessingStatus
-    jobs: List[dict] 
\ No newline at end of file
+    jobs: List[dict]
+    leader_election: Optional[LeaderElectionStatus] = None
+    mode: str = "fixed"
+    adaptive: Optional[AdaptiveSchedulingStatus] = None
\ No newline at end of file
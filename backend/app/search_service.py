@@ -0,0 +1,258 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+
+from . import crud, schemas
+from .database import SessionLocal, StarredRepo
+from .vector_service import vector_service
+from .query_cache import SingleFlight
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 结构化过滤条件字段，与 crud.search_repos 的过滤参数一致
+FILTER_FIELDS = (
+    "language", "owner", "min_stars", "max_stars",
+    "starred_after", "starred_before", "has_topics", "is_fork"
+)
+
+
+class SearchService:
+    """搜索服务：语义搜索，以及关键词检索与向量检索并发执行、使用倒数排名融合 (RRF) 合并结果的混合搜索"""
+    
+    def __init__(self):
+        # 默认延迟预算（毫秒）
+        self.default_budget_ms = int(os.getenv("HYBRID_SEARCH_BUDGET_MS", "1000"))
+        # 相同语义搜索请求的合并
+        self.search_flight = SingleFlight()
+    
+    def _lexical_search(self, query: str, limit: int, filters: Dict) -> List[StarredRepo]:
+        """关键词检索（在线程中执行，使用独立的数据库会话）"""
+        db = SessionLocal()
+        try:
+            return crud.lexical_search(db, query, limit, **filters)
+        finally:
+            db.close()
+    
+    def hydrate_repos(self, repo_ids: List[int]) -> List[StarredRepo]:
+        """一次IN查询批量获取向量检索命中的仓库，按输入顺序返回（在线程中执行，使用独立的数据库会话）"""
+        if not repo_ids:
+            return []
+        
+        db = SessionLocal()
+        try:
+            return crud.get_repos_by_repo_ids(db, repo_ids)
+        finally:
+            db.close()
+    
+    def get_readme_previews(self, repo_ids: List[int]) -> Dict[int, str]:
+        """批量获取README内容预览（在线程中执行，使用独立的数据库会话）"""
+        db = SessionLocal()
+        try:
+            return crud.get_readme_previews(db, repo_ids)
+        finally:
+            db.close()
+    
+    def get_candidate_repo_ids(self, filters: Dict) -> Optional[List[int]]:
+        """结构化过滤得到的候选仓库ID，没有过滤条件时返回None（在线程中执行，使用独立的数据库会话）"""
+        if not crud.has_search_filters(**filters):
+            return None
+        
+        db = SessionLocal()
+        try:
+            return crud.get_filtered_readme_repo_ids(db, **filters)
+        finally:
+            db.close()
+    
+    async def _semantic_search(
+        self, query: str, limit: int, min_similarity: float, filters: Dict
+    ) -> List[Tuple[StarredRepo, float]]:
+        """向量检索（过滤条件下推到向量查询），返回 (仓库, 相似度)"""
+        repo_ids = await asyncio.to_thread(self.get_candidate_repo_ids, filters)
+        vector_results = await vector_service.asemantic_search(
+            query=query,
+            limit=limit,
+            repo_ids=repo_ids,
+            min_similarity=min_similarity
+        )
+        
+        scores = {result["repo_id"]: result["similarity_score"] for result in vector_results}
+        repos = await asyncio.to_thread(self.hydrate_repos, list(scores.keys()))
+        return [(repo, scores[repo.repo_id]) for repo in repos]
+    
+    async def semantic_search(self, request: schemas.SemanticSearchRequest) -> Dict:
+        """语义搜索，并发的相同请求（同一查询和参数）共享一次计算"""
+        return await self.search_flight.do(
+            request.model_dump_json(),
+            lambda: self._run_semantic_search(request)
+        )
+    
+    async def _run_semantic_search(self, request: schemas.SemanticSearchRequest) -> Dict:
+        """执行语义搜索"""
+        start_time = time.time()
+        
+        # 结构化过滤条件先在数据库中得到候选仓库，再下推到向量查询
+        filters = {field: getattr(request, field) for field in FILTER_FIELDS}
+        repo_ids = await asyncio.to_thread(self.get_candidate_repo_ids, filters)
+        
+        # 执行向量搜索（向量计算和检索都不阻塞事件循环），相似度阈值和过滤条件在检索时应用
+        vector_results = await vector_service.asemantic_search(
+            query=request.query,
+            limit=request.limit,
+            repo_ids=repo_ids,
+            min_similarity=request.min_similarity
+        )
+        
+        search_results = (await self._build_semantic_results([vector_results]))[0]
+        
+        return {
+            "results": search_results,
+            "total": len(search_results),
+            "query": request.query,
+            "processing_time": round(time.time() - start_time, 3)
+        }
+    
+    async def batch_semantic_search(self, request: schemas.BatchSemanticSearchRequest) -> Dict:
+        """批量语义搜索：所有查询共享一次候选过滤、一次批量向量计算、一次多查询检索和一次仓库信息查询"""
+        start_time = time.time()
+        
+        filters = {field: getattr(request, field) for field in FILTER_FIELDS}
+        repo_ids = await asyncio.to_thread(self.get_candidate_repo_ids, filters)
+        
+        batch_results = await vector_service.asemantic_search_batch(
+            queries=request.queries,
+            limit=request.limit,
+            repo_ids=repo_ids,
+            min_similarity=request.min_similarity
+        )
+        search_results = await self._build_semantic_results(batch_results)
+        
+        return {
+            "results": [
+                schemas.BatchSemanticSearchItem(query=query, results=results, total=len(results))
+                for query, results in zip(request.queries, search_results)
+            ],
+            "total_queries": len(request.queries),
+            "processing_time": round(time.time() - start_time, 3)
+        }
+    
+    async def _build_semantic_results(
+        self, batch_results: List[List[Dict]]
+    ) -> List[List[schemas.SemanticSearchResult]]:
+        """把一个或多个查询的向量检索结果转换为搜索结果，所有查询的命中仓库只查询一次数据库"""
+        # 一次查询批量获取所有命中仓库的详细信息
+        hit_ids = list(dict.fromkeys(result["repo_id"] for results in batch_results for result in results))
+        repos = await asyncio.to_thread(self.hydrate_repos, hit_ids)
+        repo_map = {repo.repo_id: repo for repo in repos}
+        
+        # 不保存原文的向量存储（numpy）从数据库补齐内容预览
+        if any(result["content"] is None for results in batch_results for result in results):
+            previews = await asyncio.to_thread(self.get_readme_previews, hit_ids)
+            for results in batch_results:
+                for result in results:
+                    if result["content"] is None:
+                        result["content"] = previews.get(result["repo_id"], "")
+        
+        search_results = []
+        for results in batch_results:
+            query_results = []
+            for result in results:
+                repo = repo_map.get(result["repo_id"])
+                if repo:
+                    # 截取内容预览
+                    content_preview = result["content"][:200] + "..." if len(result["content"]) > 200 else result["content"]
+                    
+                    query_results.append(schemas.SemanticSearchResult(
+                        repo_id=repo.repo_id,
+                        repo_name=repo.name,
+                        full_name=repo.full_name,
+                        description=repo.description,
+                        language=repo.language,
+                        stars=repo.stargazers_count,
+                        similarity_score=result["similarity_score"],
+                        content_preview=content_preview
+                    ))
+            search_results.append(query_results)
+        
+        return search_results
+    
+    async def hybrid_search(self, request: schemas.HybridSearchRequest) -> Dict:
+        """混合搜索"""
+        start_time = time.time()
+        
+        filters = {field: getattr(request, field) for field in FILTER_FIELDS}
+        # 每一路检索多取一些候选，给融合留出空间
+        candidates = min(max(request.limit * 3, 50), 200)
+        budget = (request.timeout_ms or self.default_budget_ms) / 1000
+        
+        tasks = {
+            "lexical": asyncio.create_task(
+                asyncio.to_thread(self._lexical_search, request.query, candidates, filters)
+            ),
+            "semantic": asyncio.create_task(
+                self._semantic_search(request.query, candidates, request.min_similarity, filters)
+            ),
+        }
+        
+        # 两路检索共享同一个延迟预算，超时的一路直接放弃
+        _, pending = await asyncio.wait(tasks.values(), timeout=budget)
+        for task in pending:
+            task.cancel()
+        
+        sources = {}
+        outputs = {}
+        for name, task in tasks.items():
+            if task in pending:
+                sources[name] = "timeout"
+                logger.warning(f"混合搜索的{name}检索超出延迟预算 {budget:.3f}s")
+            elif task.exception() is not None:
+                sources[name] = "error"
+                logger.error(f"混合搜索的{name}检索失败: {task.exception()}")
+            else:
+                sources[name] = "ok"
+                outputs[name] = task.result()
+        
+        if not outputs and "timeout" not in sources.values():
+            raise RuntimeError("关键词检索和向量检索均失败")
+        
+        # 倒数排名融合：score = Σ weight / (k + rank)
+        fused: Dict[int, Dict] = {}
+        
+        for rank, repo in enumerate(outputs.get("lexical", []), start=1):
+            entry = fused.setdefault(repo.repo_id, {"repo": repo, "score": 0.0})
+            entry["lexical_rank"] = rank
+            entry["score"] += request.lexical_weight / (request.rrf_k + rank)
+        
+        for rank, (repo, similarity) in enumerate(outputs.get("semantic", []), start=1):
+            entry = fused.setdefault(repo.repo_id, {"repo": repo, "score": 0.0})
+            entry["semantic_rank"] = rank
+            entry["similarity_score"] = similarity
+            entry["score"] += request.semantic_weight / (request.rrf_k + rank)
+        
+        ranked = sorted(fused.values(), key=lambda entry: entry["score"], reverse=True)[:request.limit]
+        results = [
+            schemas.HybridSearchResult(
+                repo=entry["repo"],
+                score=round(entry["score"], 6),
+                lexical_rank=entry.get("lexical_rank"),
+                semantic_rank=entry.get("semantic_rank"),
+                similarity_score=entry.get("similarity_score")
+            )
+            for entry in ranked
+        ]
+        
+        return {
+            "results": results,
+            "total": len(results),
+            "query": request.query,
+            "processing_time": round(time.time() - start_time, 3),
+            "sources": sources
+        }
+
+
+# 全局搜索服务实例
+search_service = SearchService()
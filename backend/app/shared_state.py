@@ -0,0 +1,330 @@
+"""跨进程共享状态与事件总线：多个uvicorn worker和独立的worker进程共享任务状态、互斥锁和WebSocket事件
+
+默认使用本地SQLite文件（SHARED_STATE_PATH），同一台机器上的所有进程共享；单进程部署可设置 STATE_BROKER=memory；
+也可以设置为 "模块路径:类名" 使用自定义的实现（例如基于Redis），该类需要继承 StateBroker 且可无参数构造。
+"""
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import logging
+import importlib
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+_worker_id: Optional[str] = None
+_worker_pid: Optional[int] = None
+
+
+def get_worker_id() -> str:
+    """当前进程的标识（fork出的子进程会重新生成）"""
+    global _worker_id, _worker_pid
+    if _worker_id is None or _worker_pid != os.getpid():
+        _worker_pid = os.getpid()
+        _worker_id = f"{socket.gethostname()}:{_worker_pid}:{uuid.uuid4().hex[:6]}"
+    return _worker_id
+
+
+class StateBroker(ABC):
+    """共享状态、带过期时间的互斥锁和事件发布/订阅"""
+    
+    # 是否跨进程共享（为False时不需要转发其他进程的事件）
+    shared = True
+    
+    @abstractmethod
+    def set_state(self, key: str, value: str):
+        """写入一个状态值（JSON字符串）"""
+    
+    @abstractmethod
+    def get_state(self, key: str) -> Optional[str]:
+        """读取一个状态值"""
+    
+    @abstractmethod
+    def get_states(self, prefix: str, max_age: Optional[float] = None) -> Dict[str, str]:
+        """读取键以prefix开头、max_age秒内更新过的所有状态值"""
+    
+    @abstractmethod
+    def try_acquire(self, name: str, owner: str, ttl: float) -> bool:
+        """获取（或由同一owner续期）互斥锁，锁被其他owner持有且未过期时返回False"""
+    
+    @abstractmethod
+    def release(self, name: str, owner: str):
+        """释放自己持有的锁"""
+    
+    @abstractmethod
+    def get_lock_owner(self, name: str) -> Optional[str]:
+        """未过期的锁的持有者，没有时返回None"""
+    
+    @abstractmethod
+    def publish(self, origin: str, events: List[Tuple[str, str]]):
+        """发布一批事件 (事件类型, JSON字符串)，并把每种事件的最新一条保存为同名状态"""
+    
+    @abstractmethod
+    def poll(self, after_id: int, limit: int = 500) -> List[Tuple[int, str, str]]:
+        """读取id大于after_id的事件，返回 (id, 发布者, JSON字符串)"""
+    
+    @abstractmethod
+    def last_event_id(self) -> int:
+        """最新事件的id"""
+
+
+class MemoryStateBroker(StateBroker):
+    """进程内实现，只适用于单进程部署"""
+    
+    shared = False
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states: Dict[str, Tuple[str, float]] = {}
+        self._locks: Dict[str, Tuple[str, float]] = {}
+        self._last_id = 0
+    
+    def set_state(self, key, value):
+        self._states[key] = (value, time.time())
+    
+    def get_state(self, key):
+        item = self._states.get(key)
+        return item[0] if item else None
+    
+    def get_states(self, prefix, max_age=None):
+        now = time.time()
+        return {
+            key: value for key, (value, updated_at) in list(self._states.items())
+            if key.startswith(prefix) and (max_age is None or now - updated_at <= max_age)
+        }
+    
+    def try_acquire(self, name, owner, ttl):
+        now = time.time()
+        with self._lock:
+            current = self._locks.get(name)
+            if current and current[0] != owner and current[1] > now:
+                return False
+            self._locks[name] = (owner, now + ttl)
+            return True
+    
+    def release(self, name, owner):
+        with self._lock:
+            if self._locks.get(name, (None,))[0] == owner:
+                del self._locks[name]
+    
+    def get_lock_owner(self, name):
+        current = self._locks.get(name)
+        return current[0] if current and current[1] > time.time() else None
+    
+    def publish(self, origin, events):
+        for event_type, payload in events:
+            self._last_id += 1
+            self.set_state(event_type, payload)
+    
+    def poll(self, after_id, limit=500):
+        return []
+    
+    def last_event_id(self):
+        return self._last_id
+
+
+class SqliteStateBroker(StateBroker):
+    """基于本地SQLite文件（WAL模式）的实现，同一台机器上的多个进程共享"""
+    
+    def __init__(self, path: Optional[str] = None, retention_seconds: Optional[float] = None):
+        self.path = path or os.getenv("SHARED_STATE_PATH", "./shared_state.db")
+        # 事件保留时间，订阅方轮询间隔远小于该时间
+        self.retention_seconds = retention_seconds or float(os.getenv("EVENT_BUS_RETENTION_SECONDS", "60"))
+        
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._publish_count = 0
+    
+    def _get_conn(self) -> sqlite3.Connection:
+        """获取（必要时创建）SQLite连接，fork出的子进程重新连接"""
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS shared_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS shared_locks (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS shared_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    origin TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                """
+            )
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    def set_state(self, key, value):
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO shared_state (key, value, updated_at) VALUES (?, ?, ?)",
+                (key, value, time.time())
+            )
+            conn.commit()
+    
+    def get_state(self, key):
+        with self._lock:
+            row = self._get_conn().execute("SELECT value FROM shared_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def get_states(self, prefix, max_age=None):
+        min_updated_at = time.time() - max_age if max_age is not None else 0
+        with self._lock:
+            rows = self._get_conn().execute(
+                "SELECT key, value FROM shared_state WHERE substr(key, 1, ?) = ? AND updated_at >= ?",
+                (len(prefix), prefix, min_updated_at)
+            ).fetchall()
+        return dict(rows)
+    
+    def try_acquire(self, name, owner, ttl):
+        now = time.time()
+        with self._lock:
+            conn = self._get_conn()
+            # 锁不存在、已过期或由同一owner持有时写入，一条语句完成比较和写入
+            cursor = conn.execute(
+                "INSERT INTO shared_locks (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE shared_locks.owner = excluded.owner OR shared_locks.expires_at < ?",
+                (name, owner, now + ttl, now)
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+    
+    def release(self, name, owner):
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("DELETE FROM shared_locks WHERE name = ? AND owner = ?", (name, owner))
+            conn.commit()
+    
+    def get_lock_owner(self, name):
+        with self._lock:
+            row = self._get_conn().execute(
+                "SELECT owner FROM shared_locks WHERE name = ? AND expires_at >= ?", (name, time.time())
+            ).fetchone()
+        return row[0] if row else None
+    
+    def publish(self, origin, events):
+        if not events:
+            return
+        
+        now = time.time()
+        with self._lock:
+            conn = self._get_conn()
+            conn.executemany(
+                "INSERT INTO shared_events (origin, payload, created_at) VALUES (?, ?, ?)",
+                [(origin, payload, now) for _, payload in events]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO shared_state (key, value, updated_at) VALUES (?, ?, ?)",
+                [(event_type, payload, now) for event_type, payload in events]
+            )
+            
+            # 定期清理过期事件
+            self._publish_count += 1
+            if self._publish_count % 100 == 1:
+                conn.execute("DELETE FROM shared_events WHERE created_at < ?", (now - self.retention_seconds,))
+            conn.commit()
+    
+    def poll(self, after_id, limit=500):
+        with self._lock:
+            return self._get_conn().execute(
+                "SELECT id, origin, payload FROM shared_events WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit)
+            ).fetchall()
+    
+    def last_event_id(self):
+        with self._lock:
+            row = self._get_conn().execute("SELECT MAX(id) FROM shared_events").fetchone()
+        return row[0] or 0
+
+
+class SharedLock:
+    """跨进程互斥锁：持有期间在后台定期续期，进程退出后锁在ttl秒后自动失效"""
+    
+    def __init__(self, broker: StateBroker, name: str, ttl: Optional[float] = None):
+        self.broker = broker
+        self.name = name
+        self.ttl = ttl or float(os.getenv("SHARED_LOCK_TTL_SECONDS", "60"))
+        self.owner = f"{get_worker_id()}:{uuid.uuid4().hex[:6]}"
+        self._renew_task: Optional[asyncio.Task] = None
+    
+    @property
+    def held(self) -> bool:
+        return self._renew_task is not None
+    
+    async def acquire(self) -> bool:
+        """尝试获取锁，已被持有（包括本进程）时返回False"""
+        if self.held:
+            return False
+        acquired = await asyncio.to_thread(self.broker.try_acquire, self.name, self.owner, self.ttl)
+        if acquired:
+            self._renew_task = asyncio.create_task(self._renew())
+        return acquired
+    
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await asyncio.to_thread(self.broker.try_acquire, self.name, self.owner, self.ttl):
+                    logger.warning(f"共享锁 {self.name} 已被其他进程获取")
+            except Exception as e:
+                logger.warning(f"共享锁 {self.name} 续期失败: {e}")
+    
+    async def release(self):
+        """释放锁（未持有时不做任何操作）"""
+        if self._renew_task is None:
+            return
+        self._renew_task.cancel()
+        self._renew_task = None
+        try:
+            await asyncio.to_thread(self.broker.release, self.name, self.owner)
+        except Exception as e:
+            logger.warning(f"释放共享锁 {self.name} 失败: {e}")
+    
+    async def is_locked(self) -> bool:
+        """锁是否被任意进程持有"""
+        if self.held:
+            return True
+        return await asyncio.to_thread(self.broker.get_lock_owner, self.name) is not None
+
+
+def create_state_broker(backend: Optional[str] = None) -> StateBroker:
+    """根据 STATE_BROKER 创建共享状态实现"""
+    backend = backend or os.getenv("STATE_BROKER", "sqlite")
+    if backend == "sqlite":
+        return SqliteStateBroker()
+    if backend == "memory":
+        return MemoryStateBroker()
+    if ":" in backend:
+        module_name, class_name = backend.split(":", 1)
+        broker = getattr(importlib.import_module(module_name), class_name)()
+        if not isinstance(broker, StateBroker):
+            raise ValueError(f"{backend} 不是 StateBroker 的实现")
+        return broker
+    raise ValueError(f"不支持的 STATE_BROKER: {backend}")
+
+
+# 全局共享状态实例
+state_broker = create_state_broker()
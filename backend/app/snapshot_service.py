@@ -0,0 +1,239 @@
+"""快照备份与恢复：把仓库、README和向量导出为一个压缩文件，在新环境中离线恢复，无需重新同步GitHub和计算向量
+
+文件格式：魔数之后是一系列帧，每帧为 4字节长度（大端）+ zlib压缩的msgpack对象：
+    {"type": "manifest", ...}                                   格式版本、向量模型等
+    {"type": "table", "table": 表名, "columns": {列名: [值]}}   按列存储的一块数据行
+    {"type": "vectors", "repo_ids": [...], "dim": d, "data": float16字节}
+    {"type": "end", "counts": {...}}                            结束标记，缺少时视为文件不完整
+"""
+import logging
+import struct
+import zlib
+from datetime import datetime
+from typing import BinaryIO, Dict, Iterator, List
+
+import numpy as np
+from sqlalchemy import DateTime
+from sqlalchemy.dialects.sqlite import insert
+
+from .database import SessionLocal, engine, StarredRepo, RepoReadme
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"SRSNAP\x00\x01"
+SNAPSHOT_VERSION = 1
+
+# 快照包含的表（按恢复顺序），自增主键id和近邻计算时间不导出
+SNAPSHOT_TABLES = (StarredRepo, RepoReadme)
+EXCLUDED_COLUMNS = {"id", "neighbors_updated_at"}
+
+
+def _msgpack():
+    import msgpack
+    return msgpack
+
+
+def _table_columns(model) -> List[str]:
+    return [column.name for column in model.__table__.columns if column.name not in EXCLUDED_COLUMNS]
+
+
+def _datetime_columns(model) -> List[str]:
+    return [
+        column.name for column in model.__table__.columns
+        if isinstance(column.type, DateTime) and column.name not in EXCLUDED_COLUMNS
+    ]
+
+
+def _write_frame(output: BinaryIO, frame: Dict, level: int):
+    payload = zlib.compress(_msgpack().packb(frame, use_bin_type=True), level)
+    output.write(struct.pack(">I", len(payload)))
+    output.write(payload)
+
+
+def _read_frames(source: BinaryIO) -> Iterator[Dict]:
+    if source.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        raise ValueError("不是有效的快照文件")
+    
+    msgpack = _msgpack()
+    while True:
+        header = source.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ValueError("快照文件不完整")
+        (length,) = struct.unpack(">I", header)
+        payload = source.read(length)
+        if len(payload) < length:
+            raise ValueError("快照文件不完整")
+        yield msgpack.unpackb(zlib.decompress(payload), raw=False)
+
+
+def _iter_table_chunks(db, model, chunk_size: int) -> Iterator[Dict[str, list]]:
+    """按repo_id键集分页读取一张表，每块转换为按列存储的字典"""
+    columns = _table_columns(model)
+    datetime_columns = set(_datetime_columns(model))
+    attributes = [getattr(model, name) for name in columns]
+    last_repo_id = None
+    
+    while True:
+        query = db.query(*attributes).order_by(model.repo_id)
+        if last_repo_id is not None:
+            query = query.filter(model.repo_id > last_repo_id)
+        rows = query.limit(chunk_size).all()
+        if not rows:
+            return
+        
+        data = {}
+        for index, name in enumerate(columns):
+            values = [row[index] for row in rows]
+            if name in datetime_columns:
+                values = [value.isoformat() if value is not None else None for value in values]
+            data[name] = values
+        yield data
+        last_repo_id = rows[-1].repo_id
+
+
+def write_snapshot(output: BinaryIO, chunk_size: int = 5000, include_vectors: bool = True, level: int = 6) -> Dict:
+    """把仓库、README和向量写入快照，内存占用只与chunk_size有关，返回各部分的数量"""
+    from .vector_service import vector_service
+    
+    counts = {model.__tablename__: 0 for model in SNAPSHOT_TABLES}
+    counts["vectors"] = 0
+    store = vector_service.store if include_vectors else None
+    
+    output.write(SNAPSHOT_MAGIC)
+    _write_frame(output, {
+        "type": "manifest",
+        "version": SNAPSHOT_VERSION,
+        "created_at": datetime.utcnow().isoformat(),
+        "embedding_model": vector_service.model_name if include_vectors else None,
+        "collection": store.name if store is not None else None,
+        "tables": {model.__tablename__: _table_columns(model) for model in SNAPSHOT_TABLES}
+    }, level)
+    
+    db = SessionLocal()
+    try:
+        for model in SNAPSHOT_TABLES:
+            for data in _iter_table_chunks(db, model, chunk_size):
+                _write_frame(output, {"type": "table", "table": model.__tablename__, "columns": data}, level)
+                counts[model.__tablename__] += len(data["repo_id"])
+                
+                # 向量跟随README分块导出，只导出有内容的README
+                if store is not None and model is RepoReadme:
+                    repo_ids = [
+                        repo_id for repo_id, content in zip(data["repo_id"], data["content"]) if content
+                    ]
+                    embeddings = store.get_embeddings(repo_ids)
+                    if embeddings:
+                        ids = list(embeddings.keys())
+                        matrix = np.asarray([embeddings[repo_id] for repo_id in ids], dtype=np.float16)
+                        _write_frame(output, {
+                            "type": "vectors",
+                            "repo_ids": ids,
+                            "dim": matrix.shape[1],
+                            "data": matrix.tobytes()
+                        }, level)
+                        counts["vectors"] += len(ids)
+    finally:
+        db.close()
+    
+    _write_frame(output, {"type": "end", "counts": counts}, level)
+    logger.info(f"快照导出完成：{counts}")
+    return counts
+
+
+def _restore_table(model, columns: Dict[str, list]):
+    """一次executemany批量写入一块数据行，已存在的repo_id被覆盖"""
+    names = list(columns.keys())
+    for name in set(_datetime_columns(model)) & set(names):
+        columns[name] = [datetime.fromisoformat(value) if value else None for value in columns[name]]
+    
+    rows = [dict(zip(names, values)) for values in zip(*(columns[name] for name in names))]
+    if not rows:
+        return 0
+    
+    stmt = insert(model)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["repo_id"],
+        set_={name: stmt.excluded[name] for name in names if name != "repo_id"}
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt, rows)
+    return len(rows)
+
+
+def _restore_vectors(frame: Dict) -> int:
+    """写入一块向量，同时填充持久化向量缓存（之后处理相同内容的README不会重新计算）"""
+    from .readme_service import README_SOURCE_COLUMNS, ReadmeService
+    from .vector_service import vector_service
+    
+    matrix = np.frombuffer(frame["data"], dtype=np.float16).reshape(-1, frame["dim"]).astype(np.float32)
+    embeddings = dict(zip(frame["repo_ids"], matrix.tolist()))
+    
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(*README_SOURCE_COLUMNS, RepoReadme.content, RepoReadme.content_hash)
+            .join(RepoReadme, RepoReadme.repo_id == StarredRepo.repo_id)
+            .filter(StarredRepo.repo_id.in_(list(embeddings.keys())))
+            .all()
+        )
+    finally:
+        db.close()
+    
+    rows = [row for row in rows if row.content]
+    vector_service.upsert_readmes([
+        ReadmeService.vector_item(row, row.content, embeddings[row.repo_id]) for row in rows
+    ])
+    vector_service.embedding_cache.put_many(vector_service.model_name, {
+        row.content_hash: embeddings[row.repo_id] for row in rows if row.content_hash
+    })
+    return len(rows)
+
+
+def restore_snapshot(source: BinaryIO, include_vectors: bool = True) -> Dict:
+    """从快照恢复：数据行分块批量upsert，向量写入当前集合
+    
+    快照中的向量模型与当前配置不同时跳过向量（需要之后用 reindex 重新计算），返回各部分的数量
+    """
+    models = {model.__tablename__: model for model in SNAPSHOT_TABLES}
+    counts = {name: 0 for name in models}
+    counts["vectors"] = 0
+    restore_vectors = include_vectors
+    completed = False
+    
+    for frame in _read_frames(source):
+        frame_type = frame.get("type")
+        
+        if frame_type == "manifest":
+            if frame.get("version") != SNAPSHOT_VERSION:
+                raise ValueError(f"不支持的快照版本: {frame.get('version')}")
+            if restore_vectors and frame.get("embedding_model"):
+                from .vector_service import vector_service
+                if frame["embedding_model"] != vector_service.model_name:
+                    logger.warning(
+                        f"快照的向量模型 {frame['embedding_model']} 与当前模型 {vector_service.model_name} 不同，跳过向量"
+                    )
+                    restore_vectors = False
+        
+        elif frame_type == "table":
+            model = models.get(frame["table"])
+            if model is None:
+                logger.warning(f"跳过未知的表: {frame['table']}")
+                continue
+            counts[frame["table"]] += _restore_table(model, frame["columns"])
+        
+        elif frame_type == "vectors":
+            if restore_vectors:
+                counts["vectors"] += _restore_vectors(frame)
+        
+        elif frame_type == "end":
+            completed = True
+            break
+    
+    if not completed:
+        raise ValueError(f"快照文件不完整，已恢复: {counts}")
+    
+    logger.info(f"快照恢复完成：{counts}")
+    return counts
+
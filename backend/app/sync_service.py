@@ -0,0 +1,122 @@
+import logging
+from datetime import datetime
+from typing import Dict, Optional
+from sqlalchemy.orm import Session
+
+from . import crud, schemas
+from .database import SessionLocal
+from .github_service import GitHubService
+from .websocket_manager import websocket_manager
+from .shared_state import SharedLock, state_broker
+
+logger = logging.getLogger(__name__)
+
+
+class SyncService:
+    """GitHub starred仓库同步服务，API进程和独立的worker进程共用"""
+    
+    def __init__(self):
+        # 同步状态
+        self.status = {
+            "is_syncing": False,
+            "last_sync": None,
+            "total_repos": 0,
+            "message": "Ready to sync"
+        }
+        # 每批写入的记录数
+        self.batch_size = 500
+        # 跨进程互斥：任意进程（API worker、独立worker）同一时间只运行一个同步
+        self.lock = SharedLock(state_broker, "github_sync")
+    
+    async def try_start(self) -> bool:
+        """获取同步锁，其他进程或本进程正在同步时返回False；获取成功后由 sync 负责释放"""
+        if not await self.lock.acquire():
+            return False
+        self.status["is_syncing"] = True
+        self.status["message"] = "Sync started"
+        await websocket_manager.broadcast_sync_status(self.status)
+        return True
+    
+    async def is_syncing(self) -> bool:
+        """是否有任意进程正在同步"""
+        return await self.lock.is_locked()
+    
+    async def get_status(self) -> Dict:
+        """同步状态：本进程正在同步时返回本地状态，否则返回任意进程最近发布的状态"""
+        if self.lock.held:
+            return self.status
+        return await websocket_manager.get_state("sync_status") or self.status
+    
+    async def sync(self, username: Optional[str] = None, db: Optional[Session] = None) -> Dict:
+        """从GitHub拉取starred仓库并批量写入数据库，未传入db时使用独立的数据库会话
+        
+        未事先调用 try_start 时在这里获取同步锁，其他进程正在同步时抛出RuntimeError
+        """
+        if not self.lock.held and not await self.try_start():
+            raise RuntimeError("同步任务已在运行中")
+        
+        own_session = db is None
+        if own_session:
+            db = SessionLocal()
+        
+        try:
+            self.status["is_syncing"] = True
+            self.status["message"] = "Fetching repositories from GitHub..."
+            
+            # 广播同步开始状态
+            await websocket_manager.broadcast_sync_status(self.status)
+            
+            github_service = GitHubService()
+            repos_data = await github_service.get_starred_repos(username)
+            
+            self.status["message"] = f"Saving {len(repos_data)} repositories to database..."
+            await websocket_manager.broadcast_sync_status(self.status)
+            
+            # 转换为StarredRepoCreate对象列表
+            repo_creates = [schemas.StarredRepoCreate(**repo_data) for repo_data in repos_data]
+            
+            # 使用高性能批量插入/更新
+            total_repos = len(repo_creates)
+            batch_size = self.batch_size
+            
+            for i in range(0, total_repos, batch_size):
+                batch = repo_creates[i:i + batch_size]
+                current_batch = i // batch_size + 1
+                total_batches = (total_repos + batch_size - 1) // batch_size
+                
+                # 广播进度
+                await websocket_manager.broadcast_sync_progress(
+                    current=i + len(batch),
+                    total=total_repos,
+                    message=f"Processing batch {current_batch}/{total_batches} ({len(batch)} repositories)"
+                )
+                
+                # 处理当前批次
+                crud.bulk_upsert_starred_repos_fast(db, batch, batch_size=len(batch))
+            
+            # 获取最终结果
+            result = {"total_processed": total_repos, "created": 0, "updated": total_repos}
+            
+            self.status["last_sync"] = datetime.utcnow()
+            self.status["total_repos"] = result["total_processed"]
+            self.status["message"] = f"Successfully synced {result['total_processed']} repositories"
+            
+            # 广播完成状态
+            await websocket_manager.broadcast_sync_status(self.status)
+            return result
+        
+        except Exception as e:
+            logger.error(f"同步失败: {e}")
+            self.status["message"] = f"Sync failed: {str(e)}"
+            await websocket_manager.broadcast_sync_status(self.status)
+            raise
+        finally:
+            self.status["is_syncing"] = False
+            await websocket_manager.broadcast_sync_status(self.status)
+            await self.lock.release()
+            if own_session:
+                db.close()
+
+
+# 全局同步服务实例
+sync_service = SyncService()
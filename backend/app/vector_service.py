@@ -1,71 +1,274 @@
 import os
+import asyncio
 import hashlib
-import chromadb
-from chromadb.config import Settings
-from typing import List, Dict, Optional, Tuple
-from openai import OpenAI
+import threading
+import time
+from typing import List, Dict, Optional
 import logging
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
+
+from .embedding_executor import EmbeddingExecutor
+from .embedding_cache import EmbeddingCache
+from .query_cache import QueryEmbeddingCache, SingleFlight, normalize_query
+from .vector_store import VectorStore, create_vector_store
+from . import metrics
+from .database import SessionLocal
+from . import crud
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# 向量集合的基础名称，重建时创建带版本号的新集合
+COLLECTION_BASE_NAME = "repo_readmes"
+# 应用配置中保存当前生效集合名的键
+ACTIVE_COLLECTION_KEY = "active_vector_collection"
+
 
 class VectorService:
-    """向量数据库服务，用于README内容的语义搜索"""
+    """向量数据库服务，用于README内容的语义搜索
+    
+    向量存储和API客户端在第一次使用时才创建，Sentence Transformers模型在进程池第一次推理时加载，
+    只做关键词搜索的API进程不会加载这些重型依赖；需要提前加载时调用 warmup()。
+    
+    当前生效的向量集合名保存在数据库中，重建完成后切换；其他进程每隔 VECTOR_COLLECTION_CHECK_SECONDS 秒重新读取。
+    重建期间的写入同时写入正在构建的集合（shadow）。
+    """
     
     def __init__(self):
-        # 初始化ChromaDB客户端
-        self.chroma_client = chromadb.PersistentClient(
-            path="./chroma_db",
-            settings=Settings(
-                anonymized_telemetry=False,
-                allow_reset=True
-            )
-        )
+        self._store: Optional[VectorStore] = None
+        self._shadow_store: Optional[VectorStore] = None
+        self._collection_name: Optional[str] = None
+        self._collection_checked_at = 0.0
+        self.collection_check_seconds = float(os.getenv("VECTOR_COLLECTION_CHECK_SECONDS", "5"))
+        self._deepseek_client = None
+        self._openai_client = None
+        self._init_lock = threading.Lock()
         
-        # 获取或创建集合
-        self.collection = self.chroma_client.get_or_create_collection(
-            name="repo_readmes",
-            metadata={"hnsw:space": "cosine"}
-        )
+        # 持久化向量缓存，相同内容和模型不重复推理
+        self.embedding_cache = EmbeddingCache()
+        
+        # 查询向量的内存LRU缓存，以及并发相同查询的请求合并
+        self.query_cache = QueryEmbeddingCache()
+        self.query_flight = SingleFlight()
         
         # 选择 embedding 方法
         self.embedding_method = os.getenv("EMBEDDING_METHOD", "sentence_transformers")
         
+        if self.embedding_method == "sentence_transformers":
+            # Sentence Transformers模型在独立的进程池中加载和推理（进程池按需启动）
+            model_name = os.getenv("SENTENCE_TRANSFORMER_MODEL", "all-MiniLM-L6-v2")
+            self.embedding_executor = EmbeddingExecutor(model_name)
+    
+    @property
+    def active_collection(self) -> str:
+        """当前生效的向量集合名（定期从数据库重新读取，其他进程切换集合后自动生效）"""
+        now = time.monotonic()
+        if self._collection_name is None or now - self._collection_checked_at > self.collection_check_seconds:
+            db = SessionLocal()
+            try:
+                self._collection_name = crud.get_setting(db, ACTIVE_COLLECTION_KEY, COLLECTION_BASE_NAME)
+            except Exception as e:
+                logger.warning(f"读取当前向量集合失败，使用默认集合: {e}")
+                self._collection_name = self._collection_name or COLLECTION_BASE_NAME
+            finally:
+                db.close()
+            self._collection_checked_at = now
+        return self._collection_name
+    
+    @property
+    def store(self) -> VectorStore:
+        """当前生效的向量存储（VECTOR_STORE=chroma|numpy），第一次访问或集合切换后创建"""
+        name = self.active_collection
+        if self._store is None or self._store.name != name:
+            with self._init_lock:
+                if self._store is None or self._store.name != name:
+                    if self._store is not None:
+                        self._store.flush()
+                        logger.info(f"向量集合已切换: {self._store.name} -> {name}")
+                    self._store = create_vector_store(name)
+        return self._store
+    
+    def begin_shadow(self, store: VectorStore):
+        """开始向正在重建的集合同步写入"""
+        self._shadow_store = store
+    
+    def end_shadow(self):
+        """停止向重建集合同步写入"""
+        self._shadow_store = None
+    
+    def switch_collection(self, store: VectorStore):
+        """本进程立即切换到新集合（调用方负责更新数据库中的集合指针）"""
+        with self._init_lock:
+            if self._store is not None:
+                self._store.flush()
+            self._store = store
+            self._collection_name = store.name
+            self._collection_checked_at = time.monotonic()
+    
+    def _write_stores(self) -> List[VectorStore]:
+        """需要写入的向量存储：当前集合，以及重建期间正在构建的集合"""
+        stores = [self.store]
+        if self._shadow_store is not None and self._shadow_store.name != stores[0].name:
+            stores.append(self._shadow_store)
+        return stores
+    
+    @property
+    def deepseek_client(self):
+        """DeepSeek客户端，第一次访问时创建"""
+        if self._deepseek_client is None:
+            with self._init_lock:
+                if self._deepseek_client is None:
+                    from openai import OpenAI
+                    self._deepseek_client = OpenAI(
+                        api_key=os.getenv("DEEPSEEK_API_KEY"),
+                        base_url="https://api.deepseek.com"
+                    )
+        return self._deepseek_client
+    
+    @property
+    def openai_client(self):
+        """OpenAI客户端，第一次访问时创建"""
+        if self._openai_client is None:
+            with self._init_lock:
+                if self._openai_client is None:
+                    from openai import OpenAI
+                    self._openai_client = OpenAI(
+                        api_key=os.getenv("OPENAI_API_KEY")
+                    )
+        return self._openai_client
+    
+    def warmup(self):
+        """预热：打开向量存储、创建API客户端或启动推理进程并加载模型"""
+        self.store.count()
+        if self.embedding_method == "sentence_transformers":
+            self.embedding_executor.warmup()
+        elif self.embedding_method == "deepseek":
+            self.deepseek_client
+        elif self.embedding_method == "openai":
+            self.openai_client
+    
+    @property
+    def model_name(self) -> str:
+        """当前使用的向量模型标识，用作向量缓存的键"""
         if self.embedding_method == "deepseek":
-            # 初始化DeepSeek客户端
-            self.deepseek_client = OpenAI(
-                api_key=os.getenv("DEEPSEEK_API_KEY"),
-                base_url="https://api.deepseek.com"
-            )
+            return "deepseek:deepseek-embedding"
         elif self.embedding_method == "sentence_transformers":
-            # 初始化Sentence Transformers模型
-            model_name = os.getenv("SENTENCE_TRANSFORMER_MODEL", "all-MiniLM-L6-v2")
-            logger.info(f"加载 Sentence Transformer 模型: {model_name}")
-            self.sentence_model = SentenceTransformer(model_name)
+            return f"sentence_transformers:{self.embedding_executor.model_name}"
         elif self.embedding_method == "openai":
-            # 初始化OpenAI客户端
-            self.openai_client = OpenAI(
-                api_key=os.getenv("OPENAI_API_KEY")
-            )
-        
+            return "openai:text-embedding-3-small"
+        return self.embedding_method
+    
     def get_embedding(self, text: str) -> List[float]:
-        """获取文本向量"""
+        """获取文本向量（优先读取向量缓存）"""
+        content_hash = get_content_hash(text)
+        cached = self.embedding_cache.get_many(self.model_name, [content_hash])
+        if content_hash in cached:
+            return cached[content_hash]
+        
+        embedding = self._compute_embedding(text)
+        self.embedding_cache.put_many(self.model_name, {content_hash: embedding})
+        return embedding
+    
+    def _compute_embedding(self, text: str) -> List[float]:
+        """计算文本向量"""
+        start = time.perf_counter()
         try:
             if self.embedding_method == "deepseek":
-                return self._get_deepseek_embedding(text)
+                embedding = self._get_deepseek_embedding(text)
             elif self.embedding_method == "sentence_transformers":
-                return self._get_sentence_transformer_embedding(text)
+                embedding = self._get_sentence_transformer_embedding(text)
             elif self.embedding_method == "openai":
-                return self._get_openai_embedding(text)
+                embedding = self._get_openai_embedding(text)
             else:
                 raise ValueError(f"不支持的 embedding 方法: {self.embedding_method}")
         except Exception as e:
             logger.error(f"获取向量失败: {e}")
             raise
+        self._record_embedding_batch(1, time.perf_counter() - start)
+        return embedding
+    
+    async def aget_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """异步批量获取文本向量，已缓存的内容跳过推理，相同内容只计算一次"""
+        if not texts:
+            return []
+        
+        hashes = [get_content_hash(text) for text in texts]
+        embeddings = await asyncio.to_thread(self.embedding_cache.get_many, self.model_name, hashes)
+        
+        # 未命中缓存的内容（按哈希去重）
+        missing = {}
+        for content_hash, text in zip(hashes, texts):
+            if content_hash not in embeddings:
+                missing.setdefault(content_hash, text)
+        
+        if missing:
+            computed = await self._acompute_embeddings(list(missing.values()))
+            new_embeddings = dict(zip(missing.keys(), computed))
+            await asyncio.to_thread(self.embedding_cache.put_many, self.model_name, new_embeddings)
+            embeddings.update(new_embeddings)
+        
+        return [embeddings[content_hash] for content_hash in hashes]
+    
+    async def _acompute_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """异步批量计算文本向量，推理和网络请求都不阻塞事件循环"""
+        start = time.perf_counter()
+        try:
+            if self.embedding_method == "sentence_transformers":
+                embeddings = await self.embedding_executor.embed(texts)
+            elif self.embedding_method in ("deepseek", "openai"):
+                embeddings = await asyncio.to_thread(self._get_api_embeddings, texts)
+            else:
+                raise ValueError(f"不支持的 embedding 方法: {self.embedding_method}")
+        except Exception as e:
+            logger.error(f"获取向量失败: {e}")
+            raise
+        self._record_embedding_batch(len(texts), time.perf_counter() - start)
+        return embeddings
+    
+    def _record_embedding_batch(self, size: int, seconds: float):
+        """记录一次向量计算的批量大小和耗时（只统计缓存未命中、实际计算的文本）"""
+        metrics.embedding_batch_size.observe(size, method=self.embedding_method)
+        metrics.embedding_duration.observe(seconds, method=self.embedding_method)
+        metrics.embedding_texts.inc(size, method=self.embedding_method)
+    
+    async def aget_embedding(self, text: str) -> List[float]:
+        """异步获取单个文本向量"""
+        embeddings = await self.aget_embeddings([text])
+        return embeddings[0]
+    
+    async def aget_query_embedding(self, query: str) -> List[float]:
+        """获取查询向量：先查内存LRU缓存，并发的相同查询只计算一次
+        
+        规范化的文本只用作缓存键，向量按调用方传入的原始查询计算
+        """
+        key = (self.model_name, normalize_query(query))
+        
+        embedding = self.query_cache.get(key)
+        if embedding is not None:
+            return embedding
+        
+        embedding = await self.query_flight.do(key, lambda: self.aget_embedding(query))
+        self.query_cache.put(key, embedding)
+        return embedding
+    
+    async def aget_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        """批量获取查询向量：内存LRU缓存未命中的查询合并为一次批量计算"""
+        keys = [(self.model_name, normalize_query(query)) for query in queries]
+        # 每个缓存键对应的原始查询（键相同时取第一个），未命中时按原始查询计算
+        originals = {}
+        for key, query in zip(keys, queries):
+            originals.setdefault(key, query)
+        embeddings = {key: self.query_cache.get(key) for key in originals}
+        
+        missing = [key for key, embedding in embeddings.items() if embedding is None]
+        if missing:
+            computed = await self.aget_embeddings([originals[key] for key in missing])
+            for key, embedding in zip(missing, computed):
+                self.query_cache.put(key, embedding)
+                embeddings[key] = embedding
+        
+        return [embeddings[key] for key in keys]
     
     def _get_deepseek_embedding(self, text: str) -> List[float]:
         """使用DeepSeek API获取文本向量"""
@@ -78,8 +281,7 @@ class VectorService:
     
     def _get_sentence_transformer_embedding(self, text: str) -> List[float]:
         """使用Sentence Transformers获取文本向量"""
-        embedding = self.sentence_model.encode(text, convert_to_tensor=False)
-        return embedding.tolist()
+        return self.embedding_executor.embed_sync([text])[0]
     
     def _get_openai_embedding(self, text: str) -> List[float]:
         """使用OpenAI API获取文本向量"""
@@ -90,14 +292,29 @@ class VectorService:
         )
         return response.data[0].embedding
     
-    def add_readme(self, repo_id: int, content: str, metadata: Dict = None) -> str:
+    def _get_api_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """使用DeepSeek/OpenAI API批量获取文本向量（一次请求）"""
+        if self.embedding_method == "deepseek":
+            client, model = self.deepseek_client, "deepseek-embedding"
+        else:
+            client, model = self.openai_client, "text-embedding-3-small"
+        
+        response = client.embeddings.create(
+            model=model,
+            input=texts,
+            encoding_format="float"
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    
+    def add_readme(self, repo_id: int, content: str, metadata: Dict = None, embedding: Optional[List[float]] = None) -> str:
         """添加README内容到向量数据库"""
         try:
             # 生成唯一ID
             embedding_id = f"repo_{repo_id}"
             
-            # 获取文本向量
-            embedding = self.get_embedding(content)
+            # 获取文本向量（调用方可以传入预先异步计算好的向量）
+            if embedding is None:
+                embedding = self.get_embedding(content)
             
             # 准备元数据
             doc_metadata = {
@@ -107,12 +324,14 @@ class VectorService:
             }
             
             # 添加到向量数据库
-            self.collection.add(
-                ids=[embedding_id],
-                embeddings=[embedding],
-                documents=[content],
-                metadatas=[doc_metadata]
-            )
+            for store in self._write_stores():
+                store.upsert(
+                    repo_ids=[repo_id],
+                    embeddings=[embedding],
+                    documents=[content],
+                    metadatas=[doc_metadata]
+                )
+                store.flush()
             
             logger.info(f"成功添加仓库 {repo_id} 的README到向量数据库")
             return embedding_id
@@ -121,91 +340,159 @@ class VectorService:
             logger.error(f"添加README到向量数据库失败: {e}")
             raise
     
-    def update_readme(self, repo_id: int, content: str, metadata: Dict = None) -> str:
+    def update_readme(self, repo_id: int, content: str, metadata: Dict = None, embedding: Optional[List[float]] = None) -> str:
         """更新README内容"""
         try:
             embedding_id = f"repo_{repo_id}"
             
-            # 先删除旧的记录
-            try:
-                self.collection.delete(ids=[embedding_id])
-            except Exception:
-                pass  # 如果不存在就忽略
-            
-            # 添加新的记录
-            return self.add_readme(repo_id, content, metadata)
+            # 覆盖写入同一ID的记录
+            self.add_readme(repo_id, content, metadata, embedding=embedding)
+            return embedding_id
             
         except Exception as e:
             logger.error(f"更新README向量失败: {e}")
             raise
     
+    def upsert_readmes(self, items: List[Dict], store: Optional[VectorStore] = None) -> List[str]:
+        """批量写入（新增或覆盖）README向量，items 中每项包含 repo_id、content、embedding、metadata
+        
+        未指定store时写入当前集合（重建期间同时写入正在构建的集合）
+        """
+        if not items:
+            return []
+        
+        try:
+            embedding_ids = [f"repo_{item['repo_id']}" for item in items]
+            
+            for target in ([store] if store is not None else self._write_stores()):
+                target.upsert(
+                    repo_ids=[item["repo_id"] for item in items],
+                    embeddings=[item["embedding"] for item in items],
+                    documents=[item["content"] for item in items],
+                    metadatas=[
+                        {
+                            "repo_id": item["repo_id"],
+                            "content_length": len(item["content"]),
+                            **(item.get("metadata") or {})
+                        }
+                        for item in items
+                    ]
+                )
+                target.flush()
+            
+            logger.info(f"成功写入 {len(items)} 个README向量")
+            return embedding_ids
+        
+        except Exception as e:
+            logger.error(f"批量写入README向量失败: {e}")
+            raise
+    
     def delete_readme(self, repo_id: int):
         """删除README向量"""
         try:
-            embedding_id = f"repo_{repo_id}"
-            self.collection.delete(ids=[embedding_id])
+            for store in self._write_stores():
+                store.delete([repo_id])
             logger.info(f"成功删除仓库 {repo_id} 的README向量")
         except Exception as e:
             logger.error(f"删除README向量失败: {e}")
             raise
     
-    def semantic_search(self, query: str, limit: int = 10) -> List[Dict]:
+    def semantic_search(
+        self,
+        query: str,
+        limit: int = 10,
+        repo_ids: Optional[List[int]] = None,
+        min_similarity: float = 0.0
+    ) -> List[Dict]:
         """语义搜索README内容"""
+        return self.search_by_embedding(self.get_embedding(query), limit, repo_ids, min_similarity)
+    
+    async def asemantic_search(
+        self,
+        query: str,
+        limit: int = 10,
+        repo_ids: Optional[List[int]] = None,
+        min_similarity: float = 0.0
+    ) -> List[Dict]:
+        """异步语义搜索：向量计算在进程池中进行，向量检索在线程中进行"""
+        query_embedding = await self.aget_query_embedding(query)
+        return await asyncio.to_thread(self.search_by_embedding, query_embedding, limit, repo_ids, min_similarity)
+    
+    async def asemantic_search_batch(
+        self,
+        queries: List[str],
+        limit: int = 10,
+        repo_ids: Optional[List[int]] = None,
+        min_similarity: float = 0.0
+    ) -> List[List[Dict]]:
+        """批量语义搜索：一次批量计算所有查询向量，一次多查询向量检索，按输入顺序返回每个查询的结果"""
+        query_embeddings = await self.aget_query_embeddings(queries)
+        return await asyncio.to_thread(self._query_store, query_embeddings, limit, repo_ids, min_similarity)
+    
+    def search_by_embedding(
+        self,
+        query_embedding: List[float],
+        limit: int = 10,
+        repo_ids: Optional[List[int]] = None,
+        min_similarity: float = 0.0
+    ) -> List[Dict]:
+        """使用已计算好的查询向量搜索README内容
+        
+        repo_ids 为候选仓库集合（结构化过滤的结果），为 None 时不限制；
+        过滤方式由向量存储决定，保证满足条件的结果足够时返回limit个
+        """
         try:
-            # 获取查询向量
-            query_embedding = self.get_embedding(query)
-            
-            # 执行向量搜索
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=limit,
-                include=["documents", "metadatas", "distances"]
-            )
-            
-            # 格式化结果
-            search_results = []
-            if results["ids"] and results["ids"][0]:
-                for i in range(len(results["ids"][0])):
-                    result = {
-                        "repo_id": results["metadatas"][0][i]["repo_id"],
-                        "content": results["documents"][0][i],
-                        "similarity_score": 1 - results["distances"][0][i],  # 转换为相似度分数
-                        "metadata": results["metadatas"][0][i]
-                    }
-                    search_results.append(result)
-            
-            return search_results
-            
+            return self._query_store([query_embedding], limit, repo_ids, min_similarity)[0]
         except Exception as e:
             logger.error(f"语义搜索失败: {e}")
             raise
     
+    def _query_store(
+        self,
+        query_embeddings: List[List[float]],
+        limit: int,
+        repo_ids: Optional[List[int]],
+        min_similarity: float
+    ) -> List[List[Dict]]:
+        """向量检索，记录检索耗时和每次检索的查询数"""
+        store = self.store
+        backend = store.__class__.__name__
+        start = time.perf_counter()
+        results = store.query(query_embeddings, limit, repo_ids, min_similarity)
+        metrics.vector_query_duration.observe(
+            time.perf_counter() - start, backend=backend, filtered="true" if repo_ids is not None else "false"
+        )
+        metrics.vector_query_batch_size.observe(len(query_embeddings), backend=backend)
+        return results
+    
     def get_collection_stats(self) -> Dict:
         """获取向量数据库统计信息"""
         try:
-            count = self.collection.count()
             return {
-                "total_documents": count,
-                "collection_name": self.collection.name
+                "total_documents": self.store.count(),
+                "collection_name": self.store.name,
+                "store": self.store.get_stats(),
+                "embedding_cache": self.embedding_cache.get_stats()
             }
         except Exception as e:
             logger.error(f"获取统计信息失败: {e}")
-            return {"total_documents": 0, "collection_name": "repo_readmes"}
+            return {"total_documents": 0, "collection_name": self._collection_name or COLLECTION_BASE_NAME}
     
     def clear_collection(self):
         """清空向量数据库"""
         try:
-            # 删除现有集合
-            self.chroma_client.delete_collection("repo_readmes")
-            # 重新创建集合
-            self.collection = self.chroma_client.get_or_create_collection(
-                name="repo_readmes",
-                metadata={"hnsw:space": "cosine"}
-            )
+            self.store.clear()
             logger.info("成功清空向量数据库")
         except Exception as e:
             logger.error(f"清空向量数据库失败: {e}")
             raise
+    
+    def shutdown(self):
+        """释放向量计算资源，并把缓冲中的向量落盘"""
+        if self._store is not None:
+            self._store.flush()
+        if self.embedding_method == "sentence_transformers":
+            self.embedding_executor.shutdown()
 
 
 # 全局向量服务实例
@@ -0,0 +1,784 @@
+import os
+import json
+import shutil
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class VectorStore(ABC):
+    """向量存储接口：以repo_id为键保存README向量，支持批量写入和批量top-k查询"""
+    
+    name: str
+    
+    @abstractmethod
+    def upsert(
+        self,
+        repo_ids: List[int],
+        embeddings: List[List[float]],
+        documents: Optional[List[str]] = None,
+        metadatas: Optional[List[Dict]] = None
+    ):
+        """批量写入（新增或覆盖）向量"""
+    
+    @abstractmethod
+    def delete(self, repo_ids: List[int]):
+        """批量删除向量"""
+    
+    @abstractmethod
+    def query(
+        self,
+        query_embeddings: List[List[float]],
+        n_results: int,
+        repo_ids: Optional[List[int]] = None,
+        min_similarity: float = 0.0
+    ) -> List[List[Dict]]:
+        """批量top-k查询，每个查询返回按相似度从高到低排列的结果
+        
+        repo_ids 为候选仓库集合，为 None 时不限制；每个结果包含 repo_id、similarity_score、content、metadata
+        """
+    
+    @abstractmethod
+    def get_embeddings(self, repo_ids: List[int]) -> Dict[int, List[float]]:
+        """读取已存储的向量"""
+    
+    @abstractmethod
+    def count(self) -> int:
+        """向量数量"""
+    
+    @abstractmethod
+    def clear(self):
+        """清空所有向量"""
+    
+    @abstractmethod
+    def drop(self):
+        """删除整个集合"""
+    
+    def flush(self):
+        """把缓冲中的写入持久化（默认无需操作）"""
+    
+    def get_stats(self) -> Dict:
+        """存储统计信息"""
+        return {"backend": self.__class__.__name__, "name": self.name, "total_documents": self.count()}
+
+
+_chroma_client = None
+
+
+def _get_chroma_client():
+    """获取（必要时创建）共享的ChromaDB客户端"""
+    global _chroma_client
+    if _chroma_client is None:
+        import chromadb
+        from chromadb.config import Settings
+        
+        _chroma_client = chromadb.PersistentClient(
+            path=os.getenv("CHROMA_DB_PATH", "./chroma_db"),
+            settings=Settings(
+                anonymized_telemetry=False,
+                allow_reset=True
+            )
+        )
+    return _chroma_client
+
+
+class ChromaVectorStore(VectorStore):
+    """基于ChromaDB集合的向量存储（HNSW近似检索，同时保存文档和元数据）"""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.client = _get_chroma_client()
+        self.collection = self.client.get_or_create_collection(
+            name=name,
+            metadata={"hnsw:space": "cosine"}
+        )
+        
+        # 候选集合不超过该数量时下推为where条件，否则按倍数扩大召回
+        self.prefilter_max = int(os.getenv("VECTOR_PREFILTER_MAX", "2000"))
+        self.overfetch_factor = int(os.getenv("VECTOR_OVERFETCH_FACTOR", "4"))
+        if self.overfetch_factor < 2:
+            # 每轮召回数量按该倍数增长，小于2时不会增长
+            raise ValueError(f"VECTOR_OVERFETCH_FACTOR 至少为2，实际为 {self.overfetch_factor}")
+    
+    def upsert(self, repo_ids, embeddings, documents=None, metadatas=None):
+        if not repo_ids:
+            return
+        self.collection.upsert(
+            ids=[f"repo_{repo_id}" for repo_id in repo_ids],
+            embeddings=embeddings,
+            documents=documents,
+            metadatas=metadatas or [{"repo_id": repo_id} for repo_id in repo_ids]
+        )
+    
+    def delete(self, repo_ids):
+        if repo_ids:
+            self.collection.delete(ids=[f"repo_{repo_id}" for repo_id in repo_ids])
+    
+    def _query(self, query_embeddings, n_results, where=None) -> List[List[Dict]]:
+        """执行一次ChromaDB查询并格式化结果"""
+        if n_results <= 0:
+            return [[] for _ in query_embeddings]
+        
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where=where,
+            include=["documents", "metadatas", "distances"]
+        )
+        
+        formatted = []
+        for q in range(len(query_embeddings)):
+            search_results = []
+            if results["ids"] and results["ids"][q]:
+                for i in range(len(results["ids"][q])):
+                    search_results.append({
+                        "repo_id": results["metadatas"][q][i]["repo_id"],
+                        "content": results["documents"][q][i],
+                        "similarity_score": 1 - results["distances"][q][i],  # 转换为相似度分数
+                        "metadata": results["metadatas"][q][i]
+                    })
+            formatted.append(search_results)
+        return formatted
+    
+    def query(self, query_embeddings, n_results, repo_ids=None, min_similarity=0.0):
+        def above_threshold(results):
+            return [result for result in results if result["similarity_score"] >= min_similarity]
+        
+        if repo_ids is None:
+            return [above_threshold(results) for results in self._query(query_embeddings, n_results)]
+        
+        if not repo_ids:
+            return [[] for _ in query_embeddings]
+        
+        if len(repo_ids) <= self.prefilter_max:
+            # 候选集合较小：直接下推为元数据过滤条件
+            where = {"repo_id": {"$in": list(repo_ids)}}
+            return [above_threshold(results) for results in self._query(query_embeddings, n_results, where)]
+        
+        # 候选集合较大：逐步扩大召回数量，直到每个查询都凑够n_results个满足条件的结果
+        return [
+            self._query_overfetch(query_embedding, n_results, set(repo_ids), min_similarity)
+            for query_embedding in query_embeddings
+        ]
+    
+    def _query_overfetch(self, query_embedding, limit, candidate_ids, min_similarity) -> List[Dict]:
+        """扩大召回数量后按候选集合过滤"""
+        total_documents = self.collection.count()
+        n_results = limit * self.overfetch_factor
+        
+        while True:
+            results = self._query([query_embedding], min(n_results, total_documents))[0]
+            matched = [
+                result for result in results
+                if result["repo_id"] in candidate_ids and result["similarity_score"] >= min_similarity
+            ]
+            
+            exhausted = n_results >= total_documents or len(results) < n_results
+            below_threshold = bool(results) and results[-1]["similarity_score"] < min_similarity
+            if len(matched) >= limit or exhausted or below_threshold:
+                return matched[:limit]
+            
+            n_results *= self.overfetch_factor
+    
+    def get_embeddings(self, repo_ids):
+        if not repo_ids:
+            return {}
+        results = self.collection.get(
+            ids=[f"repo_{repo_id}" for repo_id in repo_ids],
+            include=["embeddings", "metadatas"]
+        )
+        return {
+            metadata["repo_id"]: np.asarray(embedding, dtype=np.float32).tolist()
+            for metadata, embedding in zip(results["metadatas"], results["embeddings"])
+        }
+    
+    def count(self):
+        return self.collection.count()
+    
+    def clear(self):
+        # 删除现有集合后重新创建
+        self.client.delete_collection(self.name)
+        self.collection = self.client.get_or_create_collection(
+            name=self.name,
+            metadata={"hnsw:space": "cosine"}
+        )
+    
+    def drop(self):
+        """删除整个集合"""
+        self.client.delete_collection(self.name)
+
+
+# 支持的量化方式
+QUANTIZATION_METHODS = ("none", "int8", "binary")
+
+# 每个字节中1的位数，用于计算汉明距离
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def quantize(vectors: np.ndarray, method: str) -> Dict[str, np.ndarray]:
+    """把归一化向量编码为紧凑表示
+    
+    int8: 每行按最大绝对值缩放到[-127, 127]并保存缩放系数（体积为float32的1/4）；
+    binary: 每一维只保留符号位并按位打包（体积为float32的1/32）
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if method == "int8":
+        scale = np.abs(vectors).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        codes = np.round(vectors / scale[:, None]).astype(np.int8)
+        return {"codes": codes, "scale": scale.astype(np.float32)}
+    elif method == "binary":
+        return {"codes": np.packbits(vectors > 0, axis=1)}
+    raise ValueError(f"不支持的量化方式: {method}")
+
+
+class NumpyVectorStore(VectorStore):
+    """基于NumPy矩阵的向量存储：精确的暴力余弦检索，不保存文档副本
+    
+    向量归一化后按追加写入的段（segment）保存为 .npy 文件并以内存映射方式读取；
+    覆盖写入时旧行失效，删除记录在manifest中，段过多时自动合并。
+    多个进程可以写入同一目录：落盘、合并、删除和清空时持有目录下锁文件的 flock，并以磁盘上的manifest
+    为准分配段号；写缓冲只在本进程内，落盘前其他进程看不到。其他进程检测到manifest变化后自动重新加载。
+    
+    开启量化（int8/binary）时，每个段额外保存一份紧凑编码并常驻内存：先在编码上近似检索出
+    limit * rerank_factor 个候选，再读取磁盘上的全精度向量精确重排，全精度向量只在重排时按行读取。
+    """
+    
+    def __init__(
+        self,
+        name: str,
+        path: Optional[str] = None,
+        quantization: Optional[str] = None,
+        rerank_factor: Optional[int] = None
+    ):
+        self.name = name
+        self.path = os.path.join(path or os.getenv("VECTOR_STORE_PATH", "./vector_store"), name)
+        self.dtype = np.dtype(os.getenv("VECTOR_STORE_DTYPE", "float16"))
+        self.flush_threshold = int(os.getenv("VECTOR_STORE_FLUSH_ROWS", "1024"))
+        self.max_segments = int(os.getenv("VECTOR_STORE_MAX_SEGMENTS", "16"))
+        self.block_rows = 16384
+        
+        self.quantization = quantization or os.getenv("VECTOR_QUANTIZATION", "none")
+        if self.quantization not in QUANTIZATION_METHODS:
+            raise ValueError(f"不支持的量化方式: {self.quantization}")
+        self.rerank_factor = rerank_factor or int(os.getenv("VECTOR_RERANK_FACTOR", "10"))
+        
+        self._lock = threading.RLock()
+        os.makedirs(self.path, exist_ok=True)
+        self._load()
+    
+    # ---- 持久化 ----
+    
+    @property
+    def _manifest_path(self) -> str:
+        return os.path.join(self.path, "manifest.json")
+    
+    def _read_manifest(self) -> Dict:
+        manifest = {"dim": None, "segments": [], "deleted": {}, "next_segment": 1}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            self._manifest_mtime = os.stat(self._manifest_path).st_mtime_ns
+        else:
+            self._manifest_mtime = None
+        return manifest
+    
+    def _load(self, manifest: Optional[Dict] = None, keep_buffer: bool = False):
+        """从manifest加载所有段并重建 repo_id -> (段, 行) 索引；已打开的段直接复用
+        
+        keep_buffer=True 时保留尚未落盘的写缓冲（持有写锁时与其他进程的写入合并）
+        """
+        with self._lock:
+            manifest = manifest or self._read_manifest()
+            self._manifest_version = manifest.get("version", 0)
+            opened = {segment["name"]: segment for segment in getattr(self, "_segments", [])}
+            
+            self.dim = manifest["dim"] if manifest["dim"] is not None else (self.dim if keep_buffer else None)
+            self._next_segment = manifest["next_segment"]
+            self._deleted = {int(repo_id): seq for repo_id, seq in manifest["deleted"].items()}
+            self._segments = []
+            for segment in manifest["segments"]:
+                if segment in opened:
+                    self._segments.append({key: opened[segment][key] for key in ("name", "vectors", "ids", "codes")})
+                    continue
+                vectors = np.load(os.path.join(self.path, f"{segment}.vec.npy"), mmap_mode="r")
+                ids = np.load(os.path.join(self.path, f"{segment}.ids.npy"))
+                self._segments.append({
+                    "name": segment,
+                    "vectors": vectors,
+                    "ids": ids,
+                    "codes": self._load_codes(segment, vectors)
+                })
+            
+            if not keep_buffer:
+                self._buffer_ids: List[int] = []
+                self._buffer_vectors: List[np.ndarray] = []
+            self._rebuild_index()
+    
+    @contextmanager
+    def _write_lock(self):
+        """跨进程写锁：持有集合目录下锁文件的 flock，并重新读取manifest（段号、段列表和删除记录以磁盘为准）"""
+        with self._lock:
+            with open(os.path.join(self.path, ".lock"), "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    manifest = self._read_manifest()
+                    if manifest.get("version", 0) != self._manifest_version:
+                        logger.info(f"向量存储 {self.name} 已被其他进程更新，合并后写入")
+                        self._load(manifest, keep_buffer=True)
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    
+    def _rebuild_index(self):
+        """重建索引和每个段的有效行掩码：后写入的覆盖先写入的，删除记录晚于最后一次写入时视为已删除"""
+        self._index: Dict[int, tuple] = {}
+        for seg_idx, segment in enumerate(self._segments):
+            for row, repo_id in enumerate(segment["ids"].tolist()):
+                self._index[repo_id] = (seg_idx, row)
+        
+        for repo_id, seq in self._deleted.items():
+            location = self._index.get(repo_id)
+            if location is not None and location[0] < seq:
+                del self._index[repo_id]
+        
+        for segment in self._segments:
+            segment["live"] = np.zeros(len(segment["ids"]), dtype=bool)
+        for seg_idx, row in self._index.values():
+            self._segments[seg_idx]["live"][row] = True
+    
+    def _maybe_reload(self):
+        """其他进程更新了manifest时重新加载"""
+        try:
+            mtime = os.stat(self._manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._manifest_mtime and not self._buffer_ids:
+            logger.info(f"向量存储 {self.name} 已被其他进程更新，重新加载")
+            self._load()
+    
+    def _write_manifest(self):
+        """原子地写入manifest（调用方持有写锁），每次写入版本号加一"""
+        self._manifest_version += 1
+        manifest = {
+            "version": self._manifest_version,
+            "dim": self.dim,
+            "dtype": self.dtype.name,
+            "segments": [segment["name"] for segment in self._segments],
+            "deleted": {str(repo_id): seq for repo_id, seq in self._deleted.items()},
+            "next_segment": self._next_segment
+        }
+        tmp_path = self._manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self._manifest_path)
+        self._manifest_mtime = os.stat(self._manifest_path).st_mtime_ns
+    
+    def _codes_path(self, segment: str) -> str:
+        return os.path.join(self.path, f"{segment}.{self.quantization}.npz")
+    
+    def _load_codes(self, segment: str, vectors: np.ndarray) -> Optional[Dict[str, np.ndarray]]:
+        """读取段的量化编码（读入内存）；编码文件不存在时（如刚开启量化）从全精度向量分块生成"""
+        if self.quantization == "none":
+            return None
+        
+        codes_path = self._codes_path(segment)
+        if os.path.exists(codes_path):
+            with np.load(codes_path) as data:
+                return {key: data[key] for key in data.files}
+        
+        blocks = [
+            quantize(vectors[start:start + self.block_rows], self.quantization)
+            for start in range(0, len(vectors), self.block_rows)
+        ]
+        codes = {key: np.concatenate([block[key] for block in blocks]) for key in blocks[0]} if blocks else {}
+        np.savez(codes_path, **codes)
+        return codes
+    
+    def _write_segment(self, ids: np.ndarray, vectors: np.ndarray) -> Dict:
+        """写入一个新段文件并以内存映射方式打开"""
+        segment = f"seg_{self._next_segment:06d}"
+        self._next_segment += 1
+        np.save(os.path.join(self.path, f"{segment}.vec.npy"), vectors.astype(self.dtype))
+        np.save(os.path.join(self.path, f"{segment}.ids.npy"), ids.astype(np.int64))
+        
+        codes = None
+        if self.quantization != "none":
+            codes = quantize(vectors, self.quantization)
+            np.savez(self._codes_path(segment), **codes)
+        
+        return {
+            "name": segment,
+            "vectors": np.load(os.path.join(self.path, f"{segment}.vec.npy"), mmap_mode="r"),
+            "ids": ids.astype(np.int64),
+            "codes": codes
+        }
+    
+    def _remove_segment_files(self, names: List[str]):
+        suffixes = (".vec.npy", ".ids.npy") + tuple(
+            f".{method}.npz" for method in QUANTIZATION_METHODS if method != "none"
+        )
+        for segment in names:
+            for suffix in suffixes:
+                try:
+                    os.remove(os.path.join(self.path, f"{segment}{suffix}"))
+                except FileNotFoundError:
+                    pass
+    
+    def flush(self):
+        """把写缓冲落盘为一个新段，段过多时合并"""
+        with self._lock:
+            if not self._buffer_ids:
+                return
+            
+            with self._write_lock():
+                ids = np.asarray(self._buffer_ids, dtype=np.int64)
+                vectors = np.vstack(self._buffer_vectors)
+                self._segments.append(self._write_segment(ids, vectors))
+                self._buffer_ids = []
+                self._buffer_vectors = []
+                
+                if len(self._segments) > self.max_segments:
+                    self._compact()
+                else:
+                    self._write_manifest()
+                    self._rebuild_index()
+    
+    def _compact(self):
+        """把所有有效行合并为一个段，清除删除记录"""
+        old_names = [segment["name"] for segment in self._segments]
+        self._rebuild_index()
+        
+        ids = []
+        vectors = []
+        for segment in self._segments:
+            live = segment["live"]
+            if live.any():
+                ids.append(segment["ids"][live])
+                vectors.append(np.asarray(segment["vectors"][live]))
+        
+        self._segments = []
+        if ids:
+            self._segments.append(self._write_segment(np.concatenate(ids), np.vstack(vectors)))
+        self._deleted = {}
+        self._write_manifest()
+        self._rebuild_index()
+        self._remove_segment_files(old_names)
+        logger.info(f"向量存储 {self.name} 合并完成：{len(old_names)} 个段 -> {len(self._segments)} 个段")
+    
+    # ---- 写入 ----
+    
+    def _normalize(self, embeddings) -> np.ndarray:
+        """转换为float32矩阵并做L2归一化（余弦相似度即点积）"""
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim == 1:
+            matrix = matrix[None, :]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+    
+    def upsert(self, repo_ids, embeddings, documents=None, metadatas=None):
+        if not repo_ids:
+            return
+        
+        vectors = self._normalize(embeddings)
+        with self._lock:
+            self._maybe_reload()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"向量维度不匹配: 期望 {self.dim}，实际 {vectors.shape[1]}")
+            
+            # 同一批内重复的repo_id以最后一次为准；缓冲中已有的旧行直接替换
+            latest = {repo_id: i for i, repo_id in enumerate(repo_ids)}
+            self._drop_from_buffer(set(latest))
+            for repo_id, i in latest.items():
+                # 段中的旧行失效
+                location = self._index.pop(repo_id, None)
+                if location is not None:
+                    self._segments[location[0]]["live"][location[1]] = False
+                self._buffer_ids.append(repo_id)
+                self._buffer_vectors.append(vectors[i:i + 1])
+                self._deleted.pop(repo_id, None)
+            
+            if len(self._buffer_ids) >= self.flush_threshold:
+                self.flush()
+    
+    def _drop_from_buffer(self, repo_ids: set):
+        """从写缓冲中移除指定repo_id的行"""
+        if not self._buffer_ids or not repo_ids.intersection(self._buffer_ids):
+            return
+        kept = [(repo_id, vector) for repo_id, vector in zip(self._buffer_ids, self._buffer_vectors)
+                if repo_id not in repo_ids]
+        self._buffer_ids = [repo_id for repo_id, _ in kept]
+        self._buffer_vectors = [vector for _, vector in kept]
+    
+    def delete(self, repo_ids):
+        if not repo_ids:
+            return
+        
+        with self._write_lock():
+            self._drop_from_buffer(set(repo_ids))
+            for repo_id in repo_ids:
+                location = self._index.get(repo_id)
+                if location is not None:
+                    self._segments[location[0]]["live"][location[1]] = False
+                    del self._index[repo_id]
+                # 记录删除发生时已有的段数，之后重新写入的同一repo_id不受影响
+                self._deleted[repo_id] = len(self._segments)
+            self._write_manifest()
+    
+    def clear(self):
+        with self._write_lock():
+            old_names = [segment["name"] for segment in self._segments]
+            self._segments = []
+            self._buffer_ids = []
+            self._buffer_vectors = []
+            self._deleted = {}
+            self.dim = None
+            self._write_manifest()
+            self._rebuild_index()
+            self._remove_segment_files(old_names)
+    
+    def drop(self):
+        """删除整个存储目录"""
+        with self._lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self._segments = []
+            self._buffer_ids = []
+            self._buffer_vectors = []
+            self._index = {}
+    
+    # ---- 查询 ----
+    
+    def _snapshot(self):
+        """获取当前可查询的数据快照：(向量块, id数组, 有效行掩码, 量化编码) 列表"""
+        with self._lock:
+            self._maybe_reload()
+            parts = [
+                (segment["vectors"], segment["ids"], segment["live"].copy(), segment["codes"])
+                for segment in self._segments
+            ]
+            if self._buffer_ids:
+                buffer_vectors = np.vstack(self._buffer_vectors)
+                parts.append((
+                    buffer_vectors.astype(self.dtype),
+                    np.asarray(self._buffer_ids, dtype=np.int64),
+                    np.ones(len(self._buffer_ids), dtype=bool),
+                    quantize(buffer_vectors, self.quantization) if self.quantization != "none" else None
+                ))
+            return parts
+    
+    def _candidate_mask(self, ids: np.ndarray, live: np.ndarray, candidate_ids: Optional[np.ndarray]) -> np.ndarray:
+        """有效行且在候选集合中的行"""
+        if candidate_ids is None:
+            return live
+        return live & np.isin(ids, candidate_ids)
+    
+    def query(self, query_embeddings, n_results, repo_ids=None, min_similarity=0.0):
+        if not query_embeddings:
+            return []
+        if self.dim is None or n_results <= 0 or (repo_ids is not None and not repo_ids):
+            return [[] for _ in query_embeddings]
+        
+        queries = self._normalize(query_embeddings)  # (m, d)
+        candidate_ids = np.asarray(list(repo_ids), dtype=np.int64) if repo_ids is not None else None
+        parts = self._snapshot()
+        
+        if self.quantization == "none":
+            best_scores, best_ids = self._exact_topk(queries, parts, n_results, candidate_ids)
+        else:
+            best_scores, best_ids = self._quantized_topk(queries, parts, n_results, candidate_ids)
+        
+        return self._format_results(best_scores, best_ids, min_similarity)
+    
+    def _exact_topk(self, queries, parts, n_results, candidate_ids):
+        """在全精度向量上分块暴力检索"""
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        
+        for vectors, ids, live, _ in parts:
+            mask = self._candidate_mask(ids, live, candidate_ids)
+            if not mask.any():
+                continue
+            
+            # 分块计算，避免一次把整个段转换为float32
+            for start in range(0, len(ids), self.block_rows):
+                block_mask = mask[start:start + self.block_rows]
+                if not block_mask.any():
+                    continue
+                block = np.asarray(vectors[start:start + self.block_rows], dtype=np.float32)
+                scores = queries @ block.T  # (m, rows)
+                scores[:, ~block_mask] = -np.inf
+                block_ids = ids[start:start + self.block_rows]
+                
+                best_scores, best_ids = self._merge_topk(
+                    best_scores, best_ids, scores, np.broadcast_to(block_ids, scores.shape), n_results
+                )
+        
+        return best_scores, best_ids
+    
+    def _approximate_scores(self, queries, packed_queries, codes, start, end) -> np.ndarray:
+        """在量化编码上计算近似相似度"""
+        if self.quantization == "int8":
+            block = codes["codes"][start:end].astype(np.float32)
+            return (queries @ block.T) * codes["scale"][start:end]
+        
+        # binary: 汉明距离换算为[-1, 1]区间的近似余弦相似度
+        xor = np.bitwise_xor(packed_queries[:, None, :], codes["codes"][None, start:end, :])
+        hamming = _POPCOUNT[xor].sum(axis=2, dtype=np.int32)
+        return (1.0 - 2.0 * hamming / self.dim).astype(np.float32)
+    
+    def _quantized_topk(self, queries, parts, n_results, candidate_ids):
+        """先在量化编码上近似检索候选，再用全精度向量精确重排"""
+        n_candidates = n_results * self.rerank_factor
+        packed_queries = None
+        block_rows = self.block_rows
+        if self.quantization == "binary":
+            packed_queries = np.packbits(queries > 0, axis=1)
+            # 按位异或会产生 (查询数, 行数, 字节数) 的中间结果，按查询数缩小块大小
+            block_rows = max(256, (1 << 24) // (len(queries) * packed_queries.shape[1]))
+        
+        # 候选用 (段序号 << 32 | 行号) 标识
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_handles = np.zeros((len(queries), 0), dtype=np.int64)
+        
+        for part_idx, (_, ids, live, codes) in enumerate(parts):
+            mask = self._candidate_mask(ids, live, candidate_ids)
+            if not mask.any():
+                continue
+            
+            for start in range(0, len(ids), block_rows):
+                end = min(start + block_rows, len(ids))
+                block_mask = mask[start:end]
+                if not block_mask.any():
+                    continue
+                scores = self._approximate_scores(queries, packed_queries, codes, start, end)
+                scores[:, ~block_mask] = -np.inf
+                handles = (np.int64(part_idx) << 32) | np.arange(start, end, dtype=np.int64)
+                
+                best_scores, best_handles = self._merge_topk(
+                    best_scores, best_handles, scores, np.broadcast_to(handles, scores.shape), n_candidates
+                )
+        
+        if best_handles.shape[1] == 0:
+            return best_scores, best_handles
+        
+        # 所有查询的候选去重后，每个段只按行读取一次全精度向量
+        unique_handles, inverse = np.unique(best_handles, return_inverse=True)
+        part_indices = unique_handles >> 32
+        rows = unique_handles & 0xFFFFFFFF
+        full_vectors = np.empty((len(unique_handles), self.dim), dtype=np.float32)
+        candidate_repo_ids = np.empty(len(unique_handles), dtype=np.int64)
+        for part_idx in np.unique(part_indices):
+            selected = part_indices == part_idx
+            vectors, ids, _, _ = parts[part_idx]
+            full_vectors[selected] = np.asarray(vectors[rows[selected]], dtype=np.float32)
+            candidate_repo_ids[selected] = ids[rows[selected]]
+        
+        inverse = inverse.reshape(best_handles.shape)
+        exact_scores = np.take_along_axis(queries @ full_vectors.T, inverse, axis=1)
+        exact_scores[~np.isfinite(best_scores)] = -np.inf
+        
+        empty_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        empty_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        return self._merge_topk(empty_scores, empty_ids, exact_scores, candidate_repo_ids[inverse], n_results)
+    
+    @staticmethod
+    def _merge_topk(best_scores, best_ids, scores, ids, k):
+        """合并当前top-k和新块的得分，用argpartition保留每行最大的k个"""
+        all_scores = np.concatenate([best_scores, scores], axis=1)
+        all_ids = np.concatenate([best_ids, ids], axis=1)
+        if all_scores.shape[1] <= k:
+            return all_scores, all_ids
+        top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+        return np.take_along_axis(all_scores, top, axis=1), np.take_along_axis(all_ids, top, axis=1)
+    
+    @staticmethod
+    def _format_results(best_scores, best_ids, min_similarity) -> List[List[Dict]]:
+        """按得分从高到低格式化每个查询的结果"""
+        formatted = []
+        for scores, ids in zip(best_scores, best_ids):
+            order = np.argsort(-scores)
+            formatted.append([
+                {
+                    "repo_id": int(ids[i]),
+                    "content": None,
+                    "similarity_score": float(scores[i]),
+                    "metadata": {}
+                }
+                for i in order
+                if np.isfinite(scores[i]) and scores[i] >= min_similarity
+            ])
+        return formatted
+    
+    def get_embeddings(self, repo_ids):
+        result = {}
+        with self._lock:
+            self._maybe_reload()
+            buffer_rows = {repo_id: i for i, repo_id in enumerate(self._buffer_ids)}
+            for repo_id in repo_ids:
+                if repo_id in buffer_rows:
+                    result[repo_id] = self._buffer_vectors[buffer_rows[repo_id]][0].astype(np.float32).tolist()
+                    continue
+                location = self._index.get(repo_id)
+                if location is not None:
+                    vector = self._segments[location[0]]["vectors"][location[1]]
+                    result[repo_id] = np.asarray(vector, dtype=np.float32).tolist()
+        return result
+    
+    def count(self):
+        with self._lock:
+            self._maybe_reload()
+            return len(self._index) + len(self._buffer_ids)
+    
+    def get_stats(self) -> Dict:
+        stats = super().get_stats()
+        with self._lock:
+            full_precision_rows = sum(len(segment["ids"]) for segment in self._segments)
+            stats.update({
+                "dim": self.dim,
+                "dtype": self.dtype.name,
+                "quantization": self.quantization,
+                # 检索时常驻内存的量化编码，以及同样行数的float32向量所需内存
+                "index_memory_bytes": sum(
+                    array.nbytes
+                    for segment in self._segments if segment["codes"]
+                    for array in segment["codes"].values()
+                ),
+                "float32_memory_bytes": full_precision_rows * (self.dim or 0) * 4,
+                "segments": len(self._segments),
+                "buffered_rows": len(self._buffer_ids),
+                "disk_bytes": sum(
+                    os.path.getsize(os.path.join(self.path, file_name))
+                    for file_name in os.listdir(self.path)
+                    if file_name.endswith((".npy", ".npz"))
+                )
+            })
+        return stats
+
+
+def create_vector_store(name: str, backend: Optional[str] = None) -> VectorStore:
+    """按配置创建向量存储（VECTOR_STORE=chroma|numpy）"""
+    backend = backend or os.getenv("VECTOR_STORE", "chroma")
+    if backend == "chroma":
+        return ChromaVectorStore(name)
+    elif backend == "numpy":
+        return NumpyVectorStore(name)
+    raise ValueError(f"不支持的向量存储: {backend}")
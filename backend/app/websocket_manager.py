@@ -1,83 +1,333 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Set
 from fastapi import WebSocket
 import json
 import asyncio
+import logging
+import os
+import time
 from datetime import datetime
 
+from .shared_state import state_broker, get_worker_id
+
+logger = logging.getLogger(__name__)
+
+# 客户端发送队列满时的处理方式
+SLOW_CLIENT_POLICIES = ("disconnect", "drop_oldest")
+
+# 各进程登记WebSocket连接数的间隔秒数
+PRESENCE_INTERVAL = 5.0
+
+
+class ClientConnection:
+    """一个WebSocket客户端：有界发送队列，由独立的发送任务依次写出"""
+    
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.dropped = 0
+
 
 class WebSocketManager:
+    """WebSocket连接管理：广播只把消息放入每个客户端的发送队列，不等待任何客户端写出
+    
+    状态和进度事件经 publish 合并：每种事件只保留最新状态，按最大频率发送；
+    发送时同时发布到共享事件总线，其他进程（多个uvicorn worker、独立的worker进程）转发给各自的客户端，
+    每种事件的最新状态也保存在共享状态中
+    
+    发送队列满（客户端过慢或已失去响应）时按 WEBSOCKET_SLOW_CLIENT_POLICY 断开该客户端或丢弃其最旧的消息
+    """
+    
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        self.queue_size = int(os.getenv("WEBSOCKET_QUEUE_SIZE", "256"))
+        self.send_timeout = float(os.getenv("WEBSOCKET_SEND_TIMEOUT", "10"))
+        self.slow_client_policy = os.getenv("WEBSOCKET_SLOW_CLIENT_POLICY", "disconnect")
+        if self.slow_client_policy not in SLOW_CLIENT_POLICIES:
+            raise ValueError(f"不支持的 WEBSOCKET_SLOW_CLIENT_POLICY: {self.slow_client_policy}")
+        
+        self.evicted_clients = 0
+        self.dropped_messages = 0
+        self._closing: Set[asyncio.Task] = set()
+        
+        # 状态类事件合并：每种事件只保留最新状态，最多每秒发送 WEBSOCKET_MAX_FLUSH_RATE 次（0表示不合并）
+        self.max_flush_rate = float(os.getenv("WEBSOCKET_MAX_FLUSH_RATE", "10"))
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._last_flush = 0.0
+        self.published_events = 0
+        self.coalesced_events = 0
+        # 发布到共享事件总线在线程中执行，按顺序串行，保留最后一次发布的任务
+        self._publish_task: Optional[asyncio.Task] = None
+        
+        # 转发其他进程发布的事件
+        self.poll_interval = float(os.getenv("EVENT_BUS_POLL_INTERVAL", "0.25"))
+        self._relay_task: Optional[asyncio.Task] = None
+        self._last_event_id = 0
+        self.relayed_events = 0
+        # 其他进程登记的连接数之和，由转发循环定期更新，统计时不读取共享状态
+        self._remote_connections = 0
+    
+    @property
+    def active_connections(self) -> List[WebSocket]:
+        return list(self.clients.keys())
     
     async def connect(self, websocket: WebSocket):
-        """接受WebSocket连接"""
+        """接受WebSocket连接并启动该连接的发送任务"""
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = ClientConnection(websocket, self.queue_size)
+        client.task = asyncio.create_task(self._sender(client))
+        self.clients[websocket] = client
     
     def disconnect(self, websocket: WebSocket):
-        """断开WebSocket连接"""
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        """断开WebSocket连接（可重复调用）"""
+        client = self.clients.pop(websocket, None)
+        if client and client.task and client.task is not asyncio.current_task():
+            client.task.cancel()
     
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        """发送个人消息"""
+    async def _sender(self, client: ClientConnection):
+        """依次写出队列中的消息，写出失败或超时则移除该连接"""
         try:
-            await websocket.send_text(message)
+            while True:
+                message = await client.queue.get()
+                await asyncio.wait_for(client.websocket.send_text(message), timeout=self.send_timeout)
+                client.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"WebSocket发送失败，移除连接: {e!r}")
+            self.disconnect(client.websocket)
+            # 发送超时的连接可能仍然打开，关闭帧在后台发送
+            self._close_in_background(client.websocket, 1011)
+    
+    def _enqueue(self, client: ClientConnection, message: str):
+        """非阻塞地放入客户端发送队列"""
+        try:
+            client.queue.put_nowait(message)
+            return
+        except asyncio.QueueFull:
+            pass
+        
+        if self.slow_client_policy == "drop_oldest":
+            # 降级：丢弃最旧的消息，客户端只会错过中间状态
+            client.queue.get_nowait()
+            client.queue.put_nowait(message)
+            client.dropped += 1
+            self.dropped_messages += 1
+        else:
+            self._evict(client)
+    
+    def _evict(self, client: ClientConnection):
+        """断开过慢的客户端，关闭帧在后台发送"""
+        self.disconnect(client.websocket)
+        self.evicted_clients += 1
+        logger.warning(f"WebSocket客户端发送队列已满（{self.queue_size}），断开连接")
+        self._close_in_background(client.websocket)
+    
+    def _close_in_background(self, websocket: WebSocket, code: int = 1013):
+        """在后台任务中发送关闭帧，保留任务引用直到完成"""
+        task = asyncio.create_task(self._close(websocket, code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+    
+    async def _close(self, websocket: WebSocket, code: int = 1013):
+        try:
+            await asyncio.wait_for(websocket.close(code=code), timeout=self.send_timeout)
         except Exception:
-            # 连接已断开，移除它
-            self.disconnect(websocket)
+            pass
+    
+    async def send_personal_message(self, message: str, websocket: WebSocket):
+        """发送个人消息（放入该连接的发送队列）"""
+        client = self.clients.get(websocket)
+        if client:
+            self._enqueue(client, message)
     
     async def broadcast(self, message: Dict[str, Any]):
-        """广播消息给所有连接的客户端"""
-        if not self.active_connections:
+        """广播消息给所有连接的客户端：只序列化一次，放入每个客户端的发送队列后立即返回"""
+        if not self.clients:
             return
         
         message_str = json.dumps(message, default=str)
-        disconnected = []
+        for client in list(self.clients.values()):
+            self._enqueue(client, message_str)
+    
+    def publish(self, event_type: str, data: Dict[str, Any]):
+        """发布状态类事件：同类事件只保留最新的一条，按最大频率合并发送，不阻塞调用方"""
+        self.published_events += 1
+        message = {
+            "type": event_type,
+            # 复制当前状态，调用方之后修改状态字典不影响待发送的内容
+            "data": dict(data),
+            "timestamp": datetime.utcnow().isoformat()
+        }
+        if self._pending.pop(event_type, None) is not None:
+            self.coalesced_events += 1
+        # 重新插入到末尾，多种事件按最后一次发布的顺序发送
+        self._pending[event_type] = message
         
-        for connection in self.active_connections:
+        if self.max_flush_rate <= 0:
+            self.flush()
+            return
+        if self._flush_handle is not None:
+            return
+        
+        loop = asyncio.get_running_loop()
+        delay = self._last_flush + 1.0 / self.max_flush_rate - loop.time()
+        if delay <= 0:
+            self.flush()
+        else:
+            self._flush_handle = loop.call_later(delay, self.flush)
+    
+    def flush(self):
+        """发送所有待发送的合并事件，每条消息只序列化一次"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        
+        pending, self._pending = self._pending, {}
+        self._last_flush = asyncio.get_running_loop().time()
+        events = []
+        for event_type, message in pending.items():
+            message_str = json.dumps(message, default=str)
+            events.append((event_type, message_str))
+            for client in list(self.clients.values()):
+                self._enqueue(client, message_str)
+        
+        # 发布到共享事件总线（同时更新共享状态），其他进程的客户端也能收到；在后台线程中写入，不阻塞事件循环
+        if events:
+            self._publish_task = asyncio.create_task(self._publish_events(events, self._publish_task))
+    
+    async def _publish_events(self, events: List[tuple], previous: Optional[asyncio.Task]):
+        """等待上一次发布完成后再发布，共享状态按发送顺序更新"""
+        if previous is not None:
+            await asyncio.wait({previous})
+        try:
+            await asyncio.to_thread(state_broker.publish, get_worker_id(), events)
+        except Exception as e:
+            logger.warning(f"发布共享事件失败: {e}")
+    
+    async def drain(self):
+        """发出尚未发送的合并事件，并等待其发布到共享事件总线"""
+        if self._pending:
+            self.flush()
+        if self._publish_task is not None:
+            await asyncio.wait({self._publish_task})
+    
+    async def get_state(self, event_type: str) -> Optional[Dict[str, Any]]:
+        """读取任意进程最近一次发布的某种事件的状态（在线程中读取共享状态）"""
+        try:
+            value = await asyncio.to_thread(state_broker.get_state, event_type)
+        except Exception as e:
+            logger.warning(f"读取共享状态失败: {e}")
+            return None
+        return json.loads(value)["data"] if value else None
+    
+    async def start_relay(self):
+        """开始转发其他进程发布的事件（只转发启动之后的事件）"""
+        if not state_broker.shared or self._relay_task is not None:
+            return
+        self._last_event_id = await asyncio.to_thread(state_broker.last_event_id)
+        self._relay_task = asyncio.create_task(self._relay())
+    
+    async def stop_relay(self):
+        if self._relay_task is not None:
+            self._relay_task.cancel()
+            self._relay_task = None
+    
+    async def _relay(self):
+        """轮询共享事件总线，把其他进程的事件放入本进程客户端的发送队列（已序列化，直接转发）"""
+        worker_id = get_worker_id()
+        presence_key = f"websocket_clients:{worker_id}"
+        last_presence = 0.0
+        
+        while True:
             try:
-                await connection.send_text(message_str)
-            except Exception:
-                # 连接已断开，标记为需要移除
-                disconnected.append(connection)
+                events = await asyncio.to_thread(state_broker.poll, self._last_event_id)
+                for event_id, origin, payload in events:
+                    self._last_event_id = event_id
+                    if origin == worker_id:
+                        continue
+                    self.relayed_events += 1
+                    for client in list(self.clients.values()):
+                        self._enqueue(client, payload)
+                
+                # 定期登记本进程的连接数，同时读取其他进程登记的连接数，用于统计所有进程的连接总数
+                now = time.monotonic()
+                if now - last_presence >= PRESENCE_INTERVAL:
+                    last_presence = now
+                    await asyncio.to_thread(state_broker.set_state, presence_key, json.dumps({
+                        "connections": len(self.clients),
+                        "pid": os.getpid()
+                    }))
+                    presences = await asyncio.to_thread(
+                        state_broker.get_states, "websocket_clients:", max_age=PRESENCE_INTERVAL * 3
+                    )
+                    presences.pop(presence_key, None)
+                    self._remote_connections = sum(json.loads(value)["connections"] for value in presences.values())
+            except Exception as e:
+                logger.warning(f"转发共享事件失败: {e}")
+            
+            await asyncio.sleep(self.poll_interval)
+    
+    def get_cluster_connections(self) -> int:
+        """所有进程的WebSocket连接总数：本进程使用实时的连接数，其他进程使用转发循环最近读取的值（最多滞后 PRESENCE_INTERVAL 秒）"""
+        if not state_broker.shared:
+            return len(self.clients)
+        return len(self.clients) + self._remote_connections
+    
+    async def close_all(self):
+        """关闭所有连接（应用关闭时调用）"""
+        await self.stop_relay()
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._pending.clear()
+        if self._publish_task is not None:
+            await asyncio.wait({self._publish_task})
         
-        # 移除断开的连接
-        for connection in disconnected:
-            self.disconnect(connection)
+        clients = list(self.clients.values())
+        for client in clients:
+            self.disconnect(client.websocket)
+        await asyncio.gather(*(self._close(client.websocket, 1001) for client in clients))
     
-    async def broadcast_sync_status(self, status: Dict[str, Any]):
-        """广播同步状态更新"""
-        message = {
-            "type": "sync_status",
-            "data": status,
-            "timestamp": datetime.utcnow().isoformat()
+    def get_stats(self) -> Dict[str, Any]:
+        """连接数、排队消息数和慢客户端处理统计（只读取内存中的计数，不访问共享状态）"""
+        return {
+            "connections": len(self.clients),
+            "queued_messages": sum(client.queue.qsize() for client in self.clients.values()),
+            "max_queue_depth": max((client.queue.qsize() for client in self.clients.values()), default=0),
+            "queue_size": self.queue_size,
+            "slow_client_policy": self.slow_client_policy,
+            "evicted_clients": self.evicted_clients,
+            "dropped_messages": self.dropped_messages,
+            "max_flush_rate": self.max_flush_rate,
+            "published_events": self.published_events,
+            "coalesced_events": self.coalesced_events,
+            "relayed_events": self.relayed_events,
+            "cluster_connections": self.get_cluster_connections()
         }
-        await self.broadcast(message)
+    
+    async def broadcast_sync_status(self, status: Dict[str, Any]):
+        """广播同步状态更新（合并发送）"""
+        self.publish("sync_status", status)
     
     async def broadcast_sync_progress(self, current: int, total: int, message: str):
-        """广播同步进度"""
-        progress_data = {
-            "type": "sync_progress",
-            "data": {
-                "current": current,
-                "total": total,
-                "percentage": round((current / total) * 100, 2) if total > 0 else 0,
-                "message": message
-            },
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        await self.broadcast(progress_data)
+        """广播同步进度（合并发送）"""
+        self.publish("sync_progress", {
+            "current": current,
+            "total": total,
+            "percentage": round((current / total) * 100, 2) if total > 0 else 0,
+            "message": message
+        })
     
     async def broadcast_readme_status(self, status: Dict[str, Any]):
-        """广播README处理状态更新"""
-        message = {
-            "type": "readme_status",
-            "data": status,
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        await self.broadcast(message)
-
+        """广播README处理状态更新（合并发送）"""
+        self.publish("readme_status", status)
+    
+    async def broadcast_reindex_status(self, status: Dict[str, Any]):
+        """广播向量重建进度（合并发送）"""
+        self.publish("reindex_status", status)
 
 # 全局WebSocket管理器实例
 websocket_manager = WebSocketManager() 
\ No newline at end of file
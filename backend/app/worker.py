@@ -0,0 +1,268 @@
+"""独立的数据处理进程：运行GitHub同步、README获取和向量计算任务
+
+与API进程只共享数据库和向量存储，API进程设置 RUN_SCHEDULER_IN_API=false 后不再加载任何向量计算依赖。
+
+用法（在 backend 目录下）:
+    python -m app.worker run [--sync-interval-hours 24] [--warmup]
+    python -m app.worker sync [--username octocat]
+    python -m app.worker readmes [--max-repos 100] [--only-changed]
+    python -m app.worker reindex [--chunk-size 200]
+    python -m app.worker knn [--full]
+    python -m app.worker export [--format ndjson|csv] [--output repos.ndjson] [--query orm] [--language Python] [--starred-after 2024-01-01] [--is-fork false]
+    python -m app.worker snapshot --output backup.snap [--no-vectors]
+    python -m app.worker restore backup.snap [--no-vectors] [--refresh-knn]
+"""
+import argparse
+import asyncio
+import logging
+import signal
+import sys
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from . import schemas
+from .database import SessionLocal, create_tables
+from .export_service import EXPORT_FORMATS, iter_export_chunks
+
+logger = logging.getLogger("app.worker")
+
+# 导出的过滤条件：与 /repos/export 相同（SearchParams 中除排序和分页外的字段）
+EXPORT_FILTER_FIELDS = (
+    "query", "language", "owner", "min_stars", "max_stars",
+    "starred_after", "starred_before", "has_topics", "is_fork"
+)
+
+
+async def run_worker(args):
+    """常驻运行定时任务，直到收到SIGINT/SIGTERM"""
+    from .scheduler import task_scheduler
+    from .vector_service import vector_service
+    
+    if args.sync_interval_hours is not None:
+        task_scheduler.sync_interval_hours = args.sync_interval_hours
+    
+    if args.warmup:
+        logger.info("预热向量存储和向量模型...")
+        await asyncio.to_thread(vector_service.warmup)
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
+    
+    await task_scheduler.start()
+    logger.info(f"worker已启动，任务: {[job['id'] for job in (await task_scheduler.get_status())['jobs']]}")
+    
+    try:
+        await stop_event.wait()
+    finally:
+        await task_scheduler.stop()
+        vector_service.shutdown()
+        logger.info("worker已停止")
+
+
+async def run_sync(args):
+    """执行一次GitHub同步"""
+    from .sync_service import sync_service
+    
+    result = await sync_service.sync(args.username)
+    logger.info(f"同步完成：{result}")
+
+
+@asynccontextmanager
+async def hold_readme_lock():
+    """持有README处理锁，与API进程和其他worker中写入向量存储的README任务互斥；锁已被持有时以错误退出"""
+    from .scheduler import task_scheduler
+    
+    if not await task_scheduler.readme_lock.acquire():
+        logger.error("README处理任务正在其他进程中运行，请等待其结束后重试")
+        raise SystemExit(1)
+    try:
+        yield
+    finally:
+        await task_scheduler.readme_lock.release()
+
+
+async def run_readmes(args):
+    """执行一次README处理"""
+    from .readme_service import readme_service
+    from .vector_service import vector_service
+    
+    db = SessionLocal()
+    try:
+        async with hold_readme_lock():
+            result = await readme_service.batch_process_readmes(
+                db=db,
+                batch_size=args.batch_size,
+                max_repos=args.max_repos,
+                only_changed=args.only_changed
+            )
+        logger.info(f"README处理完成：{result}")
+    finally:
+        db.close()
+        vector_service.shutdown()
+
+
+async def run_reindex(args):
+    """用数据库中的README内容构建新版本向量集合并切换"""
+    from .reindex_service import reindex_service
+    from .vector_service import vector_service
+    
+    try:
+        result = await reindex_service.run(args.chunk_size)
+        logger.info(f"向量重建完成：{result}")
+    finally:
+        vector_service.shutdown()
+
+
+async def run_command(command, args):
+    """执行异步命令，结束前发出尚未发送的状态事件，其他进程的WebSocket客户端能看到最终状态"""
+    from .websocket_manager import websocket_manager
+    
+    try:
+        await command(args)
+    finally:
+        await websocket_manager.drain()
+
+
+def run_knn(args):
+    """刷新相似仓库近邻表"""
+    from .knn_service import knn_service
+    
+    result = knn_service.refresh(full=args.full)
+    logger.info(f"相似仓库近邻表刷新完成：{result}")
+
+
+def run_export(args):
+    """导出仓库数据到文件或标准输出（过滤条件按 SearchParams 解析，与API导出一致）"""
+    params = schemas.SearchParams(**{field: getattr(args, field) for field in EXPORT_FILTER_FIELDS})
+    filters = params.model_dump(include=set(EXPORT_FILTER_FIELDS))
+    
+    db = SessionLocal()
+    output = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    try:
+        for chunk in iter_export_chunks(db, args.format, args.chunk_size, **filters):
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        db.close()
+
+
+def run_snapshot(args):
+    """把仓库、README和向量导出为快照文件"""
+    from .snapshot_service import write_snapshot
+    
+    with open(args.output, "wb") as output:
+        counts = write_snapshot(output, chunk_size=args.chunk_size, include_vectors=not args.no_vectors)
+    logger.info(f"快照已写入 {args.output}：{counts}")
+
+
+def restore_from_file(path: str, include_vectors: bool):
+    """读取快照文件并恢复（在线程中执行）"""
+    from .snapshot_service import restore_snapshot
+    
+    with open(path, "rb") as source:
+        return restore_snapshot(source, include_vectors=include_vectors)
+
+
+async def run_restore(args):
+    """从快照文件恢复仓库、README和向量（持有README处理锁，恢复期间其他进程不处理README）"""
+    from .vector_service import vector_service
+    
+    try:
+        async with hold_readme_lock():
+            counts = await asyncio.to_thread(restore_from_file, args.path, not args.no_vectors)
+        logger.info(f"快照恢复完成：{counts}")
+        
+        # 近邻表不在快照中，未重新计算前相似仓库接口使用已存储的向量实时检索
+        if args.refresh_knn and counts["vectors"]:
+            from .knn_service import knn_service
+            await asyncio.to_thread(knn_service.refresh, True)
+    finally:
+        vector_service.shutdown()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m app.worker", description="Star Repo Search 数据处理进程")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    run_parser = subparsers.add_parser("run", help="常驻运行定时任务（README处理、可选的GitHub同步）")
+    run_parser.add_argument("--sync-interval-hours", type=int, help="GitHub同步间隔小时数，覆盖 SYNC_INTERVAL_HOURS")
+    run_parser.add_argument("--warmup", action="store_true", help="启动时预热向量模型")
+    
+    sync_parser = subparsers.add_parser("sync", help="执行一次GitHub同步")
+    sync_parser.add_argument("--username", help="GitHub用户名（默认为token对应的用户）")
+    
+    readmes_parser = subparsers.add_parser("readmes", help="执行一次README处理")
+    readmes_parser.add_argument("--max-repos", type=int, help="最多处理的仓库数")
+    readmes_parser.add_argument("--only-changed", action="store_true", help="只处理变更队列中的仓库")
+    readmes_parser.add_argument("--batch-size", type=int, default=5, help="并发请求GitHub的数量")
+    
+    reindex_parser = subparsers.add_parser("reindex", help="用数据库中的README内容构建新版本向量集合并原子切换")
+    reindex_parser.add_argument("--chunk-size", type=int, default=200)
+    
+    knn_parser = subparsers.add_parser("knn", help="刷新相似仓库近邻表（默认只重新计算有变化的部分）")
+    knn_parser.add_argument("--full", action="store_true", help="全量重建")
+    
+    export_parser = subparsers.add_parser("export", help="导出仓库数据")
+    export_parser.add_argument("--format", choices=EXPORT_FORMATS, default="ndjson")
+    export_parser.add_argument("--output", help="输出文件路径（默认标准输出）")
+    export_parser.add_argument("--chunk-size", type=int, default=500)
+    export_parser.add_argument("--query", help="关键词（与 /repos/search 的query相同）")
+    export_parser.add_argument("--language")
+    export_parser.add_argument("--owner")
+    export_parser.add_argument("--min-stars", type=int)
+    export_parser.add_argument("--max-stars", type=int)
+    export_parser.add_argument("--starred-after", help="star时间下限（YYYY-MM-DD 或 ISO 8601）")
+    export_parser.add_argument("--starred-before", help="star时间上限（YYYY-MM-DD 或 ISO 8601）")
+    export_parser.add_argument("--has-topics", choices=("true", "false"), help="是否有topics")
+    export_parser.add_argument("--is-fork", choices=("true", "false"), help="是否为fork")
+    
+    snapshot_parser = subparsers.add_parser("snapshot", help="把仓库、README和向量导出为快照文件")
+    snapshot_parser.add_argument("--output", required=True, help="快照文件路径")
+    snapshot_parser.add_argument("--chunk-size", type=int, default=5000)
+    snapshot_parser.add_argument("--no-vectors", action="store_true", help="不导出向量")
+    
+    restore_parser = subparsers.add_parser("restore", help="从快照文件恢复（已存在的仓库被覆盖）")
+    restore_parser.add_argument("path", help="快照文件路径")
+    restore_parser.add_argument("--no-vectors", action="store_true", help="不恢复向量")
+    restore_parser.add_argument("--refresh-knn", action="store_true", help="恢复后全量重建相似仓库近邻表")
+    
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # 日志输出到标准错误，导出到标准输出时不混在一起
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    
+    create_tables()
+    
+    if args.command == "export":
+        run_export(args)
+        return
+    if args.command == "knn":
+        run_knn(args)
+        return
+    if args.command == "snapshot":
+        run_snapshot(args)
+        return
+    
+    commands = {
+        "run": run_worker,
+        "sync": run_sync,
+        "readmes": run_readmes,
+        "reindex": run_reindex,
+        "restore": run_restore,
+    }
+    asyncio.run(run_command(commands[args.command], args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""同步与README处理的端到端吞吐测试：在后台线程中启动本地模拟GitHub（benchmarks.mock_github），
+把 GitHubService 指向它，离线运行完整的同步和README批处理
+
+- fetch：GitHubService.get_starred_repos 分页拉取的耗时
+- sync：sync_service.sync 拉取并写入数据库的总耗时
+- readmes：readme_service.batch_process_readmes 处理变更队列的耗时、每个仓库的请求数和成功率
+
+数据库、向量存储和缓存放在临时目录中，不会读写 .env 中的配置；README阶段按当前 EMBEDDING_METHOD 计算向量。
+模拟服务的延迟、配额和错误注入参数与 benchmarks.mock_github 相同，结果为JSON。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.bench_github_sync --rows 10000 --latency-ms 50 --concurrency 10
+    python -m benchmarks.bench_github_sync --rows 2000 --error-rate 0.02 --rate-limit 3000 --output sync.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_github import add_config_arguments, create_mock, serve_in_thread
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run(args, mock) -> Dict:
+    # 环境变量在调用前已设置，此时才导入应用模块
+    from app import crud
+    from app.database import SessionLocal, create_tables
+    from app.github_service import GitHubService
+    from app.readme_service import readme_service
+    from app.sync_service import sync_service
+    
+    create_tables()
+    results = {}
+    
+    async def fetch():
+        repos = await GitHubService().get_starred_repos(args.username)
+        return {"repos": len(repos)}
+    
+    async def sync():
+        synced = await sync_service.sync(args.username)
+        return {"repos": synced["total_processed"]}
+    
+    async def readmes():
+        db = SessionLocal()
+        try:
+            processed = await readme_service.batch_process_readmes(
+                db, batch_size=args.concurrency, max_repos=args.readme_limit, only_changed=True
+            )
+            return {**processed, "repos": processed["total"], "database_repos": crud.get_repo_stats(db)["total_repos"]}
+        finally:
+            db.close()
+    
+    phases = [("fetch", fetch), ("sync", sync)]
+    if not args.skip_readmes:
+        phases.append(("readmes", readmes))
+    
+    for name, phase in phases:
+        # 注入的错误会让阶段失败（同步不重试），记录错误后继续下一阶段
+        start = time.perf_counter()
+        try:
+            result = await phase()
+        except Exception as e:
+            result = {"repos": 0, "error": f"{type(e).__name__}: {e}"}
+        seconds = time.perf_counter() - start
+        stats = mock.take_stats()
+        results[name] = {
+            **result,
+            "seconds": round(seconds, 3),
+            "repos_per_second": round(result["repos"] / seconds, 1) if seconds else None,
+            "requests_per_repo": round(stats["requests"] / result["repos"], 2) if result["repos"] else None,
+            "mock": stats,
+        }
+    
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同步与README处理的端到端吞吐测试（本地模拟GitHub）")
+    add_config_arguments(parser)
+    parser.add_argument("--concurrency", type=int, default=10, help="README处理的并发请求数（batch_size）")
+    parser.add_argument("--readme-limit", type=int, help="最多处理的README数")
+    parser.add_argument("--skip-readmes", action="store_true", help="只测试同步")
+    parser.add_argument("--output", help="结果JSON的输出路径（默认打印到标准输出）")
+    args = parser.parse_args()
+    
+    mock = create_mock(args)
+    port = free_port()
+    
+    with tempfile.TemporaryDirectory(prefix="bench_github_sync_") as workdir, serve_in_thread(mock, port=port) as url:
+        os.environ.update({
+            "GITHUB_API_URL": url,
+            "GITHUB_TOKEN": "mock-token",
+            "README_FETCH_DELAY_SECONDS": "0",
+            "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+            "VECTOR_STORE_PATH": os.path.join(workdir, "vector_store"),
+            "CHROMA_DB_PATH": os.path.join(workdir, "chroma"),
+            "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache.db"),
+            "STATE_BROKER": "memory",
+            "RUN_SCHEDULER_IN_API": "false",
+        })
+        results = asyncio.run(run(args, mock))
+    
+    report = {
+        "benchmark": "github_sync",
+        "created_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "rows": len(mock.fixture["starred"]),
+            "readmes": len(mock.readmes),
+            "seed": args.seed,
+            "latency_ms": args.latency_ms,
+            "latency_jitter_ms": args.latency_jitter_ms,
+            "rate_limit": args.rate_limit,
+            "error_rate": args.error_rate,
+            "secondary_rate_limit_rate": args.secondary_rate_limit_rate,
+            "concurrency": args.concurrency,
+            "embedding_method": os.getenv("EMBEDDING_METHOD", "sentence_transformers"),
+        },
+        "results": results,
+    }
+    
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""搜索与写入基准测试：在合成数据集（benchmarks.synthetic）上测量
+
+- `crud.bulk_upsert_starred_repos_fast` 的插入和更新吞吐
+- `crud.search_repos` 在不同过滤条件、排序和分页组合下的延迟
+- `crud.get_repo_stats` 的延迟
+- 语义搜索（单查询、带过滤条件、批量）的端到端延迟
+
+每个规模在独立的子进程和临时目录中运行（数据库、向量存储和缓存互不影响）。结果为JSON，附带git提交、
+Python版本和平台信息；指定 --baseline 时与之前保存的结果比较，p50延迟或吞吐变差超过阈值的指标列在
+regressions 中并以非零状态退出。
+
+语义搜索使用合成向量，查询向量预先放入查询向量缓存，测得的延迟不含模型推理（取决于 EMBEDDING_METHOD），
+包括候选过滤、向量检索和仓库信息查询。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.bench_search --scales 1000 10000 100000 --output results.json
+    python -m benchmarks.bench_search --scales 10000 --baseline results.json --threshold 0.2
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_vector_store import make_vectors
+from benchmarks.synthetic import generate_repos, iter_readme_rows, insert_readmes
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# crud.search_repos 的测试组合：(名称, 参数)
+SEARCH_CASES = [
+    ("default", {}),
+    ("sort_stars_desc", {"sort_by": "stargazers_count"}),
+    ("sort_name_asc", {"sort_by": "name", "sort_order": "asc"}),
+    ("sort_updated_desc", {"sort_by": "updated_at"}),
+    ("deep_page", {"page": 50}),
+    ("query", {"query": "vector"}),
+    ("query_relevance", {"query": "vector", "sort_by": "relevance"}),
+    ("query_topic", {"query": "kubernetes", "sort_by": "stargazers_count"}),
+    ("query_no_match", {"query": "no-such-repository"}),
+    ("language", {"language": "Python"}),
+    ("language_min_stars", {"language": "Rust", "min_stars": 1000, "sort_by": "stargazers_count"}),
+    ("owner", {"owner": "fast-0"}),
+    ("starred_range", {"starred_after": "2020-01-01", "starred_before": "2022-12-31"}),
+    ("topics_not_fork", {"has_topics": True, "is_fork": False}),
+    ("combined", {"query": "cli", "language": "Go", "min_stars": 10, "has_topics": True, "sort_by": "stargazers_count"}),
+]
+
+# 与基准比较的指标（其余指标只记录不比较）：延迟越低越好，吞吐越高越好
+LOWER_IS_BETTER_SUFFIXES = ("p50_ms", "ms_per_query")
+HIGHER_IS_BETTER_SUFFIXES = ("rows_per_second",)
+
+
+def measure(fn: Callable, repeat: int, warmup: int = 2) -> Dict:
+    """重复执行fn，返回延迟分位数（毫秒）"""
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "mean_ms": round(float(np.mean(latencies)), 3),
+    }
+
+
+async def ameasure(fn: Callable, repeat: int, warmup: int = 2) -> Dict:
+    """measure 的异步版本，fn返回协程"""
+    for _ in range(warmup):
+        await fn()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "mean_ms": round(float(np.mean(latencies)), 3),
+    }
+
+
+def bench_ingest(db, repos: List[Dict], args) -> Dict:
+    """批量插入和更新的吞吐（pydantic对象的构造不计入）"""
+    from app import crud, schemas
+    
+    creates = [schemas.StarredRepoCreate(**repo) for repo in repos]
+    start = time.perf_counter()
+    crud.bulk_upsert_starred_repos_fast(db, creates)
+    insert_seconds = time.perf_counter() - start
+    
+    # 再次同步时大部分仓库只有star数等字段变化
+    updates = [
+        repo.model_copy(update={"stargazers_count": repo.stargazers_count + 1}) for repo in creates
+    ]
+    start = time.perf_counter()
+    crud.bulk_upsert_starred_repos_fast(db, updates)
+    update_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    readmes = insert_readmes(db, iter_readme_rows(repos, args.seed, args.readme_ratio))
+    readme_seconds = time.perf_counter() - start
+    
+    return {
+        "insert_seconds": round(insert_seconds, 3),
+        "insert_rows_per_second": round(len(repos) / insert_seconds, 1),
+        "update_seconds": round(update_seconds, 3),
+        "update_rows_per_second": round(len(repos) / update_seconds, 1),
+        "readmes": readmes,
+        "readme_seconds": round(readme_seconds, 3),
+    }
+
+
+def bench_queries(db, args) -> Dict:
+    """search_repos 各组合和 get_repo_stats 的延迟"""
+    from app import crud
+    
+    search = {}
+    for name, params in SEARCH_CASES:
+        _, total = crud.search_repos(db, **params)
+        search[name] = {"total": total, **measure(lambda: crud.search_repos(db, **params), args.repeat)}
+    
+    return {
+        "search_repos": search,
+        "get_repo_stats": measure(lambda: crud.get_repo_stats(db), args.repeat),
+    }
+
+
+async def bench_semantic(db, args) -> Dict:
+    """写入合成向量，测量语义搜索的端到端延迟（查询向量已缓存，不含模型推理）"""
+    from app import schemas
+    from app.database import RepoReadme
+    from app.query_cache import normalize_query
+    from app.search_service import search_service
+    from app.vector_service import vector_service
+    
+    repo_ids = [row[0] for row in db.query(RepoReadme.repo_id).order_by(RepoReadme.repo_id).all()]
+    vectors = make_vectors(len(repo_ids), args.dim, seed=args.seed)
+    
+    start = time.perf_counter()
+    for i in range(0, len(repo_ids), 1000):
+        vector_service.upsert_readmes([
+            {"repo_id": repo_id, "content": "", "embedding": vector.tolist()}
+            for repo_id, vector in zip(repo_ids[i:i + 1000], vectors[i:i + 1000])
+        ])
+    upsert_seconds = time.perf_counter() - start
+    
+    queries = [f"benchmark query {i}" for i in range(args.queries)]
+    for query, vector in zip(queries, make_vectors(len(queries), args.dim, seed=args.seed + 1)):
+        vector_service.query_cache.put((vector_service.model_name, normalize_query(query)), vector.tolist())
+    
+    def request(**filters):
+        index = itertools.count()
+        return lambda: search_service.semantic_search(schemas.SemanticSearchRequest(
+            query=queries[next(index) % len(queries)], limit=args.k, min_similarity=0.0, **filters
+        ))
+    
+    batch = schemas.BatchSemanticSearchRequest(queries=queries, limit=args.k, min_similarity=0.0)
+    batch_latency = await ameasure(lambda: search_service.batch_semantic_search(batch), max(3, args.repeat // 5))
+    
+    return {
+        "vectors": len(repo_ids),
+        "dim": args.dim,
+        "vector_upsert_rows_per_second": round(len(repo_ids) / upsert_seconds, 1),
+        "single": await ameasure(request(), args.repeat),
+        "filtered_language": await ameasure(request(language="Python"), args.repeat),
+        "filtered_stars": await ameasure(request(min_stars=1000), args.repeat),
+        "batch_ms_per_query": round(batch_latency["p50_ms"] / len(queries), 3),
+    }
+
+
+def run_scale(rows: int, args) -> Dict:
+    """在当前进程中运行一个规模的全部测试（环境变量必须在导入app之前设置好）"""
+    from app.database import SessionLocal, create_tables
+    
+    create_tables()
+    repos = generate_repos(rows, seed=args.seed)
+    db = SessionLocal()
+    try:
+        result = {"rows": rows, "ingest": bench_ingest(db, repos, args)}
+        result.update(bench_queries(db, args))
+        if not args.skip_semantic:
+            result["semantic_search"] = asyncio.run(bench_semantic(db, args))
+        return result
+    finally:
+        db.close()
+
+
+def flatten(report: Dict, prefix: str = "") -> Dict[str, float]:
+    """把嵌套结果展开为 "a.b.c": 数值"""
+    flat = {}
+    for key, value in report.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(report: Dict, baseline: Dict, threshold: float) -> List[Dict]:
+    """与基准结果比较，返回变差超过threshold（比例）的指标"""
+    current = flatten(report["scales"])
+    previous = flatten(baseline.get("scales", {}))
+    regressions = []
+    for name, value in current.items():
+        old = previous.get(name)
+        if not old or not value:
+            continue
+        if name.endswith(LOWER_IS_BETTER_SUFFIXES):
+            change = value / old - 1
+        elif name.endswith(HIGHER_IS_BETTER_SUFFIXES):
+            change = old / value - 1
+        else:
+            continue
+        if change > threshold:
+            regressions.append({"metric": name, "baseline": old, "current": value, "change": round(change, 4)})
+    return regressions
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def run_child(rows: int, args, workdir: str) -> Dict:
+    """在子进程中运行一个规模，数据库、向量存储和缓存放在独立的临时目录"""
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "VECTOR_STORE": args.vector_store,
+        "VECTOR_STORE_PATH": os.path.join(workdir, "vector_store"),
+        "CHROMA_DB_PATH": os.path.join(workdir, "chroma"),
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache.db"),
+        "STATE_BROKER": "memory",
+        "QUERY_CACHE_SIZE": str(max(1024, args.queries * 2)),
+    })
+    output = os.path.join(workdir, "result.json")
+    command = [
+        sys.executable, "-m", "benchmarks.bench_search", "--rows", str(rows), "--output", output,
+        "--seed", str(args.seed), "--readme-ratio", str(args.readme_ratio), "--repeat", str(args.repeat),
+        "--queries", str(args.queries), "--dim", str(args.dim), "--k", str(args.k),
+    ]
+    if args.skip_semantic:
+        command.append("--skip-semantic")
+    subprocess.run(command, cwd=BACKEND_DIR, env=env, check=True)
+    with open(output, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="搜索与写入基准测试")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000], help="测试的仓库数")
+    parser.add_argument("--rows", type=int, help="只在当前进程中运行这一个规模（由 --scales 的子进程使用）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--readme-ratio", type=float, default=0.8, help="有README的仓库比例")
+    parser.add_argument("--repeat", type=int, default=20, help="每个查询重复的次数")
+    parser.add_argument("--queries", type=int, default=50, help="语义搜索的查询数")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--vector-store", default="numpy", choices=["numpy", "chroma"])
+    parser.add_argument("--skip-semantic", action="store_true", help="不测试语义搜索")
+    parser.add_argument("--baseline", help="之前保存的结果JSON，用于检测性能回退")
+    parser.add_argument("--threshold", type=float, default=0.2, help="判定回退的变化比例")
+    parser.add_argument("--output", help="结果JSON的输出路径（默认打印到标准输出）")
+    args = parser.parse_args()
+    
+    if args.rows:
+        result = run_scale(args.rows, args)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+    
+    report = {
+        "benchmark": "search",
+        "created_at": datetime.utcnow().isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "seed": args.seed,
+            "readme_ratio": args.readme_ratio,
+            "repeat": args.repeat,
+            "queries": args.queries,
+            "dim": args.dim,
+            "k": args.k,
+            "vector_store": args.vector_store,
+        },
+        "scales": {}
+    }
+    
+    for rows in args.scales:
+        workdir = tempfile.mkdtemp(prefix=f"bench_search_{rows}_")
+        try:
+            report["scales"][str(rows)] = run_child(rows, args, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        report["baseline_commit"] = baseline.get("git_commit")
+        report["regressions"] = compare(report, baseline, args.threshold)
+        exit_code = 1 if report["regressions"] else 0
+    
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
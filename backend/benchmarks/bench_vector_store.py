@@ -0,0 +1,159 @@
+"""向量存储基准测试：比较 ChromaDB 与内存映射 NumPy 存储（含int8/binary量化）
+
+在合成的归一化向量上测量构建耗时、单查询/批量查询延迟、磁盘占用、检索索引常驻内存和 recall@k
+（以float32精确暴力检索为基准）。未安装chromadb时跳过Chroma部分。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.bench_vector_store --rows 10000 --dim 384 --queries 100
+    python -m benchmarks.bench_vector_store --quantization none int8 binary --rerank-factor 10
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import importlib.util
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_vectors(rows: int, dim: int, seed: int = 42) -> np.ndarray:
+    """生成带簇结构的归一化向量（比均匀随机向量更接近真实文本向量分布）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, rows // 100), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), rows)] + 0.5 * rng.standard_normal((rows, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact_topk(vectors: np.ndarray, ids: np.ndarray, queries: np.ndarray, k: int) -> List[set]:
+    """float32暴力检索的top-k结果，作为recall的基准"""
+    scores = queries @ vectors.T
+    top = np.argpartition(-scores, min(k, len(ids) - 1), axis=1)[:, :k]
+    return [set(ids[row].tolist()) for row in top]
+
+
+def dir_size(path: str) -> int:
+    """目录占用的字节数"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            total += os.path.getsize(os.path.join(root, file_name))
+    return total
+
+
+def bench_store(store, vectors: np.ndarray, ids: np.ndarray, queries: np.ndarray, k: int,
+                truth: List[set], data_dir: str, batch_size: int = 1000) -> Dict:
+    """对一个向量存储执行写入和查询测试"""
+    start = time.perf_counter()
+    for i in range(0, len(ids), batch_size):
+        store.upsert(ids[i:i + batch_size].tolist(), vectors[i:i + batch_size].tolist())
+    store.flush()
+    build_seconds = time.perf_counter() - start
+    
+    # 单查询延迟
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(store.query([query.tolist()], k)[0])
+        latencies.append((time.perf_counter() - start) * 1000)
+    
+    # 批量查询（一次调用处理全部查询）
+    start = time.perf_counter()
+    store.query(queries.tolist(), k)
+    batch_ms = (time.perf_counter() - start) * 1000
+    
+    # 带候选集合（结构化过滤）的查询
+    candidates = ids[::10].tolist()
+    start = time.perf_counter()
+    for query in queries[:20]:
+        store.query([query.tolist()], k, repo_ids=candidates)
+    filtered_ms = (time.perf_counter() - start) * 1000 / min(20, len(queries))
+    
+    recall = np.mean([
+        len({hit["repo_id"] for hit in hits} & expected) / len(expected)
+        for hits, expected in zip(results, truth)
+    ])
+    
+    result = {
+        "build_seconds": round(build_seconds, 3),
+        "query_p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "query_p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "batch_query_ms_per_query": round(batch_ms / len(queries), 3),
+        "filtered_query_ms": round(filtered_ms, 3),
+        f"recall@{k}": round(float(recall), 4),
+        "disk_bytes": dir_size(data_dir),
+    }
+    
+    stats = store.get_stats()
+    if "index_memory_bytes" in stats:
+        # 量化编码常驻内存；未量化时检索需要读入全部全精度向量
+        memory = stats["index_memory_bytes"] or stats["float32_memory_bytes"]
+        result["index_memory_bytes"] = memory
+        result["memory_saved_ratio"] = round(1 - memory / stats["float32_memory_bytes"], 4)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量存储基准测试")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--quantization", nargs="+", default=["none", "int8", "binary"],
+                        help="NumPy存储要测试的量化方式")
+    parser.add_argument("--rerank-factor", type=int, default=10, help="量化检索时精确重排的候选倍数")
+    parser.add_argument("--output", help="结果JSON的输出路径（默认打印到标准输出）")
+    args = parser.parse_args()
+    
+    vectors = make_vectors(args.rows, args.dim)
+    ids = np.arange(1, args.rows + 1, dtype=np.int64)
+    queries = make_vectors(args.queries, args.dim, seed=7)
+    truth = exact_topk(vectors, ids, queries, args.k)
+    
+    report = {
+        "rows": args.rows,
+        "dim": args.dim,
+        "queries": args.queries,
+        "k": args.k,
+        "raw_float32_bytes": int(vectors.nbytes),
+        "stores": {}
+    }
+    
+    workdir = tempfile.mkdtemp(prefix="bench_vector_store_")
+    try:
+        # 存储路径在导入前通过环境变量指定
+        os.environ["VECTOR_STORE_PATH"] = os.path.join(workdir, "numpy")
+        os.environ["CHROMA_DB_PATH"] = os.path.join(workdir, "chroma")
+        from app.vector_store import ChromaVectorStore, NumpyVectorStore
+        
+        for method in args.quantization:
+            store = NumpyVectorStore(f"bench_{method}", quantization=method, rerank_factor=args.rerank_factor)
+            report["stores"][f"numpy_{method}"] = bench_store(
+                store, vectors, ids, queries, args.k, truth, store.path
+            )
+        
+        if importlib.util.find_spec("chromadb") is None:
+            report["stores"]["chroma"] = {"skipped": "chromadb 未安装"}
+        else:
+            store = ChromaVectorStore("bench")
+            report["stores"]["chroma"] = bench_store(
+                store, vectors, ids, queries, args.k, truth, os.environ["CHROMA_DB_PATH"]
+            )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
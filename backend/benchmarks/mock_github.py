@@ -0,0 +1,376 @@
+"""本地模拟的GitHub API：用固定的数据集离线、可重复地测试同步和README处理
+
+提供同步和README处理用到的接口，响应格式与GitHub一致：
+    GET /user
+    GET /users/{username}/starred          分页，带Link头；Accept包含star+json时返回starred_at
+    GET /rate_limit                        不消耗配额
+    GET /repos/{owner}/{repo}/contents/{path}
+    GET /repos/{owner}/{repo}/readme
+以及测试用的 GET /_mock/stats（请求统计）和 POST /_mock/reset（清零统计和配额）。
+
+每个响应都带 X-RateLimit-* 头，配额用完后返回403；可以配置固定延迟和抖动、按比例注入5xx错误和二级限流（403 + Retry-After）。
+数据集默认由 benchmarks.synthetic 生成，也可以用 --fixture 读取保存的JSON。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.mock_github --rows 10000 --port 8765 --latency-ms 50 --error-rate 0.01
+    GITHUB_API_URL=http://127.0.0.1:8765 GITHUB_TOKEN=mock python -m app.worker sync
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate_repos, iter_readme_rows
+
+# 不计入配额、不注入错误和延迟的路径
+UNMETERED_PATHS = ("/rate_limit", "/_mock/")
+
+# README文件名及其占比：大部分仓库使用README.md，其余需要逐个尝试文件名才能找到
+README_FILENAMES = [("README.md", 0.85), ("readme.md", 0.07), ("README.rst", 0.05), ("README", 0.03)]
+
+
+def _timestamp(value) -> str:
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ") if value else None
+
+
+def build_fixture(rows: int, seed: int = 42, readme_ratio: float = 0.8, username: str = "octocat") -> Dict:
+    """用合成数据生成GitHub格式的数据集：{"user": ..., "starred": [...], "readmes": {full_name: {文件名: 内容}}}"""
+    repos = generate_repos(rows, seed=seed)
+    rng = random.Random(seed)
+    
+    starred = []
+    for repo in repos:
+        starred.append({
+            "starred_at": _timestamp(repo["starred_at"]),
+            "repo": {
+                "id": repo["repo_id"],
+                "name": repo["name"],
+                "full_name": repo["full_name"],
+                "owner": {"login": repo["owner_login"], "avatar_url": repo["owner_avatar_url"]},
+                "private": repo["is_private"],
+                "fork": repo["is_fork"],
+                "description": repo["description"],
+                "html_url": repo["html_url"],
+                "clone_url": repo["clone_url"],
+                "ssh_url": repo["ssh_url"],
+                "language": repo["language"],
+                "stargazers_count": repo["stargazers_count"],
+                "forks_count": repo["forks_count"],
+                "open_issues_count": repo["open_issues_count"],
+                "topics": json.loads(repo["topics"]),
+                "created_at": _timestamp(repo["created_at"]),
+                "updated_at": _timestamp(repo["updated_at"]),
+                "pushed_at": _timestamp(repo["pushed_at"]),
+                "size": repo["size"],
+                "default_branch": repo["default_branch"],
+                "license": {"key": repo["license_key"], "name": repo["license_name"]} if repo["license_key"] else None,
+            }
+        })
+    # GitHub按star时间从新到旧返回
+    starred.sort(key=lambda item: item["starred_at"], reverse=True)
+    
+    full_names = {repo["repo_id"]: repo["full_name"] for repo in repos}
+    names, weights = zip(*README_FILENAMES)
+    readmes = {
+        full_names[row["repo_id"]]: {rng.choices(names, weights)[0]: row["content"]}
+        for row in iter_readme_rows(repos, seed, readme_ratio)
+    }
+    
+    return {
+        "user": {"login": username, "id": 1, "type": "User", "name": username.title()},
+        "starred": starred,
+        "readmes": readmes,
+    }
+
+
+class MockConfig:
+    """模拟服务的行为配置"""
+    
+    def __init__(
+        self,
+        latency_ms: float = 0.0,
+        latency_jitter_ms: float = 0.0,
+        rate_limit: int = 5000,
+        rate_limit_window: float = 3600.0,
+        error_rate: float = 0.0,
+        error_statuses: List[int] = None,
+        secondary_rate_limit_rate: float = 0.0,
+        require_auth: bool = True,
+        seed: Optional[int] = None,
+    ):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses or [500, 502, 503]
+        self.secondary_rate_limit_rate = secondary_rate_limit_rate
+        self.require_auth = require_auth
+        self.seed = seed
+
+
+class MockGitHub:
+    """模拟服务的数据集、配额和统计"""
+    
+    def __init__(self, fixture: Dict, config: Optional[MockConfig] = None):
+        self.fixture = fixture
+        self.config = config or MockConfig()
+        self.repos = {item["repo"]["full_name"].lower(): item["repo"] for item in fixture["starred"]}
+        self.readmes = {full_name.lower(): files for full_name, files in fixture["readmes"].items()}
+        self._random = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """清零统计并开始新的配额窗口"""
+        with self._lock:
+            self.window_start = time.time()
+            self.used = 0
+        self.take_stats()
+    
+    def take_stats(self) -> Dict:
+        """取出并清零请求统计（配额不变）"""
+        with self._lock:
+            stats = getattr(self, "stats", None)
+            self.stats = {"requests": 0, "by_endpoint": {}, "injected_errors": 0, "secondary_rate_limited": 0, "rate_limited": 0}
+        return stats
+    
+    def _rate_limit_headers(self) -> Dict[str, str]:
+        reset_at = int(self.window_start + self.config.rate_limit_window)
+        return {
+            "X-RateLimit-Limit": str(self.config.rate_limit),
+            "X-RateLimit-Remaining": str(max(0, self.config.rate_limit - self.used)),
+            "X-RateLimit-Reset": str(reset_at),
+            "X-RateLimit-Used": str(self.used),
+            "X-RateLimit-Resource": "core",
+        }
+    
+    def _consume(self, endpoint: str) -> Optional[JSONResponse]:
+        """计入一次请求，配额用完或注入错误时返回错误响应"""
+        with self._lock:
+            if time.time() >= self.window_start + self.config.rate_limit_window:
+                self.window_start = time.time()
+                self.used = 0
+            
+            self.stats["requests"] += 1
+            self.stats["by_endpoint"][endpoint] = self.stats["by_endpoint"].get(endpoint, 0) + 1
+            
+            if self.used >= self.config.rate_limit:
+                self.stats["rate_limited"] += 1
+                return JSONResponse(
+                    {"message": "API rate limit exceeded for user.", "documentation_url": "https://docs.github.com/rest"},
+                    status_code=403, headers=self._rate_limit_headers()
+                )
+            self.used += 1
+            
+            roll = self._random.random()
+            if roll < self.config.secondary_rate_limit_rate:
+                self.stats["secondary_rate_limited"] += 1
+                return JSONResponse(
+                    {"message": "You have exceeded a secondary rate limit."},
+                    status_code=403, headers={**self._rate_limit_headers(), "Retry-After": "60"}
+                )
+            if roll < self.config.secondary_rate_limit_rate + self.config.error_rate:
+                self.stats["injected_errors"] += 1
+                return JSONResponse(
+                    {"message": "Server Error"},
+                    status_code=self._random.choice(self.config.error_statuses), headers=self._rate_limit_headers()
+                )
+        return None
+    
+    def _latency(self) -> float:
+        jitter = self._random.uniform(-self.config.latency_jitter_ms, self.config.latency_jitter_ms)
+        return max(0.0, self.config.latency_ms + jitter) / 1000
+    
+    def _starred_page(self, request: Request, username: str, page: int, per_page: int) -> JSONResponse:
+        per_page = max(1, min(per_page, 100))
+        page = max(1, page)
+        items = self.fixture["starred"]
+        last_page = max(1, (len(items) + per_page - 1) // per_page)
+        chunk = items[(page - 1) * per_page:page * per_page]
+        
+        # Accept 包含 star+json 时返回 {"starred_at", "repo"}，否则只返回仓库
+        if "star+json" not in request.headers.get("accept", ""):
+            chunk = [item["repo"] for item in chunk]
+        
+        url = f"{str(request.base_url).rstrip('/')}/users/{username}/starred?per_page={per_page}&page="
+        links = []
+        if page < last_page:
+            links.append(f'<{url}{page + 1}>; rel="next"')
+            links.append(f'<{url}{last_page}>; rel="last"')
+        if page > 1:
+            links.append(f'<{url}1>; rel="first"')
+            links.append(f'<{url}{page - 1}>; rel="prev"')
+        
+        headers = self._rate_limit_headers()
+        if links:
+            headers["Link"] = ", ".join(links)
+        return JSONResponse(chunk, headers=headers)
+    
+    def _file(self, owner: str, repo: str, path: Optional[str]) -> JSONResponse:
+        """仓库文件内容（base64，与GitHub一样每76个字符换行）；path为None时返回仓库的README"""
+        full_name = f"{owner}/{repo}".lower()
+        if full_name not in self.repos:
+            return JSONResponse({"message": "Not Found"}, status_code=404, headers=self._rate_limit_headers())
+        
+        files = self.readmes.get(full_name, {})
+        if path is None:
+            path = next(iter(files), None)
+        if path not in files:
+            return JSONResponse({"message": "Not Found"}, status_code=404, headers=self._rate_limit_headers())
+        
+        content = files[path].encode("utf-8")
+        return JSONResponse({
+            "type": "file",
+            "encoding": "base64",
+            "name": path.rsplit("/", 1)[-1],
+            "path": path,
+            "size": len(content),
+            "content": base64.encodebytes(content).decode("ascii"),
+        }, headers=self._rate_limit_headers())
+    
+    def create_app(self) -> FastAPI:
+        app = FastAPI(title="Mock GitHub API")
+        
+        @app.middleware("http")
+        async def github_behaviour(request: Request, call_next):
+            path = request.url.path
+            if path.startswith(UNMETERED_PATHS):
+                return await call_next(request)
+            
+            await asyncio.sleep(self._latency())
+            if self.config.require_auth and not request.headers.get("authorization"):
+                return JSONResponse({"message": "Requires authentication"}, status_code=401)
+            
+            endpoint = path.split("/")[1] if path.count("/") > 1 else path.strip("/")
+            if path.startswith("/repos/"):
+                endpoint = "readme" if path.endswith("/readme") else "contents"
+            error = self._consume(endpoint)
+            return error if error is not None else await call_next(request)
+        
+        @app.get("/user")
+        async def get_user():
+            return JSONResponse(self.fixture["user"], headers=self._rate_limit_headers())
+        
+        @app.get("/users/{username}/starred")
+        async def get_starred(request: Request, username: str, page: int = 1, per_page: int = 30):
+            if username.lower() != self.fixture["user"]["login"].lower():
+                return JSONResponse({"message": "Not Found"}, status_code=404, headers=self._rate_limit_headers())
+            return self._starred_page(request, username, page, per_page)
+        
+        @app.get("/rate_limit")
+        async def get_rate_limit():
+            core = {
+                "limit": self.config.rate_limit,
+                "remaining": max(0, self.config.rate_limit - self.used),
+                "reset": int(self.window_start + self.config.rate_limit_window),
+                "used": self.used,
+                "resource": "core",
+            }
+            return JSONResponse({"resources": {"core": core}, "rate": core}, headers=self._rate_limit_headers())
+        
+        @app.get("/repos/{owner}/{repo}/readme")
+        async def get_readme(owner: str, repo: str):
+            return self._file(owner, repo, None)
+        
+        @app.get("/repos/{owner}/{repo}/contents/{path:path}")
+        async def get_contents(owner: str, repo: str, path: str):
+            return self._file(owner, repo, path)
+        
+        @app.get("/_mock/stats")
+        async def get_stats():
+            return {**self.stats, "rate_limit": self._rate_limit_headers()}
+        
+        @app.post("/_mock/reset")
+        async def reset():
+            self.reset()
+            return {"message": "reset"}
+        
+        return app
+
+
+@contextmanager
+def serve_in_thread(mock: MockGitHub, host: str = "127.0.0.1", port: int = 8765) -> Iterator[str]:
+    """在后台线程中启动模拟服务，返回其地址，退出时关闭"""
+    import uvicorn
+    
+    server = uvicorn.Server(uvicorn.Config(mock.create_app(), host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f"模拟GitHub服务启动失败（{host}:{port}）")
+        time.sleep(0.05)
+    try:
+        yield f"http://{host}:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    """模拟服务的数据集和行为参数（bench_github_sync 共用）"""
+    parser.add_argument("--rows", type=int, default=10000, help="合成数据集的仓库数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--readme-ratio", type=float, default=0.8, help="有README的仓库比例")
+    parser.add_argument("--username", default="octocat")
+    parser.add_argument("--fixture", help="读取保存的数据集JSON（不再生成合成数据）")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="每个请求的固定延迟（毫秒）")
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0, help="延迟的随机抖动范围（毫秒）")
+    parser.add_argument("--rate-limit", type=int, default=5000, help="每个窗口的请求配额")
+    parser.add_argument("--rate-limit-window", type=float, default=3600.0, help="配额窗口秒数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入5xx错误的比例")
+    parser.add_argument("--secondary-rate-limit-rate", type=float, default=0.0, help="注入二级限流（403）的比例")
+
+
+def create_mock(args) -> MockGitHub:
+    if args.fixture:
+        with open(args.fixture, encoding="utf-8") as f:
+            fixture = json.load(f)
+    else:
+        fixture = build_fixture(args.rows, seed=args.seed, readme_ratio=args.readme_ratio, username=args.username)
+    return MockGitHub(fixture, MockConfig(
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        rate_limit=args.rate_limit,
+        rate_limit_window=args.rate_limit_window,
+        error_rate=args.error_rate,
+        secondary_rate_limit_rate=args.secondary_rate_limit_rate,
+        seed=args.seed,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的GitHub API")
+    add_config_arguments(parser)
+    parser.add_argument("--save-fixture", help="把数据集保存为JSON后退出")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    
+    mock = create_mock(args)
+    if args.save_fixture:
+        with open(args.save_fixture, "w", encoding="utf-8") as f:
+            json.dump(mock.fixture, f, ensure_ascii=False)
+        print(f"数据集已保存到 {args.save_fixture}：{len(mock.fixture['starred'])} 个仓库，{len(mock.readmes)} 个README")
+        return
+    
+    import uvicorn
+    print(f"模拟GitHub API: http://{args.host}:{args.port}（{len(mock.fixture['starred'])} 个仓库，用户 {args.username}）")
+    uvicorn.run(mock.create_app(), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
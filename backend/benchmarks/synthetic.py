@@ -0,0 +1,253 @@
+"""合成数据生成器：生成接近真实分布的 starred_repos / repo_readmes 数据集，供基准测试使用
+
+同一个 seed 总是生成相同的数据；star数、owner和语言使用长尾分布，topics、fork和许可证按常见比例生成，
+README长度服从对数正态分布，内容由仓库名、描述和topic词汇拼成的Markdown。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.synthetic --rows 10000 --database sqlite:///./synthetic.db
+    python -m benchmarks.synthetic --rows 100000 --readme-ratio 0.5 --seed 7
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 常见语言及其大致占比（其余为None，即GitHub未识别语言的仓库）
+LANGUAGES = [
+    ("Python", 0.18), ("JavaScript", 0.14), ("TypeScript", 0.13), ("Go", 0.08), ("Rust", 0.07),
+    ("Java", 0.06), ("C++", 0.05), ("C", 0.04), ("Shell", 0.03), ("Ruby", 0.02), ("Swift", 0.02),
+    ("Kotlin", 0.02), ("PHP", 0.02), ("Jupyter Notebook", 0.02), ("Vue", 0.02), ("Zig", 0.01),
+    ("Lua", 0.01), ("Haskell", 0.01), (None, 0.06)
+]
+
+TOPIC_WORDS = [
+    "machine-learning", "deep-learning", "llm", "nlp", "computer-vision", "database", "sql", "cli",
+    "web", "react", "vue", "frontend", "backend", "api", "rest", "graphql", "devops", "kubernetes",
+    "docker", "cloud", "serverless", "security", "crypto", "blockchain", "game", "gamedev", "embedded",
+    "iot", "robotics", "compiler", "parser", "interpreter", "terminal", "editor", "vim", "emacs",
+    "testing", "benchmark", "performance", "async", "networking", "http", "search", "vector-database",
+    "embeddings", "data-visualization", "analytics", "etl", "streaming", "monitoring", "observability",
+    "documentation", "static-site", "markdown", "awesome-list", "tutorial", "education", "mobile",
+    "android", "ios", "desktop", "gui", "audio", "video", "image-processing", "scraper", "automation"
+]
+
+NAME_PARTS = [
+    "fast", "tiny", "open", "micro", "hyper", "deep", "auto", "smart", "light", "neo", "super", "simple",
+    "py", "go", "rs", "js", "ts", "kit", "lab", "hub", "flow", "core", "base", "stack", "forge", "craft",
+    "db", "ml", "ai", "net", "web", "cli", "ui", "api", "cache", "queue", "graph", "vector", "search",
+    "shell", "term", "doc", "bench", "scan", "sync", "store", "stream", "pipe", "proxy", "router"
+]
+
+DESCRIPTION_TEMPLATES = [
+    "A {adjective} {thing} for {topic}",
+    "{adjective} {thing} written in {language}",
+    "The {adjective} way to build {topic} applications",
+    "Collection of {topic} resources and {thing}s",
+    "{thing} for {topic} with first-class {other} support",
+    "Experimental {thing} exploring {topic} and {other}",
+]
+
+ADJECTIVES = [
+    "fast", "minimal", "modern", "lightweight", "scalable", "production-ready", "simple", "blazing fast",
+    "type-safe", "zero-dependency"
+]
+THINGS = ["library", "framework", "toolkit", "engine", "server", "client", "CLI", "SDK", "runtime", "plugin"]
+
+# (许可证名称, key, 占比)
+LICENSES = [
+    ("MIT License", "mit", 0.45), ("Apache License 2.0", "apache-2.0", 0.25),
+    ("GNU General Public License v3.0", "gpl-3.0", 0.1),
+    ("BSD 3-Clause \"New\" or \"Revised\" License", "bsd-3-clause", 0.05), (None, None, 0.15)
+]
+
+# 生成数据的基准时间，固定以保证可复现
+BASE_TIME = datetime(2025, 1, 1)
+
+
+def _weighted_choice(rng: np.random.Generator, items: List, weights: List[float], size: int) -> np.ndarray:
+    weights = np.asarray(weights, dtype=np.float64)
+    return rng.choice(len(items), size=size, p=weights / weights.sum())
+
+
+def generate_repos(count: int, seed: int = 42, start_repo_id: int = 1) -> List[Dict]:
+    """生成count个仓库的字段字典（与 schemas.StarredRepoCreate 字段一致）"""
+    rng = np.random.default_rng(seed)
+    
+    # owner长尾分布：少数owner拥有大量仓库（最多的约占1%），大多数只有一两个
+    owner_count = max(1, count // 5)
+    owner_ranks = (rng.power(0.6, count) * owner_count).astype(np.int64)
+    # star数长尾：大多数仓库几十到几百，少数上万
+    stars = np.minimum(rng.lognormal(mean=5.0, sigma=2.0, size=count), 400000).astype(np.int64)
+    language_index = _weighted_choice(rng, LANGUAGES, [weight for _, weight in LANGUAGES], count)
+    license_index = _weighted_choice(rng, LICENSES, [weight for _, _, weight in LICENSES], count)
+    topic_counts = np.where(rng.random(count) < 0.35, 0, rng.integers(1, 8, count))
+    
+    # 创建时间在基准时间前12年内，star时间在创建之后，最近推送时间偏向最近
+    created_days = rng.uniform(30, 12 * 365, count)
+    starred_days = created_days * rng.random(count)
+    pushed_days = np.minimum(created_days, rng.exponential(120, count))
+    
+    repos = []
+    for i in range(count):
+        owner = f"{NAME_PARTS[owner_ranks[i] % len(NAME_PARTS)]}-{owner_ranks[i]}"
+        name = f"{NAME_PARTS[rng.integers(len(NAME_PARTS))]}{NAME_PARTS[rng.integers(len(NAME_PARTS))]}-{i}"
+        language = LANGUAGES[language_index[i]][0]
+        topics = [TOPIC_WORDS[t] for t in rng.choice(len(TOPIC_WORDS), int(topic_counts[i]), replace=False)]
+        
+        template = DESCRIPTION_TEMPLATES[rng.integers(len(DESCRIPTION_TEMPLATES))]
+        description = template.format(
+            adjective=ADJECTIVES[rng.integers(len(ADJECTIVES))],
+            thing=THINGS[rng.integers(len(THINGS))],
+            topic=(topics[0] if topics else TOPIC_WORDS[rng.integers(len(TOPIC_WORDS))]).replace("-", " "),
+            other=TOPIC_WORDS[rng.integers(len(TOPIC_WORDS))].replace("-", " "),
+            language=language or "plain text"
+        ) if rng.random() > 0.08 else None
+        
+        license_name, license_key, _ = LICENSES[license_index[i]]
+        created_at = BASE_TIME - timedelta(days=float(created_days[i]))
+        pushed_at = BASE_TIME - timedelta(days=float(pushed_days[i]))
+        repo_id = start_repo_id + i
+        
+        repos.append({
+            "repo_id": repo_id,
+            "name": name,
+            "full_name": f"{owner}/{name}",
+            "description": description,
+            "html_url": f"https://github.com/{owner}/{name}",
+            "clone_url": f"https://github.com/{owner}/{name}.git",
+            "ssh_url": f"git@github.com:{owner}/{name}.git",
+            "language": language,
+            "stargazers_count": int(stars[i]),
+            "forks_count": int(stars[i] * rng.uniform(0.02, 0.2)),
+            "open_issues_count": int(rng.poisson(3 + stars[i] ** 0.4)),
+            "topics": json.dumps(topics),
+            "owner_login": owner,
+            "owner_avatar_url": f"https://avatars.githubusercontent.com/u/{owner_ranks[i] + 1}?v=4",
+            "starred_at": BASE_TIME - timedelta(days=float(starred_days[i])),
+            "created_at": created_at,
+            "updated_at": max(pushed_at, created_at),
+            "pushed_at": pushed_at,
+            "is_fork": bool(rng.random() < 0.05),
+            "is_private": False,
+            "size": int(rng.lognormal(7, 2)),
+            "default_branch": "main" if rng.random() < 0.8 else "master",
+            "license_name": license_name,
+            "license_key": license_key,
+        })
+    return repos
+
+
+def generate_readme(repo: Dict, rng: np.random.Generator) -> str:
+    """生成一个仓库的README：标题、描述、若干章节和代码块，长度服从对数正态分布（中位数约1.5KB）"""
+    topics = json.loads(repo["topics"]) or [TOPIC_WORDS[rng.integers(len(TOPIC_WORDS))]]
+    target_length = int(min(rng.lognormal(7.3, 0.8), 20000))
+    
+    parts = [f"# {repo['name']}\n", f"{repo['description'] or ''}\n"]
+    length = sum(len(part) for part in parts)
+    sections = ["Features", "Installation", "Usage", "Configuration", "Examples", "Contributing", "License"]
+    while length < target_length:
+        section = sections[rng.integers(len(sections))]
+        words = [TOPIC_WORDS[rng.integers(len(TOPIC_WORDS))].replace("-", " ") for _ in range(12)]
+        section_parts = [
+            f"\n## {section}\n\n",
+            f"{repo['name']} provides {ADJECTIVES[rng.integers(len(ADJECTIVES))]} support for "
+            f"{', '.join(topic.replace('-', ' ') for topic in topics)}. It works well with {' and '.join(words[:3])}, "
+            f"and integrates with {words[3]} and {words[4]} pipelines. See the {words[5]} guide for details.\n"
+        ]
+        if section in ("Installation", "Usage"):
+            section_parts.append(f"\n```bash\npip install {repo['name'].lower()}\n{repo['name'].lower()} --help\n```\n")
+        parts.extend(section_parts)
+        length += sum(len(part) for part in section_parts)
+    return "".join(parts)[:target_length]
+
+
+def iter_readme_rows(repos: List[Dict], seed: int = 42, readme_ratio: float = 0.8) -> Iterator[Dict]:
+    """为约readme_ratio比例的仓库生成README数据行（与 repo_readmes 表字段一致）"""
+    rng = np.random.default_rng(seed + 1)
+    for repo in repos:
+        if rng.random() >= readme_ratio:
+            continue
+        content = generate_readme(repo, rng)
+        yield {
+            "repo_id": repo["repo_id"],
+            "content": content,
+            "content_hash": hashlib.md5(content.encode("utf-8")).hexdigest(),
+            "embedding_id": f"repo_{repo['repo_id']}",
+            "processed_at": BASE_TIME,
+            "updated_at": BASE_TIME,
+        }
+
+
+def insert_readmes(db, rows: Iterator[Dict], chunk_size: int = 5000) -> int:
+    """分块批量写入README数据行（已存在的repo_id跳过），返回写入的行数"""
+    from sqlalchemy.dialects.sqlite import insert
+    from app.database import RepoReadme
+    
+    stmt = insert(RepoReadme).on_conflict_do_nothing(index_elements=["repo_id"])
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            db.execute(stmt, chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        db.execute(stmt, chunk)
+        count += len(chunk)
+    db.commit()
+    return count
+
+
+def populate(db, repos: List[Dict], seed: int = 42, readme_ratio: float = 0.8, chunk_size: int = 5000) -> Dict:
+    """把仓库写入数据库（使用同步时的批量upsert），并分块写入README，返回各表的行数和耗时"""
+    from app import crud, schemas
+    
+    start = time.perf_counter()
+    for i in range(0, len(repos), chunk_size):
+        crud.bulk_upsert_starred_repos_fast(db, [schemas.StarredRepoCreate(**repo) for repo in repos[i:i + chunk_size]])
+    repo_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    readme_count = insert_readmes(db, iter_readme_rows(repos, seed, readme_ratio), chunk_size)
+    
+    return {
+        "starred_repos": len(repos),
+        "repo_readmes": readme_count,
+        "repo_seconds": round(repo_seconds, 3),
+        "readme_seconds": round(time.perf_counter() - start, 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成合成的 starred_repos / repo_readmes 数据集")
+    parser.add_argument("--rows", type=int, default=10000, help="仓库数（常用 1000 / 10000 / 100000）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--readme-ratio", type=float, default=0.8, help="有README的仓库比例")
+    parser.add_argument("--database", default="sqlite:///./synthetic.db", help="写入的数据库URL")
+    args = parser.parse_args()
+    
+    # 数据库路径在导入前通过环境变量指定
+    os.environ["DATABASE_URL"] = args.database
+    from app.database import SessionLocal, create_tables
+    
+    create_tables()
+    repos = generate_repos(args.rows, seed=args.seed)
+    db = SessionLocal()
+    try:
+        counts = populate(db, repos, seed=args.seed, readme_ratio=args.readme_ratio)
+    finally:
+        db.close()
+    print(json.dumps({"database": args.database, "seed": args.seed, **counts}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,7 @@ export interface StarredRepo {
   starred_at: string
   created_at: string
   updated_at: string
+  pushed_at?: string
   is_fork: boolean
   is_private: boolean
   size: number